@@ -1,24 +1,108 @@
 
 import os
 from flask import Flask
-from mongoengine import connect
 from flask_login import LoginManager
-from .model import Book, User, seed_books_if_empty, seed_users_if_missing
+from werkzeug.middleware.proxy_fix import ProxyFix
+from .aio import reads
+from .covers import CoverCache
+from .db import init_db
+from .events import availability
+from .metrics import instrumentation
+from .model import Branch, User, facet_cache, user_cache
 
 login_manager = LoginManager()
 
-def create_app():
+def create_app(config=None):
     app = Flask(__name__)
+    if config:
+        app.config.update(config)
 
-    app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "secret_key_1234")
+    if not app.config.get("SECRET_KEY"):
+        app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "secret_key_1234")
+
+    # Reverse proxies in front of the app whose X-Forwarded-* headers are trusted,
+    # so request.remote_addr (and the per-IP login throttle) is the client's.
+    app.config.setdefault("TRUSTED_PROXIES", int(os.environ.get("TRUSTED_PROXIES", 0)))
+    if app.config["TRUSTED_PROXIES"]:
+        hops = app.config["TRUSTED_PROXIES"]
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
 
     app.config.setdefault("MONGODB_HOST", "mongodb://localhost:27017/sg_library")
-    connect(host=app.config["MONGODB_HOST"])
+    # Client options (see app/db.py); None leaves pymongo's default.
+    app.config.setdefault("MONGODB_MAX_POOL_SIZE", int(os.environ.get("MONGODB_MAX_POOL_SIZE", 100)))
+    app.config.setdefault("MONGODB_MIN_POOL_SIZE", 0)
+    app.config.setdefault("MONGODB_MAX_IDLE_TIME_MS", None)
+    app.config.setdefault("MONGODB_WAIT_QUEUE_TIMEOUT_MS", 2000)
+    app.config.setdefault("MONGODB_CONNECT_TIMEOUT_MS", 5000)
+    app.config.setdefault("MONGODB_SERVER_SELECTION_TIMEOUT_MS", 5000)
+    app.config.setdefault("MONGODB_SOCKET_TIMEOUT_MS", None)
+    app.config.setdefault("MONGODB_COMPRESSORS", os.environ.get("MONGODB_COMPRESSORS"))
+    app.config.setdefault("MONGODB_ZLIB_LEVEL", None)
+    app.config.setdefault("MONGODB_APPNAME", "sg_library")
+    app.config.setdefault("MONGODB_READ_PREFERENCE", "primary")
+    # Catalogue reads (book lists, detail, search) may go to secondaries.
+    app.config.setdefault("MONGODB_CATALOGUE_HOST", os.environ.get("MONGODB_CATALOGUE_HOST"))
+    app.config.setdefault("MONGODB_CATALOGUE_READ_PREFERENCE",
+                          os.environ.get("MONGODB_CATALOGUE_READ_PREFERENCE", "secondaryPreferred"))
+    app.config.setdefault("MONGODB_MAX_STALENESS_S", None)
+    # Seeding and index builds run from `flask migrate`. Debug servers migrate on
+    # boot so a fresh database gets its indexes and seed data.
+    app.config.setdefault("MIGRATE_ON_STARTUP", os.environ.get("MIGRATE_ON_STARTUP") == "1" or app.debug)
+    app.config.setdefault("BOOKS_PAGE_SIZE", int(os.environ.get("BOOKS_PAGE_SIZE", 20)))
+    app.config.setdefault("BOOKS_MAX_PAGE_SIZE", 100)
+    app.config.setdefault("LOANS_PAGE_SIZE", 20)
+    app.config.setdefault("BORROW_LIMIT", None)
+    app.config.setdefault("LOANS_BATCH_MAX", 100)
+    app.config.setdefault("API_PAGE_SIZE", 50)
+    app.config.setdefault("API_MAX_PAGE_SIZE", 500)
+    app.config.setdefault("API_EXPORT_BATCH_SIZE", 1000)
+    app.config.setdefault("FACET_CACHE_TTL", 300)
+    app.config.setdefault("CARD_FRAGMENT_CACHE", False)
+    app.config.setdefault("USER_CACHE_TTL", 300)
+    app.config.setdefault("USER_CACHE_SIZE", 10000)
+    app.config.setdefault("PASSWORD_HASH_METHOD", os.environ.get("PASSWORD_HASH_METHOD", User.HASH_METHOD))
+    # Branch for stock and loans that don't name one (new titles, imports, old data).
+    app.config.setdefault("DEFAULT_BRANCH", os.environ.get("DEFAULT_BRANCH", Branch.DEFAULT))
+    facet_cache.ttl = app.config["FACET_CACHE_TTL"]
+    user_cache.ttl = app.config["USER_CACHE_TTL"]
+    user_cache.maxsize = app.config["USER_CACHE_SIZE"]
+    app.extensions["user_cache"] = user_cache
+    User.HASH_METHOD = app.config["PASSWORD_HASH_METHOD"]
+    Branch.DEFAULT = app.config["DEFAULT_BRANCH"]
+
+    app.config.setdefault("COVER_CACHE_DIR", os.path.join(app.instance_path, "covers"))
+    app.config.setdefault("COVER_CACHE_MAX_BYTES", 256 * 1024 * 1024)
+    app.config.setdefault("COVER_FETCH_WORKERS", 4)
+    app.config.setdefault("COVER_MAX_AGE", 7 * 24 * 3600)
+    app.extensions["covers"] = CoverCache(
+        app.config["COVER_CACHE_DIR"],
+        max_bytes=app.config["COVER_CACHE_MAX_BYTES"],
+        workers=app.config["COVER_FETCH_WORKERS"],
+    )
+
+    instrumentation.init_app(app)
+    init_db(app)
+    reads.init_app(app)
+    availability.init_app(app)
 
     from .books_bp import bp as books_bp
     from .auth_bp import bp as auth_bp
+    from .api_bp import bp as api_bp
     app.register_blueprint(books_bp)
     app.register_blueprint(auth_bp)
+    app.register_blueprint(api_bp)
+    if app.config["ASYNC_READS"]:
+        from .books_bp.async_views import install
+        install(app)
+
+    from .cli import register_commands
+    register_commands(app)
+
+    from .books_bp.routes import card_cache
+    for name, cache in (("user", user_cache), ("facet", facet_cache), ("card", card_cache)):
+        instrumentation.add_gauge(f"sg_{name}_cache_hits", lambda c=cache: c.hits)
+        instrumentation.add_gauge(f"sg_{name}_cache_misses", lambda c=cache: c.misses)
+    instrumentation.add_gauge("sg_sse_subscribers", availability.subscriber_count)
 
     login_manager.init_app(app)
     login_manager.login_view = "auth.login"
@@ -27,10 +111,11 @@ def create_app():
 
     @login_manager.user_loader
     def load_user(user_id):
-        return User.objects(id=user_id).first()
+        return User.load_principal(user_id)
 
-    with app.app_context():
-        seed_books_if_empty()
-        seed_users_if_missing()
+    if app.config["MIGRATE_ON_STARTUP"]:
+        from .migrations import migrate
+        with app.app_context():
+            migrate()
 
     return app
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import threading
+from typing import Any, Coroutine, Dict, Optional, Tuple
+
+from pymongo import AsyncMongoClient
+
+from .db import CATALOGUE_ALIAS, client_options
+from .metrics import adopt_stats, current_stats
+
+
+async def _gather(*aws):
+    return await asyncio.gather(*aws)
+
+
+async def _counted(aw: Coroutine, stats) -> Any:
+    # Runs as its own task on the client loop; the request's stats go with it
+    # so the command listener counts these queries like sync ones.
+    adopt_stats(stats)
+    return await aw
+
+
+class AsyncReads:
+    """
+    pymongo AsyncMongoClients for the async read views (books_bp/async_views.py).
+
+    Flask runs each async view in a short-lived event loop of its own, which an
+    AsyncMongoClient must not outlive, so every worker process keeps one
+    background loop that owns the clients and the views hand their queries to it
+    with run()/gather(). The connection settings match the sync aliases in
+    app/db.py.
+    """
+
+    def __init__(self):
+        self._settings: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+        self._clients: Dict[str, AsyncMongoClient] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app) -> None:
+        app.config.setdefault("ASYNC_READS", os.environ.get("ASYNC_READS") == "1")
+        config = app.config
+        self._settings = {
+            "default": (config["MONGODB_HOST"],
+                        client_options(config, config["MONGODB_READ_PREFERENCE"])),
+            CATALOGUE_ALIAS: (config["MONGODB_CATALOGUE_HOST"] or config["MONGODB_HOST"],
+                              client_options(config, config["MONGODB_CATALOGUE_READ_PREFERENCE"])),
+        }
+        app.extensions["async_reads"] = self
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """Start the loop thread on first use (after any worker fork)."""
+        if self._loop is not None and self._pid == os.getpid():
+            return self._loop
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="async-reads", daemon=True).start()
+                self._clients = {}
+                self._loop, self._pid = loop, os.getpid()
+        return self._loop
+
+    def collection(self, doc_cls, alias: str = "default"):
+        """doc_cls's AsyncCollection; only call from coroutines passed to run()/gather()."""
+        client = self._clients.get(alias)
+        if client is None:
+            host, options = self._settings[alias]
+            client = self._clients[alias] = AsyncMongoClient(host, **options)
+        return client.get_default_database()[doc_cls._get_collection_name()]
+
+    def catalogue(self, doc_cls):
+        return self.collection(doc_cls, CATALOGUE_ALIAS)
+
+    async def run(self, aw: Coroutine) -> Any:
+        """Await 'aw' on the client loop from a view's own loop, counted in the request's metrics."""
+        future = asyncio.run_coroutine_threadsafe(_counted(aw, current_stats()), self._ensure_loop())
+        return await asyncio.wrap_future(future)
+
+    async def gather(self, *aws: Coroutine) -> list:
+        """Run independent queries concurrently; results in argument order."""
+        return await self.run(_gather(*aws))
+
+
+reads = AsyncReads()
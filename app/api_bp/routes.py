@@ -0,0 +1,201 @@
+import csv
+import io
+import json
+from datetime import date, datetime
+from functools import wraps
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from flask import Response, abort, current_app, jsonify, request, stream_with_context
+from flask_login import current_user
+
+from . import bp
+from ..importer import CSV_LIST_SEP
+from ..model import Book, Loan
+
+BOOK_FIELDS = ("title", "category", "genres", "authors", "pages", "available", "copies",
+               "url", "description", "version")
+BOOK_DEFAULT_FIELDS = tuple(f for f in BOOK_FIELDS if f != "description")
+LOAN_FIELDS = ("user", "book", "borrow_date", "due_date", "return_date", "renew_count")
+
+
+def _jsonable(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, list):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    return value
+
+
+def _row(doc, fields):
+    out = {"id": str(doc["_id"])}
+    for f in fields:
+        out[f] = _jsonable(doc.get(f))
+    return out
+
+
+def _fields(allowed, default):
+    """Fields requested with ?fields=a,b (unknown names are a 400)."""
+    raw = request.args.get("fields")
+    if not raw:
+        return default
+    fields = tuple(f.strip() for f in raw.split(",") if f.strip())
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        abort(400, description=f"unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def _limit():
+    limit = request.args.get("limit", current_app.config["API_PAGE_SIZE"], type=int)
+    return max(1, min(limit, current_app.config["API_MAX_PAGE_SIZE"]))
+
+
+def _oid(value):
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        abort(400, description="invalid id")
+
+
+def api_login_required(admin=False):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_user.is_authenticated:
+                return jsonify(error="authentication required"), 401
+            if admin and not getattr(current_user, "is_admin", False):
+                return jsonify(error="admin only"), 403
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@bp.errorhandler(400)
+def _bad_request(e):
+    return jsonify(error=e.description), 400
+
+
+@bp.errorhandler(404)
+def _not_found(e):
+    return jsonify(error="not found"), 404
+
+
+@bp.route("/books")
+def books():
+    fields = _fields(BOOK_FIELDS, BOOK_DEFAULT_FIELDS)
+    limit = _limit()
+    query = {}
+    if request.args.get("category"):
+        query["category"] = request.args["category"]
+    if request.args.get("after"):
+        query["title"] = {"$gt": request.args["after"]}
+
+    cursor = (Book._reads()
+              .find(query, dict.fromkeys(fields + ("title",), 1))
+              .sort("title", 1).limit(limit + 1))
+    docs = list(cursor)
+    more = len(docs) > limit
+    docs = docs[:limit]
+    return jsonify(
+        items=[_row(d, fields) for d in docs],
+        next=docs[-1]["title"] if more else None,
+    )
+
+
+@bp.route("/books/<book_id>")
+def book(book_id):
+    fields = _fields(BOOK_FIELDS, BOOK_FIELDS)
+    doc = Book._reads().find_one({"_id": _oid(book_id)}, dict.fromkeys(fields, 1))
+    if not doc:
+        abort(404)
+    return jsonify(_row(doc, fields))
+
+
+@bp.route("/availability")
+def availability():
+    """?title=...&title=... or ?id=...; at most API_MAX_PAGE_SIZE keys per call."""
+    titles = request.args.getlist("title")
+    ids = [_oid(i) for i in request.args.getlist("id")]
+    if len(titles) + len(ids) > current_app.config["API_MAX_PAGE_SIZE"]:
+        abort(400, description="too many books requested")
+    query = {"$or": [{"title": {"$in": titles}}, {"_id": {"$in": ids}}]}
+    docs = Book._reads().find(query, {"title": 1, "available": 1, "copies": 1, **Book.HOLDING_FIELDS})
+    return jsonify(items=[_row(d, ("title", "available", "copies", "holdings")) for d in docs])
+
+
+@bp.route("/loans")
+@api_login_required()
+def loans():
+    """The caller's loans by id; admins see every loan (optionally ?user=<id>)."""
+    fields = _fields(LOAN_FIELDS, LOAN_FIELDS)
+    limit = _limit()
+    if getattr(current_user, "is_admin", False):
+        query = {"user": _oid(request.args["user"])} if request.args.get("user") else {}
+    else:
+        query = {"user": current_user.id}
+    if request.args.get("after"):
+        query["_id"] = {"$gt": _oid(request.args["after"])}
+
+    docs = list(Loan._get_collection()
+                .find(query, dict.fromkeys(fields, 1))
+                .sort("_id", 1).limit(limit + 1))
+    more = len(docs) > limit
+    docs = docs[:limit]
+    return jsonify(
+        items=[_row(d, fields) for d in docs],
+        next=str(docs[-1]["_id"]) if more else None,
+    )
+
+
+def _stream(collection, query, fields, fmt, filename):
+    """NDJSON or CSV straight off a raw pymongo cursor; memory stays flat."""
+    batch_size = current_app.config["API_EXPORT_BATCH_SIZE"]
+    cursor = collection.find(query, dict.fromkeys(fields, 1)).batch_size(batch_size)
+
+    def ndjson():
+        for doc in cursor:
+            yield json.dumps(_row(doc, fields)) + "\n"
+
+    def csv_rows():
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(("id",) + fields)
+        for n, doc in enumerate(cursor, start=1):
+            row = _row(doc, fields)
+            writer.writerow([
+                CSV_LIST_SEP.join(map(str, v)) if isinstance(v, list) else ("" if v is None else v)
+                for v in row.values()
+            ])
+            if n % batch_size == 0:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        yield buf.getvalue()
+
+    if fmt == "ndjson":
+        body, mimetype = ndjson(), "application/x-ndjson"
+    elif fmt == "csv":
+        body, mimetype = csv_rows(), "text/csv"
+    else:
+        abort(404)
+    resp = Response(stream_with_context(body), mimetype=mimetype)
+    resp.headers["Content-Disposition"] = f'attachment; filename="{filename}.{fmt}"'
+    return resp
+
+
+@bp.route("/export/books.<fmt>")
+def export_books(fmt):
+    fields = _fields(BOOK_FIELDS, BOOK_FIELDS)
+    return _stream(Book._reads(), {}, fields, fmt, "books")
+
+
+@bp.route("/export/loans.<fmt>")
+@api_login_required(admin=True)
+def export_loans(fmt):
+    fields = _fields(LOAN_FIELDS, LOAN_FIELDS)
+    return _stream(Loan._get_collection(), {}, fields, fmt, "loans")
@@ -1,4 +1,19 @@
-
 from flask import Blueprint
+from .throttle import Throttle
+
 bp = Blueprint("auth", __name__, url_prefix="", template_folder="../../templates")
+
+@bp.record_once
+def _init_throttle(state):
+    cfg = state.app.config
+    cfg.setdefault("LOGIN_RATE_WINDOW", 300)
+    cfg.setdefault("LOGIN_EMAIL_LIMIT", 5)
+    cfg.setdefault("LOGIN_IP_LIMIT", 20)
+    state.app.extensions["auth_throttle"] = Throttle(
+        backend=cfg.get("LOGIN_THROTTLE_BACKEND"),
+        window=cfg["LOGIN_RATE_WINDOW"],
+        email_limit=cfg["LOGIN_EMAIL_LIMIT"],
+        ip_limit=cfg["LOGIN_IP_LIMIT"],
+    )
+
 from . import routes  
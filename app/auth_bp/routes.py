@@ -1,8 +1,17 @@
-from flask import render_template, request, redirect, url_for, flash
+from flask import render_template, request, redirect, url_for, flash, current_app
 from flask_login import login_user, logout_user, current_user
 from . import bp
 from ..model import User
 
+def _throttled(template, **limits):
+    throttle = current_app.extensions["auth_throttle"]
+    if throttle.allow(ip=request.remote_addr, **limits):
+        return None
+    flash("Too many attempts. Please wait a few minutes and try again.", "danger")
+    resp = current_app.make_response((render_template(template), 429))
+    resp.headers["Retry-After"] = str(int(throttle.window))
+    return resp
+
 @bp.route("/register", methods=["GET", "POST"])
 def register():
     if current_user.is_authenticated:
@@ -15,6 +24,10 @@ def register():
             flash("Please fill in all fields.", "warning")
             return render_template("register.html")
 
+        blocked = _throttled("register.html")
+        if blocked:
+            return blocked
+
         if User.objects(email=email).first():
             flash("Email already registered.", "danger")
             return render_template("register.html")
@@ -33,8 +46,15 @@ def login():
     if request.method == "POST":
         email = request.form.get("email", "").strip().lower()
         password = request.form.get("password", "")
+        blocked = _throttled("login.html", email=email)
+        if blocked:
+            return blocked
+
         user = User.objects(email=email).first()
         if user and user.check_pw(password):
+            current_app.extensions["auth_throttle"].reset_email(email)
+            if user.needs_rehash():
+                user.rehash_pw(password)
             login_user(user, remember=False)
             flash("Logged in.", "success")
             return redirect(url_for("books.book_titles"))
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Iterable, Optional
+
+
+class MemoryBackend:
+    """
+    Sliding-window hit counter kept in process memory.
+    Any object with the same hit/count/reset methods can replace it
+    (e.g. one backed by Redis when running several workers).
+    """
+
+    def __init__(self):
+        self._hits = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._swept = time.monotonic()
+
+    def _trim(self, key: str, window: float, now: float) -> int:
+        """Drop hits older than 'window'; keys left empty are deleted."""
+        q = self._hits.get(key)
+        while q and q[0] <= now - window:
+            q.popleft()
+        if not q:
+            self._hits.pop(key, None)
+            return 0
+        return len(q)
+
+    def _sweep(self, window: float, now: float) -> None:
+        # Keys that are never tried again would otherwise stay forever, so
+        # once per window drop every key whose hits have all expired.
+        if now - self._swept < window:
+            return
+        self._swept = now
+        for key in [k for k, q in self._hits.items() if q[-1] <= now - window]:
+            del self._hits[key]
+
+    def count(self, key: str, window: float) -> int:
+        now = time.monotonic()
+        with self._lock:
+            return self._trim(key, window, now)
+
+    def hit(self, key: str, window: float) -> int:
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(window, now)
+            self._trim(key, window, now)
+            q = self._hits[key]
+            q.append(now)
+            return len(q)
+
+    def __len__(self) -> int:
+        """Number of keys currently tracked."""
+        with self._lock:
+            return len(self._hits)
+
+    def reset(self, key: str) -> None:
+        with self._lock:
+            self._hits.pop(key, None)
+
+
+class Throttle:
+    """Per-key attempt limits checked before any password hashing is done."""
+
+    def __init__(self, backend=None, window: float = 300, email_limit: int = 5,
+                 ip_limit: int = 20):
+        self.backend = backend or MemoryBackend()
+        self.window = window
+        self.email_limit = email_limit
+        self.ip_limit = ip_limit
+
+    def _limits(self, email: Optional[str], ip: Optional[str]) -> Iterable[tuple]:
+        if email:
+            yield f"email:{email}", self.email_limit
+        if ip:
+            yield f"ip:{ip}", self.ip_limit
+
+    def allow(self, *, email: Optional[str] = None, ip: Optional[str] = None) -> bool:
+        """Record an attempt; False if any key is already over its limit."""
+        limits = list(self._limits(email, ip))
+        if any(self.backend.count(key, self.window) >= limit for key, limit in limits):
+            return False
+        for key, _ in limits:
+            self.backend.hit(key, self.window)
+        return True
+
+    def reset_email(self, email: str) -> None:
+        self.backend.reset(f"email:{email}")
@@ -0,0 +1,150 @@
+# Async variants of the catalogue, detail, search and loans pages, installed in
+# place of the sync views when ASYNC_READS is set. Queries run on the
+# AsyncMongoClient loop in app/aio.py; the independent ones of each page go out
+# together with reads.gather() instead of one after another. Rendering is
+# shared with routes.py.
+import asyncio
+
+from flask import abort, current_app, request
+from flask_login import current_user, login_required
+
+from ..aio import reads
+from ..model import Book, Counter, Hold, Loan, LoanSummary, SimilarBooks, facet_cache
+from ..readmodel import BookView, LoanView
+from .routes import (
+    _detail_etag, _etag_for, _not_modified, _render_detail, _render_loans, _render_search,
+    _render_titles, _titles_args, _titles_count_query, _wants_hold,
+)
+
+_MISSING = object()
+
+
+async def _to_list(cursor):
+    return await cursor.to_list(None)
+
+
+async def _aggregate(coll, pipeline):
+    return await (await coll.aggregate(pipeline)).to_list(None)
+
+
+async def _none():
+    return None
+
+
+async def _facet_counts(field):
+    counts = facet_cache.get(field, _MISSING)
+    if counts is _MISSING:
+        rows = await _aggregate(reads.catalogue(Book), Book._facet_pipeline(field))
+        counts = Book._facet_result(rows)
+        facet_cache.set(field, counts)
+    return counts
+
+
+async def _count(query):
+    return await reads.catalogue(Book).count_documents(query)
+
+
+async def _generation():
+    doc = await reads.catalogue(Counter).find_one({"_id": Book.GENERATION})
+    return (doc.get("value", 0), doc.get("updated_at")) if doc else (0, None)
+
+
+async def _title_page(args):
+    pipeline = Book._title_page_pipeline(
+        category=args["category"], genre=args["genre"],
+        after=args["after"], before=args["before"], limit=args["limit"],
+    )
+    rows = await _aggregate(reads.catalogue(Book), pipeline)
+    return Book._title_page_result(rows, after=args["after"], before=args["before"], limit=args["limit"])
+
+
+async def book_titles():
+    generation, changed_at = await reads.run(_generation())
+    etag = _etag_for("titles", generation, request.query_string.decode())
+    not_modified = _not_modified(etag, changed_at)
+    if not_modified:
+        return not_modified
+
+    args = _titles_args()
+    count_query = _titles_count_query(args)
+    page, category_counts, genre_counts, genre_total = await reads.gather(
+        _title_page(args),
+        _facet_counts("category"),
+        _facet_counts("genres"),
+        _count(count_query) if count_query else _none(),
+    )
+    return _render_titles(args, page, category_counts, genre_counts, genre_total, etag, changed_at)
+
+
+async def _detail(title, user_id):
+    # The full row, not just a version stamp: one round trip instead of two,
+    # at the cost of a larger read when the answer turns out to be a 304.
+    book = await reads.catalogue(Book).find_one({"title": title}, BookView.detail_projection())
+    if not book:
+        return None, None, 0, {}
+    hold, similar = await asyncio.gather(
+        reads.collection(Hold).find_one(Hold._active_filter(user_id, book["_id"])) if user_id else _none(),
+        reads.catalogue(SimilarBooks).find_one({"_id": book["_id"]}, SimilarBooks.FIELDS),
+    )
+    position = 0
+    if hold and hold.get("status") == "waiting":
+        position = 1 + await reads.collection(Hold).count_documents(Hold._ahead_filter(hold))
+    return book, hold, position, similar or {}
+
+
+async def book_detail(title):
+    user_id = current_user.id if _wants_hold() else None
+    book, hold, position, similar = await reads.run(_detail(title, user_id))
+    if not book:
+        abort(404)
+    etag = _detail_etag(book, hold, position, similar)
+    not_modified = _not_modified(etag, book.get("updated_at"))
+    if not_modified:
+        return not_modified
+    return _render_detail(BookView(book), hold, position, similar, etag)
+
+
+async def _search(q, page, per_page):
+    pipeline, match = Book._search_pipeline(q, page=page, per_page=per_page)
+    coll = reads.catalogue(Book)
+    return await asyncio.gather(_aggregate(coll, pipeline), coll.count_documents(match))
+
+
+async def book_search():
+    q = (request.args.get("q") or "").strip()
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = current_app.config["BOOKS_PAGE_SIZE"]
+    books, total = await reads.run(_search(q, page, per_page)) if q else ([], 0)
+    return _render_search(q, page, per_page, books, total)
+
+
+async def _loans(user_id, page, per_page):
+    docs, summary = await asyncio.gather(
+        _to_list(LoanView.page_cursor(reads.collection(Loan), user_id, page=page, per_page=per_page)),
+        reads.collection(LoanSummary).find_one({"_id": user_id}),
+    )
+    book_docs = await _to_list(LoanView.books_cursor(reads.collection(Book), docs)) if docs else []
+    return LoanView.join(docs, book_docs), summary
+
+
+@login_required
+async def loans_list():
+    if getattr(current_user, "is_admin", False):
+        abort(403)
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = current_app.config["LOANS_PAGE_SIZE"]
+    loans, summary = await reads.run(_loans(current_user.id, page, per_page))
+    return _render_loans(loans, LoanSummary.from_doc(summary, current_user.id), page, per_page)
+
+
+ASYNC_VIEWS = {
+    "books.book_titles": book_titles,
+    "books.book_detail": book_detail,
+    "books.book_search": book_search,
+    "books.loans_list": loans_list,
+}
+
+
+def install(app) -> None:
+    """Serve the read endpoints above from their async variants."""
+    app.view_functions.update(ASYNC_VIEWS)
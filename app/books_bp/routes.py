@@ -1,45 +1,337 @@
-from flask import render_template, request, redirect, url_for, abort, flash
+from flask import (
+    render_template, request, redirect, url_for, abort, flash, current_app, jsonify, session,
+    make_response, send_file, g, Response, stream_with_context,
+)
+from markupsafe import Markup
+from werkzeug.http import is_resource_modified
+from bson import ObjectId
+from bson.errors import InvalidId
+import hashlib
+import json
+import time
+from urllib.parse import urlsplit
 from . import bp
-from ..model import Book, Loan 
+from ..cache import TTLCache
+from ..covers import SIZES as COVER_SIZES, placeholder_svg
+from ..events import availability
+from ..model import Book, Branch, Hold, Loan, LoanRollup, LoanSummary, Notification, SimilarBooks, User
+from .. import recommend
+from ..readmodel import BookView, LoanView
 from flask_login import login_required, current_user
 from mongoengine.errors import NotUniqueError, ValidationError
 from datetime import date, timedelta
 
+# Rendered card.html fragments keyed by book version; see render_card().
+card_cache = TTLCache(ttl=3600, maxsize=5000)
+
+def _etag_for(*parts) -> str:
+    # Every page renders the nav loan badge, so its count is part of the tag.
+    user = current_user.get_id() if current_user.is_authenticated else "anon"
+    raw = ":".join(str(p) for p in (*parts, user, _active_loan_count()))
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+def _cache_headers(resp, etag, last_modified=None):
+    resp.set_etag(etag)
+    if last_modified:
+        resp.last_modified = last_modified
+    resp.cache_control.no_cache = True
+    if current_user.is_authenticated:
+        resp.cache_control.private = True
+    else:
+        resp.cache_control.public = True
+    resp.vary.add("Cookie")
+    return resp
+
+def _not_modified(etag, last_modified=None):
+    """A 304 response if the client's copy is current, else None."""
+    # Pending flash messages must be rendered, so never short-circuit them.
+    if session.get("_flashes"):
+        return None
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return _cache_headers(current_app.response_class(status=304), etag, last_modified)
+
+def _next_or(default: str) -> str:
+    """The request's 'next' if it is a path on this site, else 'default'."""
+    target = request.values.get("next") or ""
+    parts = urlsplit(target.replace("\\", "/"))
+    if target.startswith("/") and not parts.scheme and not parts.netloc:
+        return target
+    return default
+
+@bp.app_template_global()
+def render_card(b):
+    """card.html for row 'b', reused while the book's version is unchanged."""
+    if not current_app.config["CARD_FRAGMENT_CACHE"]:
+        return Markup(render_template("card.html", b=b))
+    key = (b.id, b.version, request.path)
+    return card_cache.get_or_set(key, lambda: Markup(render_template("card.html", b=b)))
+
+def _active_loan_count() -> int:
+    """The nav badge's count of the user's active loans, read once per request."""
+    if not current_user.is_authenticated or getattr(current_user, "is_admin", False):
+        return 0
+    if "_active_loans" not in g:
+        g._active_loans = LoanSummary.for_user(current_user).active_count
+    return g._active_loans
+
+@bp.app_context_processor
+def _loan_badge():
+    return {"active_loan_count": _active_loan_count}
+
 @bp.route("/")
 def home():
     return redirect(url_for("books.book_titles"))
 
 @bp.route("/books")
 def book_titles():
+    generation, changed_at = Book.generation()
+    etag = _etag_for("titles", generation, request.query_string.decode())
+    not_modified = _not_modified(etag, changed_at)
+    if not_modified:
+        return not_modified
+
+    args = _titles_args()
+    page = Book.page_by_title(
+        category=args["category"], genre=args["genre"],
+        after=args["after"], before=args["before"], limit=args["limit"],
+    )
+    count_query = _titles_count_query(args)
+    genre_total = Book._reads().count_documents(count_query) if count_query else None
+    return _render_titles(args, page, Book.facet_counts("category"), Book.facet_counts("genres"),
+                          genre_total, etag, changed_at)
+
+def _titles_args():
+    """Query-string options of the catalogue page."""
+    page_size = current_app.config["BOOKS_PAGE_SIZE"]
+    per_page = request.args.get("per_page", type=int)
+    if per_page:
+        page_size = max(1, min(per_page, current_app.config["BOOKS_MAX_PAGE_SIZE"]))
     selected = request.args.get("category", "All")
-
-    qs = Book.objects
-    if selected != "All":
-        qs = qs.filter(category=selected)
-
-    books = list(qs.order_by("+title"))
-    categories = ["All"] + sorted({b.category for b in Book.objects.only("category")})
-
-    return render_template(
+    return {
+        "selected": selected,
+        "category": None if selected == "All" else selected,
+        "genre": request.args.get("genre") or None,
+        "after": request.args.get("after") or None,
+        "before": request.args.get("before") or None,
+        "per_page": per_page,
+        "limit": page_size,
+    }
+
+def _titles_count_query(args):
+    """Filter to count when a genre is selected; category totals come from the facets."""
+    if not args["genre"]:
+        return None
+    query = {"genres": args["genre"]}
+    if args["category"]:
+        query["category"] = args["category"]
+    return query
+
+def _render_titles(args, page, category_counts, genre_counts, genre_total, etag, changed_at):
+    rows, prev_cursor, next_cursor = page
+    category = args["category"]
+    if genre_total is not None:
+        total = genre_total
+    elif category:
+        total = category_counts.get(category, 0)
+    else:
+        total = sum(category_counts.values())
+    categories = ["All"] + list(category_counts)
+
+    resp = make_response(render_template(
         "list.html",
-        books=books,
+        books=BookView.wrap(rows),
+        total=total,
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor,
+        per_page=args["per_page"],
         categories=categories,
-        selected=selected,
+        category_counts=category_counts,
+        genre_counts=genre_counts,
+        selected=args["selected"],
+        selected_genre=args["genre"],
         active_page="books",
         current_year=2025,
+    ))
+    return _cache_headers(resp, etag, changed_at)
+
+def _wants_json() -> bool:
+    if request.args.get("format") == "json":
+        return True
+    best = request.accept_mimetypes.best_match(["text/html", "application/json"])
+    return best == "application/json"
+
+@bp.route("/books/search")
+def book_search():
+    q = (request.args.get("q") or "").strip()
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = current_app.config["BOOKS_PAGE_SIZE"]
+
+    books, total = Book.search(q, page=page, per_page=per_page) if q else ([], 0)
+    return _render_search(q, page, per_page, books, total)
+
+def _render_search(q, page, per_page, books, total):
+    if _wants_json():
+        return jsonify(
+            q=q,
+            page=page,
+            total=total,
+            results=[
+                {
+                    "title": b["title"],
+                    "authors": b.get("authors", []),
+                    "category": b.get("category"),
+                    "genres": b.get("genres", []),
+                    "available": b.get("available"),
+                    "url": b.get("url"),
+                    "score": b.get("score"),
+                }
+                for b in books
+            ],
+        )
+
+    return render_template(
+        "search.html",
+        books=BookView.wrap(books),
+        q=q,
+        page=page,
+        total=total,
+        has_prev=page > 1,
+        has_next=page * per_page < total,
+        active_page="books",
     )
 
+@bp.route("/books/suggest")
+def book_suggest():
+    prefix = (request.args.get("q") or "").strip()
+    limit = min(request.args.get("limit", 10, type=int), 50)
+    return jsonify(q=prefix, titles=Book.suggest(prefix, limit=max(limit, 1)))
+
 @bp.route("/book/<path:title>")
 def book_detail(title):
-    book = Book.objects(title=title).first()
+    stamp = Book._reads().find_one({"title": title}, {"version": 1, "updated_at": 1})
+    if not stamp:
+        abort(404)
+    hold, position = None, 0
+    if _wants_hold():
+        hold = Hold.active_for(current_user, stamp["_id"])
+        position = Hold.position(hold) if hold else 0
+    similar = SimilarBooks.for_book(stamp["_id"]) or {}
+    etag = _detail_etag(stamp, hold, position, similar)
+    not_modified = _not_modified(etag, stamp.get("updated_at"))
+    if not_modified:
+        return not_modified
+
+    book = BookView.by_id(stamp["_id"])
     if not book:
         abort(404)
-    
-    return render_template(
+    return _render_detail(book, hold, position, similar, etag)
+
+def _wants_hold():
+    return current_user.is_authenticated and not getattr(current_user, "is_admin", False)
+
+def _detail_etag(stamp, hold, position, similar):
+    return _etag_for("book", stamp["_id"], stamp.get("version", 0),
+                     hold and hold["status"], position, similar.get("updated_at"),
+                     getattr(current_user, "home_branch", None))
+
+def _branch_rows(book):
+    """book's holdings as template rows, nearest-first from the user's home branch."""
+    home = getattr(current_user, "home_branch", None)
+    rank = {code: i for i, code in enumerate(Branch.ranked(home))}
+    names = Branch.names()
+    rows = [{**h, "name": names.get(h["branch"], h["branch"]), "home": h["branch"] == home}
+            for h in book.holdings]
+    return sorted(rows, key=lambda r: rank.get(r["branch"], len(rank)))
+
+def _render_detail(book, hold, position, similar, etag):
+    resp = make_response(render_template(
         "detail.html",
         b=book,
+        branches=_branch_rows(book),
+        hold=hold,
+        position=position,
+        similar=similar.get("items", []),
         active_page="books",
         current_year=2025,
+    ))
+    return _cache_headers(resp, etag, book.updated_at)
+
+@bp.route("/events/availability")
+def availability_events():
+    """
+    Server-Sent Events with availability changes for ?id=<book id>&id=...
+    Sends a snapshot first, then one 'availability' event per change, heartbeats
+    in between, and closes after SSE_MAX_SECONDS so the browser reconnects.
+    """
+    cfg = current_app.config
+    if cfg["AVAILABILITY_EVENTS"] == "off":
+        abort(404)
+    ids = []
+    for raw in request.args.getlist("id")[: cfg["SSE_MAX_TOPICS"]]:
+        try:
+            ids.append(ObjectId(raw))
+        except InvalidId:
+            abort(400)
+    if not ids:
+        abort(400)
+
+    availability.ensure_watcher(Book._get_collection())
+    sub = availability.subscribe(str(i) for i in ids)
+    snapshot = [
+        {"id": str(d["_id"]), "available": d.get("available"), "copies": d.get("copies")}
+        for d in Book._reads().find({"_id": {"$in": ids}}, {"available": 1, "copies": 1})
+    ]
+    heartbeat, deadline = cfg["SSE_HEARTBEAT"], time.monotonic() + cfg["SSE_MAX_SECONDS"]
+
+    def event(payload):
+        return f"event: availability\ndata: {json.dumps(payload)}\n\n"
+
+    def stream():
+        try:
+            yield "retry: 5000\n\n"
+            for payload in snapshot:
+                yield event(payload)
+            while time.monotonic() < deadline and not sub.overflowed:
+                payload = sub.get(timeout=heartbeat)
+                yield event(payload) if payload else ": keepalive\n\n"
+        finally:
+            sub.close()
+
+    resp = Response(stream_with_context(stream()), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+# book id -> source cover URL, so cached covers are served without a query.
+cover_urls = TTLCache(ttl=3600, maxsize=20000)
+
+@bp.route("/covers/<book_id>/<size>")
+def cover(book_id, size):
+    if size not in COVER_SIZES:
+        abort(404)
+
+    def lookup():
+        try:
+            doc = Book._get_collection().find_one({"_id": ObjectId(book_id)}, {"url": 1})
+        except InvalidId:
+            return None
+        return doc["url"] if doc else None
+
+    url = cover_urls.get_or_set(book_id, lookup)
+    if not url:
+        abort(404)
+
+    covers = current_app.extensions["covers"]
+    path = covers.get(url, size)
+    if not path:
+        # Still fetching (or the origin failed): a placeholder the browser won't
+        # keep, so the next page view picks up the thumbnail.
+        resp = current_app.response_class(placeholder_svg(size), mimetype="image/svg+xml")
+        resp.cache_control.no_store = True
+        return resp
+    return send_file(
+        path, mimetype="image/jpeg", max_age=current_app.config["COVER_MAX_AGE"], conditional=True,
     )
 
 @bp.route("/books/new", methods=["GET", "POST"])
@@ -118,7 +410,7 @@ def new_book():
             )
 
         try:
-            Book(
+            book = Book(
                 genres=genres,
                 title=title,
                 category=category,
@@ -129,6 +421,8 @@ def new_book():
                 available=available,
                 copies=copies,
             ).save()
+            Book.catalogue_changed()
+            recommend.queue_add_book(book.id)
             flash("New book added successfully.", "success")
             
             return redirect(url_for("books.new_book"))
@@ -141,6 +435,37 @@ def new_book():
         genres_choices=genres_choices,
     )
 
+@bp.route("/admin/reports")
+@login_required
+def admin_reports():
+    """Circulation dashboard; reads only the loan_rollups collection."""
+    if not getattr(current_user, "is_admin", False):
+        abort(403)
+    days = max(1, min(request.args.get("days", 30, type=int), 366))
+    since = date.today() - timedelta(days=days - 1)
+
+    per_day: dict = {}
+    categories: set = set()
+    totals = {"borrowed": 0, "renewed": 0, "returned": 0}
+    for row in LoanRollup.by_category(since):
+        categories.add(row["key"])
+        per_day.setdefault(row["day"].date(), {})[row["key"]] = row.get("borrowed", 0)
+        for event in totals:
+            totals[event] += row.get(event, 0)
+
+    return render_template(
+        "reports.html",
+        days=days,
+        since=since,
+        top_books=LoanRollup.top_books(since, limit=10),
+        categories=sorted(categories),
+        per_day=sorted(per_day.items()),
+        totals=totals,
+        avg_renewals=totals["renewed"] / totals["borrowed"] if totals["borrowed"] else 0.0,
+        active_page="reports",
+        header_class="bg-success-subtle border-bottom border-success",
+    )
+
 def _rand_date_before_today(min_days=10, max_days=20) -> date:
     return date.today() - timedelta(days=Loan.random_days_between(min_days, max_days))
 
@@ -162,23 +487,116 @@ def make_loan(title):
 
     try:
         borrow_date = _rand_date_before_today(10, 20)
-        Loan.create_for(user=current_user, book=book, borrow_date=borrow_date)
-        flash("Loan created successfully.", "success")
+        loan = Loan.create_for(
+            user=current_user, book=book, borrow_date=borrow_date,
+            limit=current_app.config["BORROW_LIMIT"], branch=request.form.get("branch") or None,
+        )
+        flash(f"Loan created successfully. Collect it at {Branch.names().get(loan.branch, loan.branch)}.",
+              "success")
+    except ValidationError as e:
+        flash(str(e), "warning")
+
+    return redirect(_next_or(url_for("books.book_detail", title=title)))
+
+@bp.route("/branch/home", methods=["POST"])
+@login_required
+def set_home_branch():
+    try:
+        User.set_home_branch(current_user.id, request.form.get("branch") or None)
+        flash("Home branch saved.", "success")
+    except ValidationError as e:
+        flash(str(e), "warning")
+    return redirect(_next_or(url_for("books.book_titles")))
+
+@bp.route("/hold/place/<path:title>", methods=["POST"])
+@login_required
+def place_hold(title):
+    if getattr(current_user, "is_admin", False):
+        abort(403)
+    book = Book.objects(title=title).only("id", "available").first()
+    if not book:
+        abort(404)
+    try:
+        hold = Hold.place(current_user, book)
+        flash(f"Hold placed. You are number {Hold.position(hold)} in the queue.", "success")
     except ValidationError as e:
         flash(str(e), "warning")
+    return redirect(url_for("books.book_detail", title=title))
+
+@bp.route("/hold/<hold_id>/cancel", methods=["POST"])
+@login_required
+def cancel_hold(hold_id):
+    if getattr(current_user, "is_admin", False):
+        abort(403)
+    try:
+        Hold.cancel(current_user, ObjectId(hold_id))
+        flash("Hold cancelled.", "info")
+    except (InvalidId, ValidationError):
+        flash("Hold not found.", "warning")
+    return redirect(_next_or(url_for("books.holds_list")))
 
-    dest = request.args.get("next") or url_for("books.book_detail", title=title)
-    return redirect(dest)
+@bp.route("/holds")
+@login_required
+def holds_list():
+    if getattr(current_user, "is_admin", False):
+        abort(403)
+    holds = Hold.for_user(current_user)
+    titles = {
+        b["_id"]: b["title"]
+        for b in Book._get_collection().find({"_id": {"$in": [h["book"] for h in holds]}}, {"title": 1})
+    }
+    for h in holds:
+        h["title"] = titles.get(h["book"], "")
+        h["position"] = Hold.position(h)
+    return render_template(
+        "holds.html",
+        holds=holds,
+        notifications=Notification.recent(current_user, limit=20),
+        active_page="holds",
+        header_class="bg-success-subtle border-bottom border-success",
+    )
+
+@bp.route("/notifications/poll")
+@login_required
+def notifications_poll():
+    """New notifications after ?after=<id>: one indexed query, 204 when there are none."""
+    try:
+        after = ObjectId(request.args["after"]) if request.args.get("after") else None
+    except InvalidId:
+        abort(400)
+    docs = Notification.recent(current_user, after=after, limit=20)
+    if not docs:
+        return "", 204
+    return jsonify(
+        last=str(docs[0]["_id"]),
+        notifications=[
+            {"id": str(d["_id"]), "kind": d["kind"], "message": d["message"],
+             "created_at": d["created_at"].isoformat() if d.get("created_at") else None}
+            for d in docs
+        ],
+    )
 
 @bp.route("/loans")
 @login_required
 def loans_list():
     if getattr(current_user, "is_admin", False):
         abort(403)
-    loans = Loan.for_user(current_user)
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = current_app.config["LOANS_PAGE_SIZE"]
+    loans = LoanView.for_user(current_user, page=page, per_page=per_page)
+    return _render_loans(loans, LoanSummary.for_user(current_user), page, per_page)
+
+def _render_loans(loans, summary, page, per_page):
+    g._active_loans = summary.active_count
+    total = summary.total_borrowed
     return render_template(
         "loans.html",
         loans=loans,
+        branch_names=Branch.names(),
+        summary=summary,
+        page=page,
+        has_prev=page > 1,
+        has_next=page * per_page < total,
         active_page="loans",
         header_class="bg-success-subtle border-bottom border-success",
     )
@@ -232,3 +650,39 @@ def loan_delete(loan_id):
     except ValidationError as e:
         flash(str(e), "warning")
     return redirect(url_for("books.loans_list"))
+
+
+@bp.route("/loans/batch/<action>", methods=["POST"])
+@login_required
+def loans_batch(action):
+    if getattr(current_user, "is_admin", False):
+        abort(403)
+    payload = request.get_json(silent=True) if request.is_json else None
+    if payload is not None:
+        loan_ids = payload.get("loan_ids") if isinstance(payload, dict) else None
+    else:
+        loan_ids = request.form.getlist("loan_ids")
+    if not isinstance(loan_ids, list) or not loan_ids:
+        if payload is not None:
+            return jsonify(error="loan_ids must be a non-empty list"), 400
+        flash("Select at least one loan.", "warning")
+        return redirect(url_for("books.loans_list"))
+    loan_ids = loan_ids[: current_app.config["LOANS_BATCH_MAX"]]
+
+    if action == "return":
+        results = Loan.bulk_return(current_user, loan_ids, lambda d: _rand_date_after(d, 10, 20))
+    elif action == "renew":
+        results = Loan.bulk_renew(current_user, loan_ids, lambda d: _rand_date_after(d, 10, 20))
+    elif action == "delete":
+        results = Loan.bulk_delete(current_user, loan_ids)
+    else:
+        abort(404)
+
+    if payload is not None:
+        return jsonify(action=action, results=results)
+    ok = sum(1 for r in results.values() if r == "ok")
+    flash(f"{action.capitalize()}: {ok} of {len(results)} loans processed.", "success" if ok else "warning")
+    for loan_id, msg in results.items():
+        if msg != "ok":
+            flash(f"{loan_id}: {msg}", "warning")
+    return redirect(url_for("books.loans_list"))
@@ -0,0 +1,126 @@
+from datetime import date
+
+import click
+from mongoengine import ValidationError
+
+from . import migrations, recommend
+from .importer import import_books, iter_records
+from .model import Book, Branch, Hold, Loan, LoanRollup, LoanSummary
+
+
+def register_commands(app):
+    @app.cli.command("migrate")
+    @click.option("--to", "target", type=int, default=None, help="Stop after this version.")
+    @click.option("--status", is_flag=True, help="Show applied and pending migrations only.")
+    def migrate_command(target, status):
+        """Create indexes, seed and backfill the database up to the latest schema version."""
+        if status:
+            current = migrations.current_version()
+            for m in sorted(migrations.MIGRATIONS, key=lambda m: m.version):
+                mark = "applied" if m.version <= current else "pending"
+                click.echo(f"{m.version:>3}  {mark:<8} {m.description}")
+            return
+        applied = migrations.migrate(target, echo=click.echo)
+        click.echo(f"{applied} migrations applied; schema at version {migrations.current_version()}")
+
+    @app.cli.command("import-books")
+    @click.argument("path", type=click.Path(exists=True, dir_okay=False))
+    @click.option("--batch-size", default=1000, show_default=True,
+                  help="Records per bulk_write round trip.")
+    def import_books_command(path, batch_size):
+        """Upsert books from a JSON Lines or CSV file."""
+        report = import_books(Book._get_collection(), iter_records(path), batch_size=batch_size,
+                              branch=Branch.DEFAULT)
+        Book.catalogue_changed()
+
+        for err in report.errors:
+            click.echo(f"error: {err}", err=True)
+        click.echo(
+            f"{report.total} records in {report.batches} batches: "
+            f"{report.upserted} inserted, {report.modified} updated, {report.invalid} invalid "
+            f"({report.elapsed:.2f}s, {report.rate:.0f} records/s)"
+        )
+
+    @app.cli.command("backfill-titles")
+    def backfill_titles_command():
+        """Populate the normalised title used by /books/suggest."""
+        click.echo(f"{Book.backfill_title_lc()} books updated")
+
+    @app.cli.command("backfill-due-dates")
+    def backfill_due_dates_command():
+        """Persist due_date on loans created before it was stored."""
+        click.echo(f"{Loan.backfill_due_dates()} loans updated")
+
+    @app.cli.command("overdue-sweep")
+    @click.option("--batch-size", default=500, show_default=True)
+    @click.option("--as-of", type=click.DateTime(formats=["%Y-%m-%d"]), default=None,
+                  help="Treat this date as today (YYYY-MM-DD).")
+    @click.option("--verbose", is_flag=True, help="Print every overdue loan.")
+    def overdue_sweep_command(batch_size, as_of, verbose):
+        """Stream overdue loans in batches, e.g. from a nightly cron job."""
+        as_of = as_of.date() if as_of else date.today()
+        total = 0
+        for n, batch in enumerate(Loan.overdue_batches(as_of=as_of, batch_size=batch_size), start=1):
+            total += len(batch)
+            click.echo(f"batch {n}: {len(batch)} overdue loans")
+            if verbose:
+                for doc in batch:
+                    click.echo(f"  loan {doc['_id']} user {doc['user']} book {doc['book']} "
+                               f"due {doc['due_date']:%Y-%m-%d}")
+        click.echo(f"{total} overdue loans as of {as_of:%Y-%m-%d}")
+
+    @app.cli.command("rebuild-loan-summaries")
+    @click.option("--batch-size", default=1000, show_default=True)
+    def rebuild_loan_summaries_command(batch_size):
+        """Recompute every user's LoanSummary from the loans collection."""
+        click.echo(f"{LoanSummary.rebuild(batch_size=batch_size)} loan summaries rebuilt")
+
+    @app.cli.command("rebuild-loan-rollups")
+    @click.option("--batch-size", default=5000, show_default=True, help="Loans aggregated per batch.")
+    def rebuild_loan_rollups_command(batch_size):
+        """Recompute the daily per-book and per-category circulation counters."""
+        click.echo(f"{LoanRollup.rebuild(batch_size=batch_size)} rollup documents written")
+
+    @app.cli.command("hold-sweep")
+    def hold_sweep_command():
+        """Expire uncollected holds and hand shelf copies to waiting holds."""
+        expired = Hold.expire_ready()
+        promoted = Hold.promote_waiting()
+        click.echo(f"{expired} holds expired, {promoted} holds made ready")
+
+    @app.cli.command("rebuild-recommendations")
+    @click.option("--k", default=recommend.TOP_K, show_default=True, help="Similar titles kept per book.")
+    @click.option("--batch-size", default=512, show_default=True, help="Books scored per matrix block.")
+    def rebuild_recommendations_command(k, batch_size):
+        """Recompute every book's similar titles from genres, authors, category and co-loans."""
+        engine = "numpy" if recommend.np is not None else "pure Python"
+        click.echo(f"{recommend.rebuild(k=k, batch_size=batch_size)} books scored ({engine})")
+
+    @app.cli.command("branch-add")
+    @click.argument("code")
+    @click.argument("name")
+    @click.option("--lng", type=float, default=None, help="Longitude, for nearest-branch ranking.")
+    @click.option("--lat", type=float, default=None, help="Latitude, for nearest-branch ranking.")
+    def branch_add_command(code, name, lng, lat):
+        """Add a branch, or rename/move an existing one."""
+        Branch.add(code, name, lng=lng, lat=lat)
+        click.echo(" > ".join(Branch.ranked(code)))
+
+    @app.cli.command("set-copies")
+    @click.argument("title")
+    @click.argument("branch")
+    @click.argument("copies", type=int)
+    def set_copies_command(title, branch, copies):
+        """Set how many copies of TITLE the branch owns."""
+        doc = Book._get_collection().find_one({"title": title}, {"_id": 1})
+        if doc is None:
+            raise click.ClickException(f"No book titled {title!r}.")
+        if branch not in Branch.names():
+            raise click.ClickException(f"Unknown branch {branch!r}; add it with `flask branch-add`.")
+        try:
+            Book.set_branch_copies(doc["_id"], branch, copies)
+        except ValidationError as e:
+            raise click.ClickException(str(e))
+        holdings = Book._get_collection().find_one({"_id": doc["_id"]}, {"holdings": 1})["holdings"]
+        for h in holdings:
+            click.echo(f"{h['branch']:<12}{h['available']:>4} / {h['copies']}")
@@ -0,0 +1,167 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # thumbnails fall back to the original image
+    Image = None
+
+# (width, height) rendered by loans.html, card.html and detail.html.
+SIZES: Dict[str, Tuple[int, int]] = {"thumb": (48, 64), "card": (240, 320), "detail": (320, 430)}
+
+
+def placeholder_svg(size: str) -> str:
+    """Plain box of the thumbnail's size, served while a cover is being fetched."""
+    w, h = SIZES[size]
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{w}" height="{h}" viewBox="0 0 {w} {h}">'
+            f'<rect width="100%" height="100%" fill="#dee2e6"/></svg>')
+
+
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class CoverCache:
+    """
+    Fetches cover images once on a background thread pool and keeps
+    fixed-size JPEG thumbnails in a content-addressed directory:
+
+        refs/<sha256(url)>             -> digest of the original bytes
+        blobs/<digest>.orig            original image
+        blobs/<digest>.<size>.jpg      thumbnail
+
+    Blobs are evicted least-recently-used (by mtime, refreshed on every hit)
+    once their total size exceeds max_bytes.
+    """
+
+    def __init__(self, root: str, max_bytes: int = 256 * 1024 * 1024, workers: int = 4,
+                 timeout: float = 10.0):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self._refs = os.path.join(root, "refs")
+        self._blobs = os.path.join(root, "blobs")
+        os.makedirs(self._refs, exist_ok=True)
+        os.makedirs(self._blobs, exist_ok=True)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="covers")
+        self._inflight: Dict[Tuple[str, str], Future] = {}
+        self._lock = threading.Lock()
+        self._size = sum(e.stat().st_size for e in os.scandir(self._blobs) if e.is_file())
+
+    # paths
+    def _ref_path(self, url: str) -> str:
+        return os.path.join(self._refs, _digest(url.encode()))
+
+    def _blob_path(self, digest: str, suffix: str) -> str:
+        return os.path.join(self._blobs, f"{digest}.{suffix}")
+
+    def cached(self, url: str, size: str) -> Optional[str]:
+        """Path of the thumbnail if it is already on disk (and mark it recently used)."""
+        try:
+            with open(self._ref_path(url)) as fh:
+                digest = fh.read().strip()
+        except FileNotFoundError:
+            return None
+        path = self._blob_path(digest, f"{size}.jpg")
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get(self, url: str, size: str) -> Optional[str]:
+        """
+        Thumbnail path for (url, size). On a miss, starts a background fetch
+        and returns None at once rather than holding the request thread.
+        """
+        path = self.cached(url, size)
+        if path:
+            return path
+        self.submit(url, size)
+        return None
+
+    def submit(self, url: str, size: str) -> Future:
+        key = (url, size)
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._pool.submit(self._build, url, size)
+                self._inflight[key] = future
+                future.add_done_callback(lambda _f: self._forget(key))
+            return future
+
+    def _forget(self, key) -> None:
+        with self._lock:
+            self._inflight.pop(key, None)
+
+    # work done on the pool
+    def _build(self, url: str, size: str) -> str:
+        digest = None
+        try:
+            with open(self._ref_path(url)) as fh:
+                digest = fh.read().strip()
+        except FileNotFoundError:
+            pass
+
+        orig = self._blob_path(digest, "orig") if digest else None
+        if orig and os.path.exists(orig):
+            with open(orig, "rb") as fh:
+                data = fh.read()
+        else:
+            with urllib.request.urlopen(url, timeout=self.timeout) as resp:
+                data = resp.read()
+            digest = _digest(data)
+            self._write(self._blob_path(digest, "orig"), data)
+            self._write(self._ref_path(url), digest.encode(), count=False)
+
+        thumb = self._blob_path(digest, f"{size}.jpg")
+        if not os.path.exists(thumb):
+            self._write(thumb, self._thumbnail(data, SIZES[size]))
+        self._evict()
+        return thumb
+
+    @staticmethod
+    def _thumbnail(data: bytes, box: Tuple[int, int]) -> bytes:
+        if Image is None:
+            return data
+        with Image.open(io.BytesIO(data)) as img:
+            out = ImageOps.fit(img.convert("RGB"), box, Image.LANCZOS)
+        buf = io.BytesIO()
+        out.save(buf, "JPEG", quality=82, optimize=True)
+        return buf.getvalue()
+
+    def _write(self, path: str, data: bytes, count: bool = True) -> None:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+        if count:
+            with self._lock:
+                self._size += len(data)
+
+    def _evict(self) -> None:
+        with self._lock:
+            if self._size <= self.max_bytes:
+                return
+            entries = sorted(
+                (e for e in os.scandir(self._blobs) if e.is_file()),
+                key=lambda e: e.stat().st_mtime,
+            )
+            for entry in entries:
+                if self._size <= self.max_bytes:
+                    break
+                size = entry.stat().st_size
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                self._size -= size
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
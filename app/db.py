@@ -0,0 +1,45 @@
+from typing import Any, Dict
+
+from mongoengine import connect, get_db
+
+# Connection alias for catalogue reads (book lists, detail, search) that may be
+# served by secondaries. Writes and loan/user reads use the default alias.
+CATALOGUE_ALIAS = "catalogue"
+
+# config key -> MongoClient option; None values are left to pymongo's defaults.
+CLIENT_OPTIONS = {
+    "MONGODB_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGODB_MIN_POOL_SIZE": "minPoolSize",
+    "MONGODB_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGODB_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+    "MONGODB_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "MONGODB_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+    "MONGODB_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+    "MONGODB_COMPRESSORS": "compressors",
+    "MONGODB_ZLIB_LEVEL": "zlibCompressionLevel",
+    "MONGODB_APPNAME": "appname",
+}
+
+
+def client_options(config, read_preference: str) -> Dict[str, Any]:
+    options = {opt: config[key] for key, opt in CLIENT_OPTIONS.items() if config.get(key) is not None}
+    options["readPreference"] = read_preference
+    if read_preference != "primary" and config.get("MONGODB_MAX_STALENESS_S") is not None:
+        options["maxStalenessSeconds"] = config["MONGODB_MAX_STALENESS_S"]
+    return options
+
+
+def init_db(app) -> None:
+    """Register the default (primary) and catalogue connections from app.config."""
+    config = app.config
+    connect(host=config["MONGODB_HOST"], **client_options(config, config["MONGODB_READ_PREFERENCE"]))
+    connect(
+        host=config["MONGODB_CATALOGUE_HOST"] or config["MONGODB_HOST"],
+        alias=CATALOGUE_ALIAS,
+        **client_options(config, config["MONGODB_CATALOGUE_READ_PREFERENCE"]),
+    )
+
+
+def catalogue_collection(doc_cls):
+    """doc_cls's collection through the catalogue alias."""
+    return get_db(CATALOGUE_ALIAS)[doc_cls._get_collection_name()]
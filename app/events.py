@@ -0,0 +1,135 @@
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional, Set
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+log = logging.getLogger(__name__)
+
+
+class Subscription:
+    """One SSE client's view of the hub: the keys it follows and a bounded queue."""
+
+    def __init__(self, hub: "Hub", keys: Iterable[str], maxsize: int = 100):
+        self.hub = hub
+        self.keys = frozenset(keys)
+        self.queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def get(self, timeout: float) -> Optional[Dict[str, Any]]:
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self) -> None:
+        self.hub._remove(self)
+
+
+class Hub:
+    """
+    In-process fan-out of availability changes to SSE subscriptions. Events come
+    either from the borrow/return code paths in this process ('local') or from a
+    single change-stream watcher thread ('changestream'), so N connected viewers
+    cost one watcher rather than N polling requests.
+    """
+
+    def __init__(self):
+        self.mode = "local"
+        self._subs: Dict[str, Set[Subscription]] = {}
+        self._lock = threading.Lock()
+        self._watcher: Optional[threading.Thread] = None
+        self._watch_collection = None
+
+    @property
+    def local(self) -> bool:
+        return self.mode == "local"
+
+    def init_app(self, app) -> None:
+        # off | local | changestream. Opt-in: every open page holds a stream,
+        # and each stream holds a server thread for up to SSE_MAX_SECONDS.
+        app.config.setdefault("AVAILABILITY_EVENTS", os.environ.get("AVAILABILITY_EVENTS", "off"))
+        # Worker processes serving the app (gunicorn reads the same variable).
+        app.config.setdefault("WORKERS", int(os.environ.get("WEB_CONCURRENCY", 1)))
+        app.config.setdefault("SSE_HEARTBEAT", 15.0)
+        app.config.setdefault("SSE_MAX_SECONDS", 300.0)
+        app.config.setdefault("SSE_MAX_TOPICS", 100)
+        self.mode = app.config["AVAILABILITY_EVENTS"]
+        if self.mode not in ("off", "local", "changestream"):
+            raise ValueError(f"Unknown AVAILABILITY_EVENTS mode: {self.mode!r}")
+        if self.mode == "local" and app.config["WORKERS"] > 1:
+            # A borrow handled by another worker would never reach this one's streams.
+            raise ValueError("AVAILABILITY_EVENTS='local' needs a single worker; use 'changestream'")
+        app.extensions["availability_hub"] = self
+
+    def subscribe(self, keys: Iterable[str]) -> Subscription:
+        sub = Subscription(self, keys)
+        with self._lock:
+            for key in sub.keys:
+                self._subs.setdefault(key, set()).add(sub)
+        return sub
+
+    def _remove(self, sub: Subscription) -> None:
+        with self._lock:
+            for key in sub.keys:
+                subs = self._subs.get(key)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._subs[key]
+
+    def publish(self, key: str, payload: Dict[str, Any]) -> None:
+        with self._lock:
+            subs = list(self._subs.get(key, ()))
+        for sub in subs:
+            try:
+                sub.queue.put_nowait(payload)
+            except queue.Full:
+                sub.overflowed = True  # a stalled client; its stream reconnects
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len({sub for subs in self._subs.values() for sub in subs})
+
+    def ensure_watcher(self, collection) -> None:
+        """Start the change-stream thread on first use (after any worker fork)."""
+        if self.mode != "changestream" or (self._watcher and self._watcher.is_alive()):
+            return
+        with self._lock:
+            if self._watcher and self._watcher.is_alive():
+                return
+            self._watch_collection = collection
+            self._watcher = threading.Thread(target=self._watch, name="availability-watch", daemon=True)
+            self._watcher.start()
+
+    def _watch(self) -> None:
+        pipeline = [{"$match": {
+            "operationType": "update",
+            "updateDescription.updatedFields.available": {"$exists": True},
+        }}]
+        resume_after, backoff = None, 1.0
+        while True:
+            try:
+                with self._watch_collection.watch(
+                    pipeline, full_document="updateLookup", resume_after=resume_after,
+                ) as stream:
+                    backoff = 1.0
+                    for change in stream:
+                        resume_after = change["_id"]
+                        doc = change.get("fullDocument") or {}
+                        self.publish(str(change["documentKey"]["_id"]), {
+                            "id": str(change["documentKey"]["_id"]),
+                            "available": doc.get("available"),
+                            "copies": doc.get("copies"),
+                        })
+            except PyMongoError as e:
+                if isinstance(e, OperationFailure) and e.code == 286:  # ChangeStreamHistoryLost
+                    resume_after = None
+                log.exception("availability change stream failed; retrying in %.0fs", backoff)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+availability = Hub()
@@ -0,0 +1,168 @@
+import csv
+import json
+import time
+from datetime import datetime, timezone
+from dataclasses import dataclass, field
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+CATEGORIES = ("Children", "Teens", "Adult")
+LIST_FIELDS = ("genres", "description", "authors")
+INT_FIELDS = ("pages", "available", "copies")
+# Separator for list-valued columns in CSV input.
+CSV_LIST_SEP = "|"
+
+
+@dataclass
+class ImportReport:
+    total: int = 0
+    upserted: int = 0
+    modified: int = 0
+    invalid: int = 0
+    batches: int = 0
+    elapsed: float = 0.0
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def rate(self) -> float:
+        return self.total / self.elapsed if self.elapsed else 0.0
+
+
+def normalise_title(title: str) -> str:
+    """Lower-cased, whitespace-collapsed title used for prefix lookups."""
+    return " ".join(title.split()).casefold()
+
+
+def iter_records(path: str) -> Iterator[Dict[str, Any]]:
+    """Stream raw book dicts from a .jsonl/.ndjson or .csv file, one at a time."""
+    if path.lower().endswith(".csv"):
+        with open(path, newline="", encoding="utf-8") as fh:
+            for row in csv.DictReader(fh):
+                for name in LIST_FIELDS:
+                    raw = row.get(name) or ""
+                    row[name] = [p.strip() for p in raw.split(CSV_LIST_SEP) if p.strip()]
+                yield row
+    else:
+        with open(path, encoding="utf-8") as fh:
+            for line in fh:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def _to_int(value) -> Optional[int]:
+    if value is None or value == "":
+        return None
+    return int(value)
+
+
+def clean_record(raw: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Validate a raw dict against the Book rules without building a Document.
+    Returns the normalised field dict; raises ValueError on bad input.
+    """
+    title = (raw.get("title") or "").strip()
+    if not title:
+        raise ValueError("missing title")
+    category = (raw.get("category") or "").strip()
+    if category not in CATEGORIES:
+        raise ValueError(f"{title!r}: invalid category {category!r}")
+    url = (raw.get("url") or "").strip()
+    if not url.startswith(("http://", "https://")):
+        raise ValueError(f"{title!r}: invalid url")
+
+    doc: Dict[str, Any] = {
+        "title": title, "title_lc": normalise_title(title), "category": category, "url": url,
+    }
+    for name in LIST_FIELDS:
+        value = raw.get(name) or []
+        if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+            raise ValueError(f"{title!r}: '{name}' must be a list of strings")
+        doc[name] = value
+    for name in INT_FIELDS:
+        try:
+            doc[name] = _to_int(raw.get(name))
+        except (TypeError, ValueError):
+            raise ValueError(f"{title!r}: '{name}' must be an integer")
+
+    if doc["pages"] is not None and doc["pages"] < 1:
+        raise ValueError(f"{title!r}: 'pages' must be at least 1")
+    for name in ("available", "copies"):
+        if doc[name] is not None and doc[name] < 0:
+            raise ValueError(f"{title!r}: '{name}' cannot be negative")
+    if doc["available"] is not None and doc["copies"] is not None:
+        if doc["available"] > doc["copies"]:
+            raise ValueError(f"{title!r}: 'available' cannot exceed 'copies'")
+    return doc
+
+
+def initial_holdings(branch: str, copies: Optional[int], available: Optional[int]):
+    """
+    (copies, available, holdings) for a title stocked at one branch. Either
+    count may be missing; it then defaults to the other.
+    """
+    if copies is None and available is None:
+        return None, None, []
+    copies = available if copies is None else copies
+    available = copies if available is None else available
+    return copies, available, [{"branch": branch, "copies": copies, "available": available}]
+
+
+def _batched(items: Iterable, size: int) -> Iterator[list]:
+    it = iter(items)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_books(collection, records: Iterable[Dict[str, Any]],
+                 batch_size: int = 1000, branch: str = "main") -> ImportReport:
+    """
+    Upsert book records by title with one unordered bulk_write per batch.
+    Stock counts only apply to new titles, which are shelved at 'branch';
+    existing titles keep their per-branch holdings and copies on loan.
+    Invalid records and per-batch write errors are collected in the report.
+    """
+    report = ImportReport()
+    started = time.perf_counter()
+    for batch_no, chunk in enumerate(_batched(records, batch_size), start=1):
+        ops = []
+        for raw in chunk:
+            report.total += 1
+            try:
+                doc = clean_record(raw)
+            except ValueError as e:
+                report.invalid += 1
+                report.errors.append(f"batch {batch_no}: {e}")
+                continue
+            doc["updated_at"] = datetime.now(timezone.utc)
+            copies, available, holdings = initial_holdings(branch, doc.pop("copies"), doc.pop("available"))
+            ops.append(UpdateOne(
+                {"title": doc["title"]},
+                {"$set": doc, "$inc": {"version": 1},
+                 "$setOnInsert": {"copies": copies, "available": available, "holdings": holdings}},
+                upsert=True,
+            ))
+        if not ops:
+            continue
+
+        report.batches += 1
+        try:
+            result = collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            details = e.details
+            report.upserted += details.get("nUpserted", 0)
+            report.modified += details.get("nModified", 0)
+            for err in details.get("writeErrors", []):
+                report.errors.append(f"batch {batch_no}: {err.get('errmsg')}")
+            continue
+        report.upserted += result.upserted_count
+        report.modified += result.modified_count
+
+    report.elapsed = time.perf_counter() - started
+    return report
@@ -0,0 +1,311 @@
+import contextvars
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Mapping, Optional
+
+from flask import Response, before_render_template, current_app, g, request, template_rendered
+from pymongo import monitoring
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label value, rendered in Prometheus text format."""
+
+    def __init__(self, name: str, help_: str, label: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._counts: Dict[str, List[int]] = {}
+        self._sums: Dict[str, float] = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float) -> None:
+        with self._lock:
+            counts = self._counts.setdefault(label_value, [0] * (len(self.buckets) + 1))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._sums[label_value] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for value, counts in sorted(self._counts.items()):
+                lbl = f'{self.label}="{value}"'
+                running = 0
+                for bound, n in zip(self.buckets, counts):
+                    running += n
+                    lines.append(f'{self.name}_bucket{{{lbl},le="{bound}"}} {running}')
+                running += counts[-1]
+                lines.append(f'{self.name}_bucket{{{lbl},le="+Inf"}} {running}')
+                lines.append(f"{self.name}_sum{{{lbl}}} {self._sums[value]:.6f}")
+                lines.append(f"{self.name}_count{{{lbl}}} {running}")
+        return lines
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_time", "template_time", "sections", "commands", "trace",
+                 "_pending", "_template_depth", "_template_started")
+
+    def __init__(self, trace: bool = False):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.sections: Dict[str, float] = defaultdict(float)
+        # Per-command descriptions for the slow-request log; only kept when 'trace'.
+        self.trace = trace
+        self.commands: List[str] = []
+        self._pending: Dict[int, str] = {}
+        self._template_depth = 0
+        self._template_started = 0.0
+
+
+_current: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar(
+    "request_stats", default=None
+)
+
+
+def describe(command_name: str, command: Mapping) -> str:
+    """
+    "find books {email,status}": the command, its collection and its filter's
+    top-level keys. Values are left out, since they can hold emails or
+    password hashes.
+    """
+    query = command.get("filter", command.get("query"))
+    if query is None and command_name == "aggregate":
+        first = (command.get("pipeline") or [{}])[0]
+        query = first.get("$match")
+    elif query is None and command_name in ("update", "delete"):
+        statements = command.get(command_name + "s") or [{}]
+        query = statements[0].get("q")
+    keys = ",".join(query) if isinstance(query, Mapping) else ""
+    return f"{command_name} {command.get(command_name)} {{{keys}}}"
+
+
+def current_stats() -> Optional[RequestStats]:
+    """Stats of the request being served in this context, if any."""
+    return _current.get()
+
+
+def adopt_stats(stats: Optional[RequestStats]) -> None:
+    """Count commands issued from this context (e.g. a task on another thread) towards 'stats'."""
+    _current.set(stats)
+
+
+class _CommandListener(monitoring.CommandListener):
+    # pymongo calls these synchronously on the thread that issued the command.
+    def started(self, event):
+        stats = _current.get()
+        if stats is not None and stats.trace:
+            stats._pending[event.request_id] = describe(event.command_name, event.command)
+
+    def _finished(self, event):
+        stats = _current.get()
+        if stats is None:
+            return
+        stats.queries += 1
+        stats.db_time += event.duration_micros / 1e6
+        if stats.trace:
+            text = stats._pending.pop(event.request_id, event.command_name)
+            stats.commands.append(f"{event.duration_micros / 1000:.1f}ms {text}")
+
+    def succeeded(self, event):
+        self._finished(event)
+
+    def failed(self, event):
+        self._finished(event)
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Connection pool utilisation across every MongoClient in the process."""
+
+    def __init__(self):
+        self.open = 0
+        self.in_use = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.checkout_wait = Histogram(
+            "sg_db_pool_checkout_seconds", "Time waiting for a pooled connection.", "pool",
+            buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.0))
+        self._lock = threading.Lock()
+
+    def _add(self, name: str, delta: int) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + delta)
+
+    def connection_created(self, event):
+        self._add("open", 1)
+
+    def connection_closed(self, event):
+        self._add("open", -1)
+
+    def connection_checked_out(self, event):
+        self._add("in_use", 1)
+        self._add("checkouts", 1)
+        duration = getattr(event, "duration", None)  # pymongo >= 4.7
+        if duration is not None:
+            self.checkout_wait.observe("%s:%s" % event.address, duration)
+
+    def connection_check_out_failed(self, event):
+        self._add("checkout_failures", 1)
+
+    def connection_checked_in(self, event):
+        self._add("in_use", -1)
+
+    # Events pymongo requires handlers for but that don't affect the counts.
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+
+_listener_registered = False
+
+
+@contextmanager
+def section(name: str):
+    """Time a block (e.g. password hashing) into the current request's stats."""
+    stats = _current.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.sections[name] += time.perf_counter() - started
+
+
+class Instrumentation:
+    """
+    Per-request query count, DB time, template time and named sections,
+    aggregated into per-endpoint histograms and served at /metrics.
+    Observers added with add_observer() receive (endpoint, duration, stats)
+    after every request.
+    """
+
+    def __init__(self):
+        self.request_duration = Histogram(
+            "sg_request_duration_seconds", "Request wall time.", "endpoint")
+        self.db_duration = Histogram(
+            "sg_db_duration_seconds", "MongoDB time per request.", "endpoint")
+        self.template_duration = Histogram(
+            "sg_template_duration_seconds", "Jinja render time per request.", "endpoint")
+        self.queries = Histogram(
+            "sg_db_queries", "MongoDB commands per request.", "endpoint",
+            buckets=(1, 2, 3, 5, 10, 20, 50, 100))
+        self.section_duration = Histogram(
+            "sg_section_duration_seconds", "Time in named sections per request.", "section")
+        self.pool = PoolStats()
+        self.gauges: Dict[str, Callable[[], float]] = {
+            "sg_db_pool_open": lambda: self.pool.open,
+            "sg_db_pool_in_use": lambda: self.pool.in_use,
+            "sg_db_pool_checkouts": lambda: self.pool.checkouts,
+            "sg_db_pool_checkout_failures": lambda: self.pool.checkout_failures,
+        }
+        self.observers: List[Callable] = []
+
+    def add_observer(self, fn: Callable) -> None:
+        self.observers.append(fn)
+
+    def add_gauge(self, name: str, fn: Callable[[], float]) -> None:
+        self.gauges[name] = fn
+
+    def init_app(self, app) -> None:
+        """Must run before the MongoDB client is created so the listener sees its commands."""
+        global _listener_registered
+        app.config.setdefault("METRICS_ENABLED", True)
+        app.config.setdefault("SLOW_REQUEST_MS", None)
+        if not app.config["METRICS_ENABLED"]:
+            return
+        if not _listener_registered:
+            monitoring.register(_CommandListener())
+            monitoring.register(self.pool)
+            _listener_registered = True
+        max_pool = app.config.get("MONGODB_MAX_POOL_SIZE")
+        if max_pool:
+            self.add_gauge("sg_db_pool_max_size", lambda: max_pool)
+
+        app.before_request(self._before)
+        app.teardown_request(self._teardown)
+        before_render_template.connect(self._template_started, app)
+        template_rendered.connect(self._template_finished, app)
+        app.add_url_rule("/metrics", "metrics", self.metrics_view)
+        app.extensions["instrumentation"] = self
+
+    def _before(self):
+        trace = current_app.config["SLOW_REQUEST_MS"] is not None
+        g._stats_token = _current.set(RequestStats(trace=trace))
+        g._stats_started = time.perf_counter()
+
+    def _template_started(self, sender, **extra):
+        stats = _current.get()
+        if stats is not None:
+            if stats._template_depth == 0:
+                stats._template_started = time.perf_counter()
+            stats._template_depth += 1
+
+    def _template_finished(self, sender, **extra):
+        stats = _current.get()
+        if stats is not None and stats._template_depth:
+            stats._template_depth -= 1
+            if stats._template_depth == 0:
+                stats.template_time += time.perf_counter() - stats._template_started
+
+    def _teardown(self, exc=None):
+        token = g.pop("_stats_token", None)
+        if token is None:
+            return
+        stats = _current.get()
+        _current.reset(token)
+        duration = time.perf_counter() - g.pop("_stats_started")
+        endpoint = request.endpoint or "unknown"
+        if endpoint == "metrics":
+            return
+
+        self.request_duration.observe(endpoint, duration)
+        self.db_duration.observe(endpoint, stats.db_time)
+        self.template_duration.observe(endpoint, stats.template_time)
+        self.queries.observe(endpoint, stats.queries)
+        for name, seconds in stats.sections.items():
+            self.section_duration.observe(name, seconds)
+        for fn in self.observers:
+            fn(endpoint, duration, stats)
+
+        slow_ms = current_app.config["SLOW_REQUEST_MS"]
+        if slow_ms is not None and duration * 1000 >= slow_ms:
+            current_app.logger.warning(
+                "slow request %s %s: %.1fms (db %.1fms in %d queries, templates %.1fms)\n  %s",
+                request.method, request.full_path.rstrip("?"), duration * 1000, stats.db_time * 1000,
+                stats.queries, stats.template_time * 1000, "\n  ".join(stats.commands),
+            )
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for hist in (self.request_duration, self.db_duration, self.template_duration,
+                     self.queries, self.section_duration, self.pool.checkout_wait):
+            lines += hist.render()
+        for name, fn in sorted(self.gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {fn()}")
+        return "\n".join(lines) + "\n"
+
+    def metrics_view(self):
+        return Response(self.render(), mimetype="text/plain; version=0.0.4")
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,136 @@
+import time
+from typing import Callable, List, NamedTuple, Optional
+
+from . import recommend
+from .model import (
+    Book, Branch, Counter, Hold, Loan, LoanRollup, LoanSummary, Notification, User,
+    seed_books_if_empty, seed_users_if_missing,
+)
+
+# Counter holding the highest migration version applied to this database.
+SCHEMA = "schema"
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    run: Callable[[], object]
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int, description: str):
+    def register(fn):
+        MIGRATIONS.append(Migration(version, description, fn))
+        return fn
+    return register
+
+
+# Every step is idempotent, so a migration interrupted before its version was
+# recorded (or run concurrently from two deploy hosts) is safe to repeat.
+
+@migration(1, "create indexes")
+def _create_indexes():
+    for doc in (Book, User, Loan):
+        doc.ensure_indexes()
+
+
+@migration(2, "seed the catalogue if it is empty")
+def _seed_books():
+    seed_books_if_empty()
+
+
+@migration(3, "seed the default admin and user accounts")
+def _seed_users():
+    seed_users_if_missing()
+
+
+@migration(4, "backfill normalised titles")
+def _backfill_titles():
+    return Book.backfill_title_lc()
+
+
+@migration(5, "backfill loan due dates")
+def _backfill_due_dates():
+    return Loan.backfill_due_dates()
+
+
+@migration(6, "rebuild loan summaries")
+def _rebuild_loan_summaries():
+    return LoanSummary.rebuild()
+
+
+@migration(7, "create hold and notification indexes")
+def _create_hold_indexes():
+    for doc in (Hold, Notification):
+        doc.ensure_indexes()
+
+
+@migration(8, "precompute similar books")
+def _similar_books():
+    return recommend.rebuild()
+
+
+@migration(9, "build loan rollups")
+def _loan_rollups():
+    LoanRollup.ensure_indexes()
+    return LoanRollup.rebuild()
+
+
+@migration(10, "create branches and per-branch holdings")
+def _branches():
+    Branch.ensure_indexes()
+    Branch.ensure_default()
+    return Book.backfill_holdings() + Loan.backfill_branch()
+
+
+@migration(11, "extend the overdue loans index with _id")
+def _overdue_index():
+    # The sweep sorts on (due_date, _id); without _id in the index that sort
+    # ran in memory over every overdue loan.
+    Loan.ensure_indexes()
+    loans = Loan._get_collection()
+    if "return_date_1_due_date_1" in loans.index_information():
+        loans.drop_index("return_date_1_due_date_1")
+
+
+@migration(12, "index book authors")
+def _authors_index():
+    # recommend.add_book() finds a new title's neighbours by genre, author or category.
+    Book.ensure_indexes()
+
+
+@migration(13, "drop leftover batch tokens")
+def _batch_tokens():
+    # Batches used to leave their tokens on loans and holdings for good.
+    return Loan.clear_batch_tokens()
+
+
+def current_version() -> int:
+    return Counter.current(SCHEMA)[0]
+
+
+def latest_version() -> int:
+    return max(m.version for m in MIGRATIONS)
+
+
+def pending(target: Optional[int] = None) -> List[Migration]:
+    done = current_version()
+    target = latest_version() if target is None else target
+    return sorted((m for m in MIGRATIONS if done < m.version <= target), key=lambda m: m.version)
+
+
+def migrate(target: Optional[int] = None, echo: Callable[[str], None] = lambda _msg: None) -> int:
+    """
+    Apply pending migrations in order, recording each version as it completes.
+    Costs a single read when the database is already up to date. Returns the
+    number of migrations applied.
+    """
+    steps = pending(target)
+    for m in steps:
+        started = time.perf_counter()
+        m.run()
+        Counter.raise_to(SCHEMA, m.version)
+        echo(f"{m.version:>3}  {m.description} ({time.perf_counter() - started:.2f}s)")
+    return len(steps)
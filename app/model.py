@@ -1,16 +1,131 @@
 from mongoengine import (
     Document, StringField, IntField, ListField, URLField, BooleanField, EmailField
 )
-from mongoengine import ValidationError
+from mongoengine import ValidationError, signals
+from bson import ObjectId
+from bson.errors import InvalidId
 from werkzeug.security import generate_password_hash, check_password_hash
-from typing import Dict, Any, Iterable
-from books import all_books 
-from mongoengine import DateField, ReferenceField, CASCADE
-from datetime import date, timedelta
+from typing import Dict, Any, Iterable, List, Optional, Tuple
+from mongoengine import (
+    DateField, DateTimeField, DictField, FloatField, ObjectIdField, PointField, ReferenceField, CASCADE,
+)
+from datetime import date, datetime, timedelta, timezone
+from pymongo import DeleteOne, ReturnDocument, UpdateOne
 import random 
+from .cache import TTLCache
+from .db import catalogue_collection
+from .events import availability
+from .importer import import_books, initial_holdings, normalise_title
+from .metrics import section
+
+# Filter-bar facets change only when the catalogue does; see Book.invalidate_facets().
+facet_cache = TTLCache(ttl=300)
+# Session principals for Flask-Login's user_loader; see User.load_principal().
+user_cache = TTLCache(ttl=300, maxsize=10000)
+# Branch names and nearest-first rankings; branches change only through the CLI.
+branch_cache = TTLCache(ttl=300)
+
+class Counter(Document):
+    """Named monotonic counters, e.g. the catalogue generation used for ETags."""
+    meta = {"collection": "counters", "strict": False, "auto_create_index": False}
+    name       = StringField(primary_key=True)
+    value      = IntField(default=0)
+    updated_at = DateTimeField()
+
+    @classmethod
+    def bump(cls, name: str) -> None:
+        cls._get_collection().update_one(
+            {"_id": name},
+            {"$inc": {"value": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+
+    @classmethod
+    def current(cls, name: str, collection=None):
+        """(value, updated_at) for 'name'; (0, None) if it was never bumped."""
+        doc = (collection or cls._get_collection()).find_one({"_id": name})
+        if doc is None:
+            return 0, None
+        return doc.get("value", 0), doc.get("updated_at")
+
+    @classmethod
+    def raise_to(cls, name: str, value: int) -> None:
+        """Set 'name' to at least 'value' (never lowers it)."""
+        cls._get_collection().update_one(
+            {"_id": name},
+            {"$max": {"value": value}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+
+class Branch(Document):
+    """
+    A library branch. Each title's copies per branch live in Book.holdings;
+    the location's 2dsphere index ranks branches by distance (see ranked()).
+    """
+    meta = {"collection": "branches", "strict": False, "auto_create_index": False}
+    code     = StringField(primary_key=True)
+    name     = StringField(required=True)
+    location = PointField()
+
+    # Branch for titles and loans that predate branches, and for new stock
+    # without one. Set from DEFAULT_BRANCH in create_app.
+    DEFAULT = "main"
+
+    @classmethod
+    def add(cls, code: str, name: str, lng: Optional[float] = None, lat: Optional[float] = None) -> None:
+        doc: Dict[str, Any] = {"name": name}
+        if lng is not None and lat is not None:
+            doc["location"] = {"type": "Point", "coordinates": [lng, lat]}
+        cls._get_collection().update_one({"_id": code}, {"$set": doc}, upsert=True)
+        branch_cache.clear()
+
+    @classmethod
+    def ensure_default(cls) -> None:
+        cls._get_collection().update_one(
+            {"_id": cls.DEFAULT}, {"$setOnInsert": {"name": "Main Library"}}, upsert=True)
+        branch_cache.clear()
+
+    @classmethod
+    def names(cls) -> Dict[str, str]:
+        """{code: name} for every branch."""
+        return branch_cache.get_or_set("names", lambda: {
+            d["_id"]: d.get("name", d["_id"]) for d in cls._get_collection().find({}, {"name": 1})
+        })
+
+    @classmethod
+    def ranked(cls, home: Optional[str] = None) -> List[str]:
+        """
+        Branch codes nearest-first from 'home' by a $near query on the location
+        index; branches without a location (or no home) follow in code order.
+        """
+        return branch_cache.get_or_set(("ranked", home), lambda: cls._ranked(home))
+
+    @classmethod
+    def _ranked(cls, home: Optional[str]) -> List[str]:
+        coll = cls._get_collection()
+        origin = coll.find_one({"_id": home}, {"location": 1}) if home else None
+        near = []
+        if origin and origin.get("location"):
+            near = [d["_id"] for d in coll.find(
+                {"location": {"$near": {"$geometry": origin["location"]}}}, {"_id": 1})]
+        rest = [d["_id"] for d in coll.find({"_id": {"$nin": near}}, {"_id": 1}).sort("_id", 1)]
+        return near + rest
 
 class Book(Document):
-    meta = {"collection": "books", "indexes": ["title", "category"], "strict": False}
+    meta = {
+        "collection": "books",
+        "indexes": [
+            "title", "category", ("category", "title"), ("genres", "title"), "title_lc", "authors",
+            {
+                "fields": ["$title", "$authors", "$genres", "$description"],
+                "default_language": "english",
+                "weights": {"title": 10, "authors": 5, "genres": 3, "description": 1},
+            },
+        ],
+        "strict": False,
+        # Created by `flask migrate`, not on first use in every worker.
+        "auto_create_index": False,
+    }
     genres      = ListField(StringField(), default=list)
     title       = StringField(required=True, unique=True)
     category    = StringField(required=True, choices=("Children", "Teens", "Adult"))
@@ -18,13 +133,34 @@ class Book(Document):
     description = ListField(StringField(), default=list)
     authors     = ListField(StringField(), default=list)
     pages       = IntField(min_value=1)
+    # Totals over 'holdings', moved by the same atomic update as the branch counts.
     available   = IntField(min_value=0)
     copies      = IntField(min_value=0)
+    # [{"branch": code, "copies": n, "available": m}]; see take_copy()/credit_copy().
+    holdings    = ListField(DictField(), default=list)
+    # Normalised title for indexed prefix search; maintained by clean().
+    title_lc    = StringField()
+    # Bumped on every change to the document; used for ETags and fragment caching.
+    version     = IntField(default=0)
+    updated_at  = DateTimeField()
+
+    # Counter name for the catalogue-wide generation; see catalogue_changed().
+    GENERATION = "catalogue"
 
     def clean(self):
+        self.version = (self.version or 0) + 1
+        self.updated_at = datetime.now(timezone.utc)
+        if self.title:
+            self.title_lc = normalise_title(self.title)
         if self.available is not None and self.copies is not None:
             if self.available > self.copies:
                 raise ValidationError("'available' cannot exceed 'copies'.")
+        if self.holdings:
+            self.copies = sum(h.get("copies") or 0 for h in self.holdings)
+            self.available = sum(h.get("available") or 0 for h in self.holdings)
+        else:
+            self.copies, self.available, self.holdings = initial_holdings(
+                Branch.DEFAULT, self.copies, self.available)
 
     @classmethod
     def from_dict(cls, d: Dict[str, Any]):
@@ -41,19 +177,201 @@ class Book(Document):
         )
 
     @classmethod
-    def seed_many(cls, items: Iterable[Dict[str, Any]]) -> int:
+    def seed_many(cls, items: Iterable[Dict[str, Any]], batch_size: int = 1000) -> int:
+        """Bulk-upsert book dicts by title; returns the number of valid records."""
+        report = import_books(cls._get_collection(), items, batch_size=batch_size, branch=Branch.DEFAULT)
+        cls.catalogue_changed()
+        return report.total - report.invalid
+
+    FACET_FIELDS = ("category", "genres")
+
+    @classmethod
+    def facet_counts(cls, field: str) -> Dict[str, int]:
+        """
+        {value: number_of_books} for 'category' or 'genres', sorted by value.
+        Computed with a server-side $group and cached in facet_cache.
+        """
+        pipeline = cls._facet_pipeline(field)
+        return facet_cache.get_or_set(
+            field, lambda: cls._facet_result(cls._reads().aggregate(pipeline))
+        )
+
+    @classmethod
+    def _facet_pipeline(cls, field: str) -> list:
+        if field not in cls.FACET_FIELDS:
+            raise ValueError(f"Unknown facet field: {field}")
+        pipeline = []
+        if field == "genres":
+            pipeline.append({"$unwind": "$genres"})
+        pipeline += [
+            {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+            {"$sort": {"_id": 1}},
+        ]
+        return pipeline
+
+    @staticmethod
+    def _facet_result(rows) -> Dict[str, int]:
+        return {row["_id"]: row["count"] for row in rows if row["_id"] is not None}
+
+    @staticmethod
+    def invalidate_facets():
+        facet_cache.clear()
+
+    @classmethod
+    def catalogue_changed(cls):
+        """Call after titles are added or edited: drops facets and moves the generation on."""
+        cls.invalidate_facets()
+        Counter.bump(cls.GENERATION)
+
+    @classmethod
+    def generation(cls):
+        # Read alongside the catalogue so ETags never run ahead of a lagging secondary.
+        return Counter.current(cls.GENERATION, collection=catalogue_collection(Counter))
+
+    @classmethod
+    def _reads(cls):
+        """Collection for catalogue reads, which may be served by secondaries (see app/db.py)."""
+        return catalogue_collection(cls)
+
+    @staticmethod
+    def _touch() -> Dict[str, Any]:
+        return {"$inc": {"version": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}}
+    
+    # Fields rendered by card.html; description is cut down to first/last paragraph.
+    CARD_FIELDS = ("title", "category", "url", "genres", "authors", "pages", "available", "copies", "version")
+
+    @classmethod
+    def _card_projection(cls) -> Dict[str, Any]:
+        desc = {"$ifNull": ["$description", []]}
+        projection = {f: 1 for f in cls.CARD_FIELDS}
+        # Branches with a copy on the shelf, counted in the same pass as the rows.
+        projection["branches_in_stock"] = {"$size": {"$filter": {
+            "input": {"$ifNull": ["$holdings", []]}, "cond": {"$gt": ["$$this.available", 0]},
+        }}}
+        projection["description"] = {
+            "$cond": [
+                {"$gt": [{"$size": desc}, 1]},
+                {"$concatArrays": [{"$slice": [desc, 1]}, {"$slice": [desc, -1]}]},
+                desc,
+            ]
+        }
+        return projection
+
+    @classmethod
+    def page_by_title(cls, *, category: Optional[str] = None, genre: Optional[str] = None,
+                      after: Optional[str] = None, before: Optional[str] = None, limit: int = 20):
+        """
+        One keyset page of card-sized book rows ordered by title.
+        'after'/'before' are title cursors; returns (rows, prev_cursor, next_cursor).
+        """
+        pipeline = cls._title_page_pipeline(
+            category=category, genre=genre, after=after, before=before, limit=limit,
+        )
+        return cls._title_page_result(
+            list(cls._reads().aggregate(pipeline)), after=after, before=before, limit=limit,
+        )
+
+    @classmethod
+    def _title_page_pipeline(cls, *, category, genre, after, before, limit) -> list:
+        match: Dict[str, Any] = {}
+        if category:
+            match["category"] = category
+        if genre:
+            match["genres"] = genre
+        backwards = before is not None
+        if backwards:
+            match["title"] = {"$lt": before}
+        elif after is not None:
+            match["title"] = {"$gt": after}
+
+        return [
+            {"$match": match},
+            {"$sort": {"title": -1 if backwards else 1}},
+            {"$limit": limit + 1},
+            {"$project": cls._card_projection()},
+        ]
+
+    @staticmethod
+    def _title_page_result(rows: list, *, after, before, limit):
+        backwards = before is not None
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+
+        if not rows:
+            return rows, None, None
+        if backwards:
+            prev_cursor = rows[0]["title"] if has_more else None
+            next_cursor = rows[-1]["title"]
+        else:
+            prev_cursor = rows[0]["title"] if after is not None else None
+            next_cursor = rows[-1]["title"] if has_more else None
+        return rows, prev_cursor, next_cursor
+
+    @classmethod
+    def search(cls, q: str, *, page: int = 1, per_page: int = 20):
+        """
+        Full-text search over title, authors, genres and description.
+        Returns card-sized rows (plus 'score') ranked by text score, and the match count.
+        """
+        pipeline, match = cls._search_pipeline(q, page=page, per_page=per_page)
+        coll = cls._reads()
+        return list(coll.aggregate(pipeline)), coll.count_documents(match)
+
+    @classmethod
+    def _search_pipeline(cls, q: str, *, page: int, per_page: int):
+        """(aggregate pipeline, count filter) for search()."""
+        match = {"$text": {"$search": q}}
+        projection = cls._card_projection()
+        projection["score"] = {"$meta": "textScore"}
+        pipeline = [
+            {"$match": match},
+            {"$sort": {"score": {"$meta": "textScore"}, "title": 1}},
+            {"$skip": (max(page, 1) - 1) * per_page},
+            {"$limit": per_page},
+            {"$project": projection},
+        ]
+        return pipeline, match
+
+    @classmethod
+    def suggest(cls, prefix: str, limit: int = 10):
+        """Titles whose normalised form starts with 'prefix', via a range scan on title_lc."""
+        lo = normalise_title(prefix)
+        if not lo:
+            return []
+        cursor = cls._reads().find(
+            {"title_lc": {"$gte": lo, "$lt": lo + "\uffff"}},
+            {"_id": 0, "title": 1},
+        ).sort("title_lc", 1).limit(limit)
+        return [doc["title"] for doc in cursor]
+
+    @classmethod
+    def backfill_title_lc(cls) -> int:
+        """Fill title_lc on documents saved before it existed."""
         count = 0
-        for raw in items:
-            doc = cls.from_dict(raw)
-            cls.objects(title=doc.title).modify(
-                upsert=True, new=True,
-                set__genres=doc.genres, set__category=doc.category, set__url=doc.url,
-                set__description=doc.description, set__authors=doc.authors,
-                set__pages=doc.pages, set__available=doc.available, set__copies=doc.copies,
+        for doc in cls._get_collection().find({"title_lc": {"$exists": False}}, {"title": 1}):
+            cls._get_collection().update_one(
+                {"_id": doc["_id"]}, {"$set": {"title_lc": normalise_title(doc["title"])}}
             )
             count += 1
         return count
-    
+
+    @classmethod
+    def backfill_holdings(cls, batch_size: int = 1000) -> int:
+        """Shelve books saved before branches existed at Branch.DEFAULT."""
+        coll, ops, count = cls._get_collection(), [], 0
+        for doc in coll.find({"holdings": {"$exists": False}}, {"copies": 1, "available": 1}):
+            copies, available, holdings = initial_holdings(Branch.DEFAULT, doc.get("copies"), doc.get("available"))
+            ops.append(UpdateOne({"_id": doc["_id"], "holdings": {"$exists": False}},
+                                 {"$set": {"copies": copies, "available": available, "holdings": holdings}}))
+            if len(ops) >= batch_size:
+                count += coll.bulk_write(ops, ordered=False).modified_count
+                ops = []
+        if ops:
+            count += coll.bulk_write(ops, ordered=False).modified_count
+        return count
+
     def can_borrow(self) -> bool:
         """True if at least one copy can be loaned out."""
         return (self.available or 0) > 0
@@ -64,37 +382,209 @@ class Book(Document):
         c = self.copies or 0
         return a < c
 
-    def borrow_one(self):
+    # Per-branch stock. Every move updates one holdings entry and the book's
+    # totals in a single conditional update, so they never drift apart.
+
+    # Projection of holdings without bookkeeping such as bulk_return's batch tokens.
+    HOLDING_FIELDS = {"holdings.branch": 1, "holdings.copies": 1, "holdings.available": 1}
+
+    @classmethod
+    def _change_available(cls, delta: int) -> Dict[str, Any]:
+        """
+        Update moving 'delta' copies on/off the shelf at the holding matched by
+        the filter's holdings condition (positional '$'), and in the totals.
+        """
+        update = cls._touch()
+        update["$inc"]["available"] = delta
+        update["$inc"]["holdings.$.available"] = delta
+        return update
+
+    @staticmethod
+    def _stocked(branch: Optional[str] = None) -> Dict[str, Any]:
+        """Filter: a holding (at 'branch', if given) with a copy on the shelf."""
+        cond: Dict[str, Any] = {} if branch is None else {"branch": branch}
+        cond["available"] = {"$gt": 0}
+        return {"holdings": {"$elemMatch": cond}}
+
+    @staticmethod
+    def _has_room(branch: str, n: int = 1) -> Dict[str, Any]:
+        """Filter: 'branch' can take back n copies without exceeding its own copies."""
+        holding = {"$arrayElemAt": [{"$filter": {
+            "input": {"$ifNull": ["$holdings", []]}, "cond": {"$eq": ["$$this.branch", branch]},
+        }}, 0]}
+        return {
+            "holdings": {"$elemMatch": {"branch": branch}},
+            "$expr": {"$let": {"vars": {"h": holding},
+                               "in": {"$lte": [{"$add": ["$$h.available", n]}, "$$h.copies"]}}},
+        }
+
+    @classmethod
+    def take_copy(cls, book_id, branch: Optional[str] = None) -> Optional[Tuple[str, Dict[str, Any]]]:
         """
-        Decrease available by 1 if possible.
-        Raises ValidationError if no copies are available.
+        Take one copy off the shelf at 'branch', or at the first branch with
+        stock when None. Returns (branch, {available, copies, version} after),
+        or None if there was nothing to take.
         """
-        if not self.can_borrow():
+        projection = {"available": 1, "copies": 1, "version": 1, "holdings": 1}
+        if branch is not None:
+            doc = cls._get_collection().find_one_and_update(
+                {"_id": book_id, **cls._stocked(branch)},
+                cls._change_available(-1),
+                projection=projection, return_document=ReturnDocument.AFTER,
+            )
+            return (branch, doc) if doc else None
+        # '$' is the first holding with stock, so the pre-image tells us which one moved.
+        before = cls._get_collection().find_one_and_update(
+            {"_id": book_id, **cls._stocked()},
+            cls._change_available(-1),
+            projection=projection,
+        )
+        if before is None:
+            return None
+        taken = next(h["branch"] for h in before["holdings"] if (h.get("available") or 0) > 0)
+        return taken, {**before, "available": before["available"] - 1, "version": before.get("version", 0) + 1}
+
+    @classmethod
+    def credit_copy(cls, book_id, branch: str, n: int = 1) -> Optional[Dict[str, Any]]:
+        """Put n copies back on the shelf at 'branch'; None if that would exceed its copies."""
+        return cls._get_collection().find_one_and_update(
+            {"_id": book_id, **cls._has_room(branch, n)},
+            cls._change_available(n),
+            projection={"available": 1, "copies": 1, "version": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    @classmethod
+    def set_branch_copies(cls, book_id, branch: str, copies: int) -> None:
+        """
+        Set how many copies 'branch' owns. Its shelf count moves by the same
+        amount, so copies out on loan stay out; fails if fewer would remain
+        than are on loan there.
+        """
+        if copies < 0:
+            raise ValidationError("Copies cannot be negative.")
+        coll = cls._get_collection()
+        doc = coll.find_one({"_id": book_id}, {"holdings": 1})
+        if doc is None:
+            raise ValidationError("Book not found.")
+        current = next((h for h in doc.get("holdings") or [] if h["branch"] == branch), None)
+        update = cls._touch()
+        if current is None:
+            query = {"_id": book_id, "holdings.branch": {"$ne": branch}}
+            update["$inc"].update({"copies": copies, "available": copies})
+            update["$push"] = {"holdings": {"branch": branch, "copies": copies, "available": copies}}
+        else:
+            delta = copies - current["copies"]
+            query = {"_id": book_id, "holdings": {"$elemMatch": {
+                "branch": branch, "copies": current["copies"], "available": {"$gte": -delta}}}}
+            update["$inc"].update({"copies": delta, "available": delta,
+                                   "holdings.$.copies": delta, "holdings.$.available": delta})
+        if not coll.update_one(query, update).modified_count:
+            raise ValidationError("Copies are on loan or the holding changed; try again.")
+        cls.catalogue_changed()
+        cls._announce_ids([book_id])
+
+    @staticmethod
+    def _announce(docs: Iterable[Dict[str, Any]]) -> None:
+        """Push new availability to SSE subscribers when events are published in-process."""
+        if not availability.local:
+            return
+        for doc in docs:
+            availability.publish(str(doc["_id"]), {
+                "id": str(doc["_id"]), "available": doc.get("available"), "copies": doc.get("copies"),
+            })
+
+    @classmethod
+    def _announce_ids(cls, book_ids) -> None:
+        if availability.local and book_ids:
+            cls._announce(cls._get_collection().find(
+                {"_id": {"$in": list(book_ids)}}, {"available": 1, "copies": 1}))
+
+    @staticmethod
+    def stocked_branches(holdings: Iterable[Dict[str, Any]], prefer: Iterable[str] = ()) -> List[str]:
+        """Branches in 'holdings' with a copy on the shelf, in 'prefer' order, then the rest."""
+        rank = {b: i for i, b in enumerate(prefer)}
+        stocked = [h["branch"] for h in holdings if (h.get("available") or 0) > 0]
+        return sorted(stocked, key=lambda b: rank.get(b, len(rank)))
+
+    def _take_first(self, holdings, prefer) -> Optional[Tuple[str, Dict[str, Any]]]:
+        for choice in self.stocked_branches(holdings, prefer):
+            taken = self.take_copy(self.id, choice)
+            if taken:
+                return taken
+        return None
+
+    def borrow_one(self, branch: Optional[str] = None, prefer: Iterable[str] = ()) -> str:
+        """
+        Atomically take a copy at 'branch'; without one, at the first branch in
+        'prefer' order that still has one. Returns the branch. Raises
+        ValidationError if no copies are available.
+        """
+        if branch is not None:
+            taken = self.take_copy(self.id, branch)
+        else:
+            # One update when this document is current. Branches emptied since
+            # it was read cost one failed update each; if all of them were, the
+            # holdings are read again and walked in the same order.
+            taken = self._take_first(self.holdings or [], prefer)
+            if taken is None:
+                fresh = self._get_collection().find_one({"_id": self.id}, self.HOLDING_FIELDS) or {}
+                taken = self._take_first(fresh.get("holdings") or [], prefer)
+        if taken is None:
             raise ValidationError("No available copies to borrow.")
-        self.available = (self.available or 0) - 1
-        self.save(validate=True)
+        branch, doc = taken
+        self._data["available"] = doc["available"]
+        self._data["version"] = doc["version"]
+        Counter.bump(self.GENERATION)
+        self._announce([doc])
+        return branch
 
-    def return_one(self):
+    def return_one(self, branch: str):
         """
-        Increase available by 1 if it will not exceed copies.
-        Raises ValidationError if it would exceed total copies.
+        Atomically put a copy back on the shelf at 'branch'.
+        Raises ValidationError if it would exceed that branch's copies.
         """
-        if not self.can_return():
+        doc = self.credit_copy(self.id, branch)
+        if doc is None:
             raise ValidationError("Cannot return: already at maximum available.")
-        self.available = (self.available or 0) + 1
-        self.save(validate=True)
+        self._data["available"] = doc["available"]
+        self._data["version"] = doc["version"]
+        Counter.bump(self.GENERATION)
+        self._announce([doc])
+
+class SimilarBooks(Document):
+    """
+    Precomputed top-k related titles per book, best first, written by
+    app/recommend.py. 'floor' is the lowest kept score (-1 while the list is short).
+    """
+    meta = {"collection": "similar_books", "strict": False, "auto_create_index": False}
+    book        = ObjectIdField(primary_key=True)
+    items       = ListField(DictField(), default=list)
+    floor       = FloatField(default=-1.0)
+    # computed_at marks the last full rebuild; updated_at also moves on incremental pushes.
+    computed_at = DateTimeField()
+    updated_at  = DateTimeField()
+
+    FIELDS = {"items": 1, "updated_at": 1}
+
+    @classmethod
+    def for_book(cls, book_id) -> Optional[Dict[str, Any]]:
+        return catalogue_collection(cls).find_one({"_id": book_id}, cls.FIELDS)
 
 def seed_books_if_empty():
-    if Book.objects.first() is None:
+    if Book._get_collection().find_one({}, {"_id": 1}) is None:
+        from books import all_books  # large literal; only needed on an empty database
         Book.seed_many(all_books)
 
 
 class User(Document):
-    meta = {"collection": "users", "indexes": ["email"], "strict": False}
+    meta = {"collection": "users", "indexes": ["email"], "strict": False, "auto_create_index": False}
     email    = EmailField(required=True, unique=True)
     password = StringField(required=True)  
     name     = StringField(required=True)
     is_admin = BooleanField(default=False)
+    # Loans come from the nearest branch to this one with a copy; see Branch.ranked().
+    home_branch = StringField()
 
     
     @property
@@ -105,31 +595,406 @@ class User(Document):
     def is_anonymous(self): return False
     def get_id(self): return str(self.id)
 
-    @staticmethod
-    def hash_pw(raw): return generate_password_hash(raw)
-    def check_pw(self, raw): return check_password_hash(self.password, raw)
+    # werkzeug method string, e.g. "scrypt:32768:8:1" or "pbkdf2:sha256:600000".
+    # Set from PASSWORD_HASH_METHOD in create_app.
+    HASH_METHOD = "scrypt:32768:8:1"
+    # (HASH_METHOD, the "method:params" prefix werkzeug writes for it); see needs_rehash().
+    _hash_prefix: Tuple[str, str] = ("", "")
+
+    @classmethod
+    def hash_pw(cls, raw):
+        with section("password_hash"):
+            return generate_password_hash(raw, method=cls.HASH_METHOD)
+
+    def check_pw(self, raw):
+        with section("password_hash"):
+            return check_password_hash(self.password, raw)
+
+    @classmethod
+    def current_hash_prefix(cls) -> str:
+        """
+        Prefix of a hash made with HASH_METHOD, which werkzeug expands with its
+        defaults ("scrypt" -> "scrypt:32768:8:1"). Made from one reference hash
+        per process, on first use so workers don't pay for it at boot.
+        """
+        method, prefix = cls._hash_prefix
+        if method != cls.HASH_METHOD:
+            prefix = generate_password_hash("", method=cls.HASH_METHOD).split("$", 1)[0]
+            cls._hash_prefix = (cls.HASH_METHOD, prefix)
+        return prefix
+
+    def needs_rehash(self) -> bool:
+        """True if the stored hash was made with different parameters than HASH_METHOD."""
+        return self.password.split("$", 1)[0] != self.current_hash_prefix()
+
+    def rehash_pw(self, raw):
+        """Re-hash a verified password with the current parameters."""
+        self.password = self.hash_pw(raw)
+        User.objects(id=self.id).update_one(set__password=self.password)
+        self._clear_changed_fields()
+
+    PRINCIPAL_FIELDS = ("email", "name", "is_admin", "home_branch")
+
+    @classmethod
+    def load_principal(cls, user_id: str) -> Optional["User"]:
+        """
+        User for an authenticated session, built from user_cache when possible.
+        Only id/email/name/is_admin are loaded, so the result must not be saved.
+        """
+        fields = user_cache.get(user_id)
+        if fields is None:
+            try:
+                oid = ObjectId(user_id)
+            except (InvalidId, TypeError):
+                return None
+            doc = cls._get_collection().find_one({"_id": oid}, dict.fromkeys(cls.PRINCIPAL_FIELDS, 1))
+            if doc is None:
+                return None
+            fields = {f: doc.get(f) for f in cls.PRINCIPAL_FIELDS}
+            user_cache.set(user_id, fields)
+        return cls(id=ObjectId(user_id), **fields)
+
+    @classmethod
+    def set_home_branch(cls, user_id, branch: Optional[str]) -> None:
+        if branch is not None and branch not in Branch.names():
+            raise ValidationError("Unknown branch.")
+        cls._get_collection().update_one({"_id": user_id}, {"$set": {"home_branch": branch}})
+        user_cache.pop(str(user_id))
+
+def _forget_cached_user(sender, document, **kwargs):
+    user_cache.pop(str(document.id))
+
+signals.post_save.connect(_forget_cached_user, sender=User)
+signals.post_delete.connect(_forget_cached_user, sender=User)
+
+DEFAULT_USERS = (
+    {"email": "admin@lib.sg", "name": "Admin", "is_admin": True},
+    {"email": "poh@lib.sg", "name": "Peter Oh", "is_admin": False},
+)
 
 def seed_users_if_missing():
-    # Admin
-    admin = User.objects(email="admin@lib.sg").first()
-    if not admin:
-        User(email="admin@lib.sg",
-             password=User.hash_pw("12345"),
-             name="Admin",
-             is_admin=True).save()
-    # Non-admin
-    user = User.objects(email="poh@lib.sg").first()
-    if not user:
-        User(email="poh@lib.sg",
-             password=User.hash_pw("12345"),
-             name="Peter Oh",
-             is_admin=False).save()
+    existing = set(User._get_collection().distinct(
+        "email", {"email": {"$in": [u["email"] for u in DEFAULT_USERS]}}))
+    for spec in DEFAULT_USERS:
+        if spec["email"] not in existing:
+            User(password=User.hash_pw("12345"), **spec).save()
+
+class LoanSummary(Document):
+    """
+    Per-user loan counters kept up to date by the Loan methods, so the loans
+    header, nav badge and borrowing limit need a single indexed read.
+    'active' maps loan id -> {"due": datetime, "renewals_left": int}.
+    """
+    meta = {"collection": "loan_summaries", "strict": False, "auto_create_index": False}
+    user           = ObjectIdField(primary_key=True)
+    total_borrowed = IntField(default=0)
+    active         = DictField(default=dict)
+    rebuilt_at     = DateTimeField()
+    rev            = IntField(default=0)  # bumped by every incremental update; see rebuild()
+
+    @classmethod
+    def for_user(cls, user) -> "LoanSummary":
+        user_id = getattr(user, "id", user)
+        return cls.objects(user=user_id).first() or cls(user=user_id)
+
+    @classmethod
+    def from_doc(cls, doc: Optional[Dict[str, Any]], user_id) -> "LoanSummary":
+        """for_user() from an already fetched raw document (or None)."""
+        return cls._from_son(doc) if doc else cls(user=user_id)
+
+    @property
+    def active_count(self) -> int:
+        return len(self.active or {})
+
+    @property
+    def overdue_count(self) -> int:
+        today = datetime.combine(date.today(), datetime.min.time())
+        return sum(1 for a in (self.active or {}).values() if a["due"] < today)
+
+    @property
+    def renewals_remaining(self) -> int:
+        return sum(a.get("renewals_left", 0) for a in (self.active or {}).values())
+
+    @staticmethod
+    def _entry(loan) -> Dict[str, Any]:
+        return {
+            "due": datetime.combine(loan.due_date, datetime.min.time()),
+            "renewals_left": Loan.MAX_RENEWALS - (loan.renew_count or 0),
+        }
+
+    @classmethod
+    def loan_opened(cls, loan) -> None:
+        cls._get_collection().update_one(
+            {"_id": loan.user_id},
+            {"$inc": {"total_borrowed": 1, "rev": 1}, "$set": {f"active.{loan.id}": cls._entry(loan)}},
+            upsert=True,
+        )
+
+    @classmethod
+    def loan_renewed(cls, loan) -> None:
+        cls.loans_renewed(loan.user_id, {loan.id: cls._entry(loan)})
+
+    @classmethod
+    def loan_closed(cls, loan) -> None:
+        cls.loans_closed(loan.user_id, [loan.id])
+
+    @classmethod
+    def loan_deleted(cls, loan) -> None:
+        cls.loans_deleted(loan.user_id, [loan.id])
+
+    @classmethod
+    def loans_renewed(cls, user_id, entries: Dict[Any, Dict[str, Any]]) -> None:
+        if entries:
+            cls._get_collection().update_one(
+                {"_id": user_id},
+                {"$set": {f"active.{loan_id}": e for loan_id, e in entries.items()}, "$inc": {"rev": 1}},
+                upsert=True,
+            )
+
+    @classmethod
+    def loans_closed(cls, user_id, loan_ids) -> None:
+        if loan_ids:
+            cls._get_collection().update_one(
+                {"_id": user_id},
+                {"$unset": {f"active.{i}": "" for i in loan_ids}, "$inc": {"rev": 1}},
+            )
+
+    @classmethod
+    def loans_deleted(cls, user_id, loan_ids) -> None:
+        if loan_ids:
+            cls._get_collection().update_one(
+                {"_id": user_id},
+                {"$inc": {"total_borrowed": -len(loan_ids), "rev": 1},
+                 "$unset": {f"active.{i}": "" for i in loan_ids}},
+            )
+
+    @classmethod
+    def rebuild(cls, batch_size: int = 1000) -> int:
+        """
+        Recompute every summary from the loans collection; returns users written.
+        Safe on a live system: see _reconcile().
+        """
+        stamp = datetime.now(timezone.utc).replace(microsecond=0)
+        pipeline = [
+            {"$group": {
+                "_id": "$user",
+                "total": {"$sum": 1},
+                "active": {"$push": {"$cond": [
+                    {"$eq": [{"$ifNull": ["$return_date", None]}, None]},
+                    {"id": "$_id", "due": "$due_date",
+                     "left": {"$subtract": [Loan.MAX_RENEWALS, {"$ifNull": ["$renew_count", 0]}]}},
+                    None,
+                ]}},
+            }},
+            {"$project": {
+                "total": 1,
+                "active": {"$filter": {"input": "$active", "cond": {"$ne": ["$$this", None]}}},
+            }},
+        ]
+        coll = cls._get_collection()
+        revs = _revisions(coll)
+        rows = Loan._get_collection().aggregate(pipeline, allowDiskUse=True)
+        return _reconcile(coll, revs, batch_size, (
+            (row["_id"], {
+                "total_borrowed": row["total"],
+                "active": {str(a["id"]): {"due": a["due"], "renewals_left": a["left"]}
+                           for a in row["active"]},
+                "rebuilt_at": stamp,
+            })
+            for row in rows
+        ))
+
+def _revisions(coll) -> Dict[Any, Optional[int]]:
+    """_id -> rev of every document in coll, read before a rebuild starts."""
+    return {d["_id"]: d.get("rev") for d in coll.find({}, {"rev": 1})}
+
+def _reconcile(coll, revs: Dict[Any, Optional[int]], batch_size: int,
+               docs: Iterable[Tuple[Any, Dict[str, Any]]]) -> int:
+    """
+    Write a rebuild's (_id, fields) pairs without losing concurrent updates.
+    Incremental updates bump 'rev', so a document whose rev moved since
+    'revs' was read is left as it is, documents that appeared meanwhile are
+    only inserted if still missing, and only ids in 'revs' that the rebuild
+    did not produce are deleted. Returns documents written.
+    """
+    ops, seen, written = [], set(), 0
+    for _id, fields in docs:
+        seen.add(_id)
+        if _id in revs:
+            ops.append(UpdateOne({"_id": _id, "rev": revs[_id]}, {"$set": fields}))
+        else:
+            ops.append(UpdateOne({"_id": _id}, {"$setOnInsert": fields}, upsert=True))
+        if len(ops) >= batch_size:
+            coll.bulk_write(ops, ordered=False)
+            written += len(ops)
+            ops = []
+    if ops:
+        coll.bulk_write(ops, ordered=False)
+        written += len(ops)
+    stale = [DeleteOne({"_id": _id, "rev": rev}) for _id, rev in revs.items() if _id not in seen]
+    for start in range(0, len(stale), batch_size):
+        coll.bulk_write(stale[start:start + batch_size], ordered=False)
+    return written
+
+class LoanRollup(Document):
+    """
+    Daily circulation counters for admin reporting, one document per
+    (book, day) and per (category, day). Kept current by the Loan methods and
+    rebuilt from the loans collection by rebuild().
+    """
+    meta = {
+        "collection": "loan_rollups",
+        "indexes": [("scope", "day"), ("scope", "key", "day")],
+        "strict": False,
+        "auto_create_index": False,
+    }
+    EVENTS = ("borrowed", "renewed", "returned")
+
+    id       = StringField(primary_key=True)  # "<scope>:<key>:<YYYY-MM-DD>"
+    scope    = StringField(required=True, choices=("book", "category"))
+    key      = StringField(required=True)
+    day      = DateTimeField(required=True)
+    title    = StringField()
+    category = StringField()
+    borrowed = IntField(default=0)
+    renewed  = IntField(default=0)
+    returned = IntField(default=0)
+    rev      = IntField(default=0)  # bumped by record()/record_many(); see rebuild()
+
+    @staticmethod
+    def _day(d) -> datetime:
+        d = d.date() if isinstance(d, datetime) else d
+        return datetime.combine(d, datetime.min.time())
+
+    @classmethod
+    def _ops(cls, counts: Dict[tuple, int], event: str, books: Dict[Any, Dict[str, Any]]) -> list:
+        per_category: Dict[tuple, int] = {}
+        ops = []
+        for (book_id, day), n in counts.items():
+            book = books.get(book_id) or {}
+            category = book.get("category") or "Unknown"
+            ops.append(UpdateOne(
+                {"_id": f"book:{book_id}:{day:%Y-%m-%d}"},
+                {"$inc": {event: n, "rev": 1},
+                 "$setOnInsert": {"scope": "book", "key": str(book_id), "day": day,
+                                  "title": book.get("title"), "category": category}},
+                upsert=True,
+            ))
+            per_category[(category, day)] = per_category.get((category, day), 0) + n
+        for (category, day), n in per_category.items():
+            ops.append(UpdateOne(
+                {"_id": f"category:{category}:{day:%Y-%m-%d}"},
+                {"$inc": {event: n, "rev": 1},
+                 "$setOnInsert": {"scope": "category", "key": category, "day": day,
+                                  "category": category}},
+                upsert=True,
+            ))
+        return ops
+
+    @classmethod
+    def record(cls, event: str, book, day: date) -> None:
+        """Count one event for a Book document (no lookup needed)."""
+        books = {book.id: {"title": book.title, "category": book.category}}
+        cls._get_collection().bulk_write(
+            cls._ops({(book.id, cls._day(day)): 1}, event, books), ordered=False)
+
+    @classmethod
+    def record_many(cls, event: str, pairs: Iterable[tuple]) -> None:
+        """Count one event per (book_id, day) pair, looking the books up with one $in."""
+        counts: Dict[tuple, int] = {}
+        for book_id, day in pairs:
+            key = (book_id, cls._day(day))
+            counts[key] = counts.get(key, 0) + 1
+        if not counts:
+            return
+        books = {
+            b["_id"]: b for b in Book._get_collection().find(
+                {"_id": {"$in": list({b for b, _ in counts})}}, {"title": 1, "category": 1})
+        }
+        cls._get_collection().bulk_write(cls._ops(counts, event, books), ordered=False)
+
+    @classmethod
+    def rebuild(cls, batch_size: int = 5000) -> int:
+        """
+        Recompute every rollup from the loans collection, aggregating batch_size
+        loans at a time; returns documents written. Loans only keep their latest
+        borrow date, so borrows and renewals of renewed loans land on that day.
+        Safe on a live system: see _reconcile().
+        """
+        stamp = datetime.now(timezone.utc).replace(microsecond=0)
+        revs = _revisions(cls._get_collection())
+        loans = Loan._get_collection()
+        totals: Dict[tuple, Dict[str, int]] = {}
+
+        last = None
+        while True:
+            ids = [d["_id"] for d in loans.find({"_id": {"$gt": last}} if last else {}, {"_id": 1})
+                   .sort("_id", 1).limit(batch_size)]
+            if not ids:
+                break
+            window = {"_id": {"$gte": ids[0], "$lte": ids[-1]}}
+            last = ids[-1]
+            # Loan dates are stored at midnight, so grouping on them groups by day.
+            grouped = [
+                ({"$group": {"_id": {"book": "$book", "day": "$borrow_date"},
+                             "borrowed": {"$sum": 1},
+                             "renewed": {"$sum": {"$ifNull": ["$renew_count", 0]}}}}, {}),
+                ({"$group": {"_id": {"book": "$book", "day": "$return_date"},
+                             "returned": {"$sum": 1}}}, {"return_date": {"$ne": None}}),
+            ]
+            for group, extra in grouped:
+                for row in loans.aggregate([{"$match": {**window, **extra}}, group]):
+                    entry = totals.setdefault((row["_id"]["book"], row["_id"]["day"]), {})
+                    for event in cls.EVENTS:
+                        entry[event] = entry.get(event, 0) + row.get(event, 0)
+
+        books = {
+            b["_id"]: b for b in Book._get_collection().find(
+                {"_id": {"$in": list({b for b, _ in totals})}}, {"title": 1, "category": 1})
+        }
+        docs: Dict[str, Dict[str, Any]] = {}
+        for (book_id, day), counts in totals.items():
+            book = books.get(book_id) or {}
+            category = book.get("category") or "Unknown"
+            for scope, key, extra in (("book", str(book_id), {"title": book.get("title")}),
+                                      ("category", category, {})):
+                doc = docs.setdefault(f"{scope}:{key}:{day:%Y-%m-%d}", {
+                    "scope": scope, "key": key, "day": day, "category": category,
+                    "borrowed": 0, "renewed": 0, "returned": 0, "rebuilt_at": stamp, **extra,
+                })
+                for event in cls.EVENTS:
+                    doc[event] += counts.get(event, 0)
+
+        return _reconcile(cls._get_collection(), revs, 1000, docs.items())
+
+    @classmethod
+    def top_books(cls, since: date, limit: int = 10) -> list:
+        return list(cls._get_collection().aggregate([
+            {"$match": {"scope": "book", "day": {"$gte": cls._day(since)}}},
+            {"$group": {"_id": "$key", "title": {"$first": "$title"},
+                        "borrowed": {"$sum": "$borrowed"}, "renewed": {"$sum": "$renewed"},
+                        "returned": {"$sum": "$returned"}}},
+            {"$sort": {"borrowed": -1, "title": 1}},
+            {"$limit": limit},
+        ]))
+
+    @classmethod
+    def by_category(cls, since: date) -> list:
+        return list(cls._get_collection().find(
+            {"scope": "category", "day": {"$gte": cls._day(since)}},
+            {"key": 1, "day": 1, "borrowed": 1, "renewed": 1, "returned": 1},
+        ).sort([("day", 1), ("key", 1)]))
 
 class Loan(Document):
     meta = {
         "collection": "loans",
-        "indexes": ["user", ("user", "book", "return_date"), "-borrow_date"],
+        "indexes": [
+            "user", ("user", "book", "return_date"), "-borrow_date",
+            ("user", "-borrow_date", "-id"), "due_date", ("return_date", "due_date", "id"),
+        ],
         "strict": False,
+        # Created by `flask migrate`, not on first use in every worker.
+        "auto_create_index": False,
     }
 
     user        = ReferenceField(User, required=True, reverse_delete_rule=CASCADE)
@@ -137,69 +1002,605 @@ class Loan(Document):
     borrow_date = DateField(required=True)
     return_date = DateField()
     renew_count = IntField(min_value=0, default=0)
+    # Persisted so overdue loans can be found with an index; set by create_for/do_renew.
+    due_date    = DateField()
+    # Branch the copy came from and goes back to.
+    branch      = StringField()
+
+    LOAN_DAYS = 14
+    MAX_RENEWALS = 2
 
     @property
-    def is_returned(self) -> bool:
-        return self.return_date is not None
+    def user_id(self):
+        """The referenced user's id, without dereferencing it."""
+        ref = self._data.get("user")
+        return getattr(ref, "id", ref)
+
+    @classmethod
+    def due_from(cls, borrow_date: date) -> date:
+        return borrow_date + timedelta(days=cls.LOAN_DAYS)
 
     @property
-    def due_date(self) -> date:
-        return self.borrow_date + timedelta(days=14)
+    def is_returned(self) -> bool:
+        return self.return_date is not None
 
     @property
     def is_overdue(self) -> bool:
         return (not self.is_returned) and (date.today() > self.due_date)
 
     @classmethod
-    def for_user(cls, user):
-        return cls.objects(user=user).order_by("-borrow_date", "-id")
+    def overdue_batches(cls, *, as_of: Optional[date] = None, batch_size: int = 500):
+        """
+        Yield lists of raw overdue loan dicts (_id, user, book, due_date), oldest due first.
+        Streams one server cursor over the (return_date, due_date, _id) index, which
+        also provides the sort.
+        """
+        as_of = as_of or date.today()
+        cursor = cls._get_collection().find(
+            {"return_date": None, "due_date": {"$lt": datetime.combine(as_of, datetime.min.time())}},
+            {"user": 1, "book": 1, "due_date": 1},
+        ).sort([("due_date", 1), ("_id", 1)]).batch_size(batch_size)
+
+        batch = []
+        for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @classmethod
+    def backfill_branch(cls) -> int:
+        """Attribute loans made before branches existed to Branch.DEFAULT."""
+        return cls._get_collection().update_many(
+            {"branch": {"$exists": False}}, {"$set": {"branch": Branch.DEFAULT}}).modified_count
+
+    @classmethod
+    def backfill_due_dates(cls, batch_size: int = 1000) -> int:
+        """Set due_date on loans saved before it was persisted."""
+        coll = cls._get_collection()
+        ops = []
+        count = 0
+        for doc in coll.find({"due_date": None}, {"borrow_date": 1}).batch_size(batch_size):
+            due = doc["borrow_date"] + timedelta(days=cls.LOAN_DAYS)
+            ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"due_date": due}}))
+            if len(ops) >= batch_size:
+                count += coll.bulk_write(ops, ordered=False).modified_count
+                ops = []
+        if ops:
+            count += coll.bulk_write(ops, ordered=False).modified_count
+        return count
+
+    # Book fields the loans page needs; anything else stays on the server.
+    BOOK_SUMMARY_FIELDS = ("title", "url", "authors", "available", "copies")
+
+    @classmethod
+    def for_user(cls, user, *, resolve_books: bool = False,
+                 page: Optional[int] = None, per_page: int = 20):
+        """
+        A user's loans, newest first. With 'page' only that page is returned.
+        With resolve_books=True the result is a list whose 'book' references are
+        filled from a single $in query on a projected book summary, instead of
+        one dereference per row.
+        """
+        qs = cls.objects(user=user).order_by("-borrow_date", "-id")
+        if page is not None:
+            qs = qs.skip((max(page, 1) - 1) * per_page).limit(per_page)
+        if not resolve_books:
+            return qs
+
+        loans = list(qs.no_dereference())
+        book_ids = {loan.book.id for loan in loans}
+        books = {
+            b.id: b
+            for b in Book.objects(id__in=list(book_ids)).only(*cls.BOOK_SUMMARY_FIELDS)
+        }
+        for loan in loans:
+            loan._data["book"] = books.get(loan.book.id, loan.book)
+        return loans
 
     @classmethod
     def by_id_for_user(cls, user, loan_id):
         return cls.objects(id=loan_id, user=user).first()
 
     @classmethod
-    def create_for(cls, *, user: User, book: Book, borrow_date: date):
-        if (book.available or 0) <= 0:
-            raise ValidationError("No available copies for this title.")
+    def create_for(cls, *, user: User, book: Book, borrow_date: date, limit: Optional[int] = None,
+                   branch: Optional[str] = None):
+        """
+        'limit' caps the user's active loans, checked against their LoanSummary.
+        The copy comes from 'branch' if given, else the nearest branch to the
+        user's home branch that has one.
+        """
+        if limit is not None and LoanSummary.for_user(user).active_count >= limit:
+            raise ValidationError(f"You can have at most {limit} books on loan.")
         if cls.objects(user=user, book=book, return_date=None).first():
             raise ValidationError("You already have an unreturned loan for this title.")
 
-        
-        book.available = (book.available or 0) - 1
-        book.save(validate=True)
+        # A ready hold already reserves a copy; otherwise take one off the shelf.
+        hold = Hold.claim_ready(user, book.id)
+        if hold is None:
+            try:
+                branch = book.borrow_one(branch, prefer=Branch.ranked(getattr(user, "home_branch", None)))
+            except ValidationError:
+                raise ValidationError("No available copies for this title.")
+        else:
+            branch = hold.get("branch") or Branch.DEFAULT
+            # No stock moves, but the /books ETag also covers the nav loan badge.
+            Counter.bump(Book.GENERATION)
 
-        return cls(user=user, book=book, borrow_date=borrow_date).save()
+        try:
+            loan = cls(
+                user=user, book=book, borrow_date=borrow_date, due_date=cls.due_from(borrow_date),
+                branch=branch,
+            ).save()
+        except Exception:
+            if hold is None:
+                book.return_one(branch)
+            else:
+                Hold.unclaim(hold)
+            raise
+        if hold is None:
+            # A hold the user still had on this title is done now they have a copy.
+            Hold.fulfil(user, book.id)
+        LoanSummary.loan_opened(loan)
+        LoanRollup.record("borrowed", book, borrow_date)
+        return loan
 
     
     def can_renew(self) -> bool:
-        return (not self.is_returned) and (not self.is_overdue) and (self.renew_count < 2)
+        return (not self.is_returned) and (not self.is_overdue) and (self.renew_count < self.MAX_RENEWALS)
 
     def do_renew(self, new_borrow_date: date):
         if not self.can_renew():
             raise ValidationError("This loan cannot be renewed.")
         self.borrow_date = new_borrow_date
+        self.due_date = self.due_from(new_borrow_date)
         self.renew_count = (self.renew_count or 0) + 1
         self.save(validate=True)
+        LoanSummary.loan_renewed(self)
+        LoanRollup.record("renewed", self.book, new_borrow_date)
 
     def do_return(self, return_date_: date):
-        if self.is_returned:
+        # Claim the loan first so concurrent returns cannot both credit the book.
+        claimed = Loan.objects(id=self.id, return_date=None).update_one(
+            set__return_date=return_date_
+        )
+        if not claimed:
             raise ValidationError("Loan already returned.")
-        
-        if not self.book.can_return():
-            raise ValidationError("Cannot return: already at maximum available.")
-        self.book.available = (self.book.available or 0) + 1
-        self.book.save(validate=True)
-
+        # The copy goes to the head of the hold queue, if any, instead of the shelf.
+        branch = self.branch or Branch.DEFAULT
+        if Hold.hand_over(self.book.id, branch) is None:
+            try:
+                self.book.return_one(branch)
+            except ValidationError:
+                Loan.objects(id=self.id).update_one(unset__return_date=True)
+                raise
+        else:
+            Counter.bump(Book.GENERATION)  # the loan badge changed; see create_for()
         self.return_date = return_date_
-        self.save(validate=True)
+        LoanSummary.loan_closed(self)
+        LoanRollup.record("returned", self.book, return_date_)
 
     
     def delete_if_returned(self):
         if not self.is_returned:
             raise ValidationError("Only returned loans can be deleted.")
-        self.delete()
+        # Not one a batch has claimed (see bulk_delete): only the deleter updates the summary.
+        deleted = Loan._get_collection().delete_one(
+            {"_id": self.id, "return_date": {"$ne": None}, "batch_token": {"$exists": False}}
+        ).deleted_count
+        if not deleted:
+            raise ValidationError("Loan not found.")
+        LoanSummary.loan_deleted(self)
+
+    # Batch versions of do_return/do_renew/delete_if_returned: ownership is checked
+    # with one $in query and changes go out as bulk writes. Each write stamps a
+    # batch token so the documents it actually changed can be read back, giving
+    # per-item results ({loan_id: "ok" or an error message}). Tokens are removed
+    # again once read.
+
+    @classmethod
+    def _owned(cls, user, loan_ids, projection):
+        results, oids = {}, []
+        for raw in loan_ids:
+            try:
+                oids.append(ObjectId(raw))
+            except (InvalidId, TypeError):
+                results[str(raw)] = "Invalid loan id."
+        docs = {
+            d["_id"]: d
+            for d in cls._get_collection().find(
+                {"_id": {"$in": oids}, "user": getattr(user, "id", user)}, projection
+            )
+        }
+        for oid in oids:
+            if oid not in docs:
+                results[str(oid)] = "Loan not found."
+        return docs, results
+
+    @classmethod
+    def _stamped(cls, coll, ids, token):
+        """Those of 'ids' carrying 'token', which is then unset from them."""
+        if not ids:
+            return set()
+        query = {"_id": {"$in": list(ids)}, "batch_token": token}
+        stamped = {d["_id"] for d in coll.find(query, {"_id": 1})}
+        if stamped:
+            coll.update_many(query, {"$unset": {"batch_token": ""}})
+        return stamped
+
+    @classmethod
+    def clear_batch_tokens(cls, age: timedelta = timedelta(minutes=5)) -> int:
+        """
+        Unset batch tokens older than 'age' from loans and book holdings, left
+        behind by batches that did not remove them. Returns documents cleaned.
+        """
+        cutoff = ObjectId.from_datetime(datetime.now(timezone.utc) - age)
+        count = cls._get_collection().update_many(
+            {"batch_token": {"$lt": cutoff}}, {"$unset": {"batch_token": ""}}).modified_count
+        books = Book._get_collection()
+        # '$' is one matching holding per book, so repeat until none is left.
+        while True:
+            n = books.update_many({"holdings.batch_token": {"$lt": cutoff}},
+                                  {"$unset": {"holdings.$.batch_token": ""}}).modified_count
+            if not n:
+                return count
+            count += n
+
+    @staticmethod
+    def _as_datetime(d: date) -> datetime:
+        return datetime.combine(d, datetime.min.time())
+
+    @classmethod
+    def bulk_return(cls, user, loan_ids, date_for) -> Dict[str, str]:
+        """Return many loans; date_for(borrow_date) gives each loan's return date."""
+        docs, results = cls._owned(user, loan_ids, {"book": 1, "branch": 1, "borrow_date": 1, "return_date": 1})
+        loans, books = cls._get_collection(), Book._get_collection()
+        token = ObjectId()
+
+        ops, pending, returned_on = [], [], {}
+        for oid, d in docs.items():
+            if d.get("return_date") is not None:
+                results[str(oid)] = "Loan already returned."
+                continue
+            returned = cls._as_datetime(date_for(d["borrow_date"].date()))
+            returned_on[oid] = returned
+            pending.append(oid)
+            ops.append(UpdateOne(
+                {"_id": oid, "return_date": None},
+                {"$set": {"return_date": returned, "batch_token": token}},
+            ))
+        if ops:
+            loans.bulk_write(ops, ordered=False)
+        claimed = cls._stamped(loans, pending, token)
+        for oid in pending:
+            if oid not in claimed:
+                results[str(oid)] = "Loan already returned."
+
+        # Copies go back to the branch they came from: group by (book, branch).
+        per_holding: Dict[Tuple[Any, str], list] = {}
+        for oid in claimed:
+            key = (docs[oid]["book"], docs[oid].get("branch") or Branch.DEFAULT)
+            per_holding.setdefault(key, []).append(oid)
+        # Copies handed to waiting holds are done; only the rest go back on the shelf.
+        done = []
+        for key, ids in list(per_holding.items()):
+            while ids and Hold.hand_over(*key) is not None:
+                done.append(ids.pop())
+            if not ids:
+                del per_holding[key]
+        book_ops = []
+        for (book_id, branch), ids in per_holding.items():
+            update = Book._change_available(len(ids))
+            update["$set"]["holdings.$.batch_token"] = token
+            book_ops.append(UpdateOne({"_id": book_id, **Book._has_room(branch, len(ids))}, update))
+        credited = set()
+        if book_ops:
+            books.bulk_write(book_ops, ordered=False)
+            query = {"_id": {"$in": list({b for b, _ in per_holding})}, "holdings.batch_token": token}
+            credited = {
+                (d["_id"], h["branch"])
+                for d in books.find(query, {"holdings": 1})
+                for h in d["holdings"] if h.get("batch_token") == token
+            }
+            # '$' is one stamped holding per book, so one pass per holding a book had stamped.
+            per_book: Dict[Any, int] = {}
+            for book_id, _branch in credited:
+                per_book[book_id] = per_book.get(book_id, 0) + 1
+            for _ in range(max(per_book.values(), default=0)):
+                books.update_many(query, {"$unset": {"holdings.$.batch_token": ""}})
+        Book._announce_ids({b for b, _ in credited})
+
+        failed = [oid for key, ids in per_holding.items() if key not in credited for oid in ids]
+        if failed:
+            loans.update_many({"_id": {"$in": failed}}, {"$unset": {"return_date": ""}})
+        done += [oid for key, ids in per_holding.items() if key in credited for oid in ids]
+        for oid in failed:
+            results[str(oid)] = "Cannot return: already at maximum available."
+        for oid in done:
+            results[str(oid)] = "ok"
+        if done:
+            # Copies credited or handed to holds; either way the loan badge changed.
+            Counter.bump(Book.GENERATION)
+        LoanSummary.loans_closed(getattr(user, "id", user), done)
+        LoanRollup.record_many("returned", [(docs[oid]["book"], returned_on[oid]) for oid in done])
+        return results
+
+    @classmethod
+    def bulk_renew(cls, user, loan_ids, date_for) -> Dict[str, str]:
+        """Renew many loans; date_for(borrow_date) gives each loan's new borrow date."""
+        docs, results = cls._owned(
+            user, loan_ids,
+            {"book": 1, "borrow_date": 1, "due_date": 1, "return_date": 1, "renew_count": 1},
+        )
+        loans = cls._get_collection()
+        token = ObjectId()
+        today = date.today()
+
+        ops, entries, renewed_on = [], {}, {}
+        for oid, d in docs.items():
+            borrowed = d["borrow_date"].date()
+            due = d["due_date"].date() if d.get("due_date") else cls.due_from(borrowed)
+            renewed = d.get("renew_count") or 0
+            if d.get("return_date") is not None or today > due or renewed >= cls.MAX_RENEWALS:
+                results[str(oid)] = "This loan cannot be renewed."
+                continue
+            new_borrow = date_for(borrowed)
+            new_due = cls.due_from(new_borrow)
+            ops.append(UpdateOne(
+                {"_id": oid, "return_date": None, "renew_count": d.get("renew_count")},
+                {"$set": {"borrow_date": cls._as_datetime(new_borrow),
+                          "due_date": cls._as_datetime(new_due), "batch_token": token},
+                 "$inc": {"renew_count": 1}},
+            ))
+            entries[oid] = {"due": cls._as_datetime(new_due),
+                            "renewals_left": cls.MAX_RENEWALS - renewed - 1}
+            renewed_on[oid] = new_borrow
+        if ops:
+            loans.bulk_write(ops, ordered=False)
+        renewed_ids = cls._stamped(loans, entries, token)
+        for oid in entries:
+            results[str(oid)] = "ok" if oid in renewed_ids else "This loan cannot be renewed."
+        LoanSummary.loans_renewed(
+            getattr(user, "id", user), {oid: e for oid, e in entries.items() if oid in renewed_ids},
+        )
+        LoanRollup.record_many("renewed", [(docs[oid]["book"], renewed_on[oid]) for oid in renewed_ids])
+        return results
+
+    @classmethod
+    def bulk_delete(cls, user, loan_ids) -> Dict[str, str]:
+        """Delete many returned loans."""
+        docs, results = cls._owned(user, loan_ids, {"return_date": 1})
+        eligible = []
+        for oid, d in docs.items():
+            if d.get("return_date") is None:
+                results[str(oid)] = "Only returned loans can be deleted."
+            else:
+                eligible.append(oid)
+        if eligible:
+            # Claim, read back, then delete only what was claimed, so loans that a
+            # concurrent delete got to first are not reported or counted again.
+            coll, token = cls._get_collection(), ObjectId()
+            coll.update_many(
+                {"_id": {"$in": eligible}, "return_date": {"$ne": None}, "batch_token": {"$exists": False}},
+                {"$set": {"batch_token": token}},
+            )
+            claimed = [d["_id"] for d in coll.find({"_id": {"$in": eligible}, "batch_token": token}, {"_id": 1})]
+            if claimed:
+                coll.delete_many({"_id": {"$in": claimed}, "batch_token": token})
+            for oid in eligible:
+                results[str(oid)] = "Loan not found."
+            for oid in claimed:
+                results[str(oid)] = "ok"
+            LoanSummary.loans_deleted(getattr(user, "id", user), claimed)
+        return results
 
     @staticmethod
     def random_days_between(lo: int, hi: int) -> int:
         return random.randint(lo, hi)
+
+class Notification(Document):
+    """Per-user messages (e.g. a hold becoming ready), polled via /notifications/poll."""
+    meta = {
+        "collection": "notifications",
+        "indexes": [("user", "-id")],
+        "strict": False,
+        "auto_create_index": False,
+    }
+    user       = ObjectIdField(required=True)
+    kind       = StringField(required=True)
+    message    = StringField(required=True)
+    book       = ObjectIdField()
+    created_at = DateTimeField()
+
+    @classmethod
+    def push(cls, user_id, kind: str, message: str, book_id=None) -> None:
+        cls._get_collection().insert_one({
+            "user": user_id, "kind": kind, "message": message, "book": book_id,
+            "created_at": datetime.now(timezone.utc),
+        })
+
+    @classmethod
+    def recent(cls, user, after: Optional[ObjectId] = None, limit: int = 50) -> list:
+        """Newest first; only those newer than 'after' if given. One indexed query."""
+        query: Dict[str, Any] = {"user": getattr(user, "id", user)}
+        if after is not None:
+            query["_id"] = {"$gt": after}
+        return list(cls._get_collection().find(query).sort("_id", -1).limit(limit))
+
+class Hold(Document):
+    """
+    A user's place in the queue for a title with no available copies.
+    Returned copies go to the oldest waiting hold (see hand_over()) instead of
+    Book.available, kept at the branch they were returned to; the holder then
+    has READY_DAYS to borrow it before it passes to the next in line.
+    """
+    meta = {
+        "collection": "holds",
+        "indexes": [("book", "status", "created_at"), ("user", "status"), ("status", "expires_at")],
+        "strict": False,
+        "auto_create_index": False,
+    }
+    STATUSES = ("waiting", "ready", "fulfilled", "cancelled", "expired")
+    ACTIVE = ("waiting", "ready")
+    READY_DAYS = 3
+
+    user       = ObjectIdField(required=True)
+    book       = ObjectIdField(required=True)
+    status     = StringField(required=True, choices=STATUSES, default="waiting")
+    created_at = DateTimeField(required=True)
+    ready_at   = DateTimeField()
+    expires_at = DateTimeField()
+    # Branch holding the reserved copy, once ready.
+    branch     = StringField()
+
+    @classmethod
+    def active_for(cls, user, book_id) -> Optional[Dict[str, Any]]:
+        return cls._get_collection().find_one(cls._active_filter(user, book_id))
+
+    @classmethod
+    def _active_filter(cls, user, book_id) -> Dict[str, Any]:
+        return {"user": getattr(user, "id", user), "book": book_id, "status": {"$in": list(cls.ACTIVE)}}
+
+    @classmethod
+    def for_user(cls, user) -> list:
+        return list(cls._get_collection().find(
+            {"user": getattr(user, "id", user), "status": {"$in": list(cls.ACTIVE)}}
+        ).sort("created_at", 1))
+
+    @classmethod
+    def position(cls, hold: Dict[str, Any]) -> int:
+        """1-based place in the book's queue; 0 once the hold is no longer waiting."""
+        if hold.get("status") != "waiting":
+            return 0
+        return 1 + cls._get_collection().count_documents(cls._ahead_filter(hold))
+
+    @staticmethod
+    def _ahead_filter(hold: Dict[str, Any]) -> Dict[str, Any]:
+        """Waiting holds on the same book placed before 'hold'."""
+        return {"book": hold["book"], "status": "waiting", "created_at": {"$lt": hold["created_at"]}}
+
+    @classmethod
+    def place(cls, user, book: Book) -> Dict[str, Any]:
+        if (book.available or 0) > 0:
+            raise ValidationError("Copies are available; borrow it instead.")
+        if cls.active_for(user, book.id):
+            raise ValidationError("You already have a hold on this title.")
+        if Loan.objects(user=user.id, book=book.id, return_date=None).first():
+            raise ValidationError("You already have this title on loan.")
+        doc = {"user": user.id, "book": book.id, "status": "waiting",
+               "created_at": datetime.now(timezone.utc)}
+        doc["_id"] = cls._get_collection().insert_one(doc).inserted_id
+        return doc
+
+    @classmethod
+    def cancel(cls, user, hold_id) -> None:
+        doc = cls._get_collection().find_one_and_update(
+            {"_id": hold_id, "user": getattr(user, "id", user), "status": {"$in": list(cls.ACTIVE)}},
+            {"$set": {"status": "cancelled"}},
+        )
+        if doc is None:
+            raise ValidationError("Hold not found.")
+        if doc["status"] == "ready":
+            cls.release_copy(doc["book"], doc.get("branch") or Branch.DEFAULT)
+
+    @classmethod
+    def hand_over(cls, book_id, branch: str) -> Optional[Dict[str, Any]]:
+        """
+        Give one returned copy of book_id, at 'branch', to the oldest waiting hold,
+        atomically. Returns the hold, or None if nobody is waiting (the caller
+        credits the book).
+        """
+        now = datetime.now(timezone.utc)
+        doc = cls._get_collection().find_one_and_update(
+            {"book": book_id, "status": "waiting"},
+            {"$set": {"status": "ready", "ready_at": now, "branch": branch,
+                      "expires_at": now + timedelta(days=cls.READY_DAYS)}},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+        if doc is not None:
+            Notification.push(
+                doc["user"], "hold_ready",
+                f"Your hold on '{cls._title(book_id)}' is ready at "
+                f"{Branch.names().get(branch, branch)}. Borrow it by {doc['expires_at']:%d %b %Y}.",
+                book_id,
+            )
+        return doc
+
+    @staticmethod
+    def _title(book_id) -> str:
+        doc = Book._get_collection().find_one({"_id": book_id}, {"title": 1})
+        return doc["title"] if doc else "a book"
+
+    @classmethod
+    def release_copy(cls, book_id, branch: str) -> None:
+        """A reserved copy came back unused: pass it on, or return it to its branch's shelf."""
+        if cls.hand_over(book_id, branch) is None:
+            Book.credit_copy(book_id, branch)
+            Counter.bump(Book.GENERATION)
+            Book._announce_ids([book_id])
+
+    @classmethod
+    def claim_ready(cls, user, book_id) -> Optional[Dict[str, Any]]:
+        """Mark the user's ready hold on book_id fulfilled; its copy is theirs to borrow."""
+        return cls._get_collection().find_one_and_update(
+            {"user": getattr(user, "id", user), "book": book_id, "status": "ready",
+             "expires_at": {"$gt": datetime.now(timezone.utc)}},
+            {"$set": {"status": "fulfilled"}},
+        )
+
+    @classmethod
+    def fulfil(cls, user, book_id) -> None:
+        """
+        Close the user's active hold on book_id after they borrowed a shelf copy.
+        A copy it had reserved (a lapsed ready hold) is passed on.
+        """
+        doc = cls._get_collection().find_one_and_update(
+            cls._active_filter(user, book_id), {"$set": {"status": "fulfilled"}},
+        )
+        if doc is not None and doc["status"] == "ready":
+            cls.release_copy(doc["book"], doc.get("branch") or Branch.DEFAULT)
+
+    @classmethod
+    def unclaim(cls, hold: Dict[str, Any]) -> None:
+        cls._get_collection().update_one(
+            {"_id": hold["_id"], "status": "fulfilled"}, {"$set": {"status": "ready"}}
+        )
+
+    @classmethod
+    def expire_ready(cls, now: Optional[datetime] = None) -> int:
+        """Expire ready holds past their deadline, passing each copy on. Returns the count."""
+        now = now or datetime.now(timezone.utc)
+        coll, count = cls._get_collection(), 0
+        while True:
+            doc = coll.find_one_and_update(
+                {"status": "ready", "expires_at": {"$lte": now}}, {"$set": {"status": "expired"}},
+            )
+            if doc is None:
+                return count
+            Notification.push(doc["user"], "hold_expired",
+                              f"Your hold on '{cls._title(doc['book'])}' expired.", doc["book"])
+            cls.release_copy(doc["book"], doc.get("branch") or Branch.DEFAULT)
+            count += 1
+
+    @classmethod
+    def promote_waiting(cls) -> int:
+        """
+        Hand shelf copies to waiting holds, for copies credited while a hold was
+        being placed. Returns the number of holds made ready.
+        """
+        count = 0
+        for book_id in cls._get_collection().distinct("book", {"status": "waiting"}):
+            changed = False
+            while (taken := Book.take_copy(book_id)) is not None:
+                changed = True
+                if cls.hand_over(book_id, taken[0]) is None:
+                    Book.credit_copy(book_id, taken[0])
+                    break
+                count += 1
+            if changed:
+                Counter.bump(Book.GENERATION)
+                Book._announce_ids([book_id])
+        return count
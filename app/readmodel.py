@@ -0,0 +1,103 @@
+# Read-only __slots__ views built straight from pymongo documents, for pages that
+# don't need MongoEngine Document construction. They expose what templates use.
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, Optional
+
+from .model import Book, Branch, Loan
+
+
+def _as_date(value) -> Optional[date]:
+    return value.date() if isinstance(value, datetime) else value
+
+
+class BookView:
+    __slots__ = ("id", "title", "category", "url", "genres", "authors", "pages", "available",
+                 "copies", "holdings", "branches_in_stock", "description", "version", "updated_at",
+                 "score")
+
+    DETAIL_FIELDS = ("title", "category", "url", "genres", "authors", "pages",
+                     "available", "copies", "description", "version", "updated_at")
+
+    def __init__(self, doc: Dict[str, Any]):
+        self.id = doc.get("_id")
+        self.title = doc.get("title")
+        self.category = doc.get("category")
+        self.url = doc.get("url")
+        self.genres = doc.get("genres") or []
+        self.authors = doc.get("authors") or []
+        self.pages = doc.get("pages")
+        self.available = doc.get("available")
+        self.copies = doc.get("copies")
+        self.holdings = doc.get("holdings") or []
+        self.branches_in_stock = doc.get("branches_in_stock")
+        self.description = doc.get("description") or []
+        self.version = doc.get("version") or 0
+        self.updated_at = doc.get("updated_at")
+        self.score = doc.get("score")
+
+    @classmethod
+    def detail_projection(cls) -> Dict[str, int]:
+        return {**dict.fromkeys(cls.DETAIL_FIELDS, 1), **Book.HOLDING_FIELDS}
+
+    @classmethod
+    def wrap(cls, docs: Iterable[Dict[str, Any]]) -> List["BookView"]:
+        return [cls(d) for d in docs]
+
+    @classmethod
+    def by_id(cls, book_id) -> Optional["BookView"]:
+        doc = Book._reads().find_one({"_id": book_id}, cls.detail_projection())
+        return cls(doc) if doc else None
+
+
+class LoanView:
+    __slots__ = ("id", "book", "borrow_date", "due_date", "return_date", "renew_count", "branch")
+
+    FIELDS = ("book", "borrow_date", "due_date", "return_date", "renew_count", "branch")
+
+    def __init__(self, doc: Dict[str, Any], book):
+        self.id = doc["_id"]
+        self.book = book
+        self.borrow_date = _as_date(doc.get("borrow_date"))
+        self.due_date = _as_date(doc.get("due_date")) or Loan.due_from(self.borrow_date)
+        self.return_date = _as_date(doc.get("return_date"))
+        self.renew_count = doc.get("renew_count") or 0
+        self.branch = doc.get("branch") or Branch.DEFAULT
+
+    @property
+    def is_returned(self) -> bool:
+        return self.return_date is not None
+
+    @property
+    def is_overdue(self) -> bool:
+        return (not self.is_returned) and (date.today() > self.due_date)
+
+    def can_renew(self) -> bool:
+        return (not self.is_returned) and (not self.is_overdue) and (self.renew_count < Loan.MAX_RENEWALS)
+
+    @classmethod
+    def for_user(cls, user, *, page: int = 1, per_page: int = 20) -> List["LoanView"]:
+        """One page of a user's loans, newest first, with books fetched by a single $in."""
+        docs = list(cls.page_cursor(Loan._get_collection(), user, page=page, per_page=per_page))
+        return cls.join(docs, cls.books_cursor(Book._get_collection(), docs))
+
+    # The cursor builders take the collection so the async views can pass an
+    # AsyncCollection; find() has the same shape on both.
+
+    @classmethod
+    def page_cursor(cls, loans, user, *, page: int, per_page: int):
+        return (
+            loans.find({"user": getattr(user, "id", user)}, dict.fromkeys(cls.FIELDS, 1))
+            .sort([("borrow_date", -1), ("_id", -1)])
+            .skip((max(page, 1) - 1) * per_page)
+            .limit(per_page)
+        )
+
+    @staticmethod
+    def books_cursor(books, docs: List[Dict[str, Any]]):
+        book_ids = list({d["book"] for d in docs})
+        return books.find({"_id": {"$in": book_ids}}, dict.fromkeys(Loan.BOOK_SUMMARY_FIELDS, 1))
+
+    @classmethod
+    def join(cls, docs: List[Dict[str, Any]], book_docs: Iterable[Dict[str, Any]]) -> List["LoanView"]:
+        books = {b["_id"]: BookView(b) for b in book_docs}
+        return [cls(d, books.get(d["book"]) or BookView({"_id": d["book"]})) for d in docs]
@@ -0,0 +1,311 @@
+import heapq
+import logging
+import math
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from itertools import combinations
+from typing import Any, Dict, List, Tuple
+
+from pymongo import ReplaceOne, UpdateOne
+
+try:
+    import numpy as np
+except ImportError:  # falls back to the pure-Python scorer below
+    np = None
+
+from .model import Book, Loan, SimilarBooks
+
+log = logging.getLogger(__name__)
+
+FIELDS = {"title": 1, "genres": 1, "authors": 1, "category": 1}
+# Weight of each shared feature in the cosine similarity.
+FEATURE_WEIGHTS = {"genres": 1.0, "authors": 2.0, "category": 0.5}
+# Weight of loan co-occurrence (borrowed by the same users) added to the cosine.
+CO_LOAN_WEIGHT = 0.5
+# Only a user's most recent loans count towards co-occurrence.
+CO_LOAN_MAX_PER_USER = 50
+TOP_K = 8
+# add_book() scores a new title against at most this many of the books that
+# share the most features with it, rather than its whole category.
+NEIGHBOURS_MAX = 1000
+
+
+def _tokens(doc: Dict[str, Any]) -> Dict[str, float]:
+    tokens = {}
+    for genre in doc.get("genres") or []:
+        tokens[f"g:{genre.casefold()}"] = FEATURE_WEIGHTS["genres"]
+    for author in doc.get("authors") or []:
+        name = author.replace("(Illustrator)", "").strip().casefold()
+        tokens[f"a:{name}"] = FEATURE_WEIGHTS["authors"]
+    if doc.get("category"):
+        tokens[f"c:{doc['category']}"] = FEATURE_WEIGHTS["category"]
+    return tokens
+
+
+class Catalogue:
+    """Feature encoding of every book; columns are only features shared by 2+ books."""
+
+    def __init__(self, docs: List[Dict[str, Any]]):
+        self.ids = [d["_id"] for d in docs]
+        self.titles = [d.get("title", "") for d in docs]
+        self.index = {book_id: i for i, book_id in enumerate(self.ids)}
+        self.tokens = [_tokens(d) for d in docs]
+        # A feature held by one book adds to its norm but never to a dot product.
+        self.norms = [math.sqrt(sum(w * w for w in t.values())) or 1.0 for t in self.tokens]
+        df: Dict[str, int] = defaultdict(int)
+        for t in self.tokens:
+            for name in t:
+                df[name] += 1
+        self.columns = {name: c for c, name in enumerate(n for n, k in df.items() if k > 1)}
+        self.postings: Dict[int, List[Tuple[int, float]]] = defaultdict(list)
+        for i, t in enumerate(self.tokens):
+            for name, w in t.items():
+                c = self.columns.get(name)
+                if c is not None:
+                    self.postings[c].append((i, w))
+
+    @classmethod
+    def load(cls, collection=None, query=None) -> "Catalogue":
+        return cls(list((collection or Book._reads()).find(query or {}, FIELDS).sort("_id", 1)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def normalised_postings(self):
+        """Per shared feature, (row indices, weights / row norms) as numpy arrays."""
+        norms = np.asarray(self.norms, dtype=np.float32)
+        out = {}
+        for c, posting in self.postings.items():
+            rows = np.fromiter((i for i, _ in posting), dtype=np.int64, count=len(posting))
+            weights = np.fromiter((w for _, w in posting), dtype=np.float32, count=len(posting))
+            out[c] = (rows, weights / norms[rows])
+        return out
+
+
+def co_loans(catalogue: Catalogue) -> Dict[int, Dict[int, float]]:
+    """
+    Loan co-occurrence between books as row index -> {row index: score}, where
+    score = users who borrowed both / sqrt(users of i * users of j).
+    """
+    pipeline = [
+        {"$sort": {"borrow_date": -1}},
+        {"$group": {"_id": "$user", "books": {"$push": "$book"}}},
+    ]
+    pairs: Dict[Tuple[int, int], int] = defaultdict(int)
+    readers: Dict[int, int] = defaultdict(int)
+    for row in Loan._get_collection().aggregate(pipeline, allowDiskUse=True):
+        recent = dict.fromkeys(catalogue.index[b] for b in row["books"] if b in catalogue.index)
+        rows = sorted(list(recent)[:CO_LOAN_MAX_PER_USER])
+        for i in rows:
+            readers[i] += 1
+        for pair in combinations(rows, 2):
+            pairs[pair] += 1
+    scores: Dict[int, Dict[int, float]] = defaultdict(dict)
+    for (i, j), n in pairs.items():
+        s = n / math.sqrt(readers[i] * readers[j])
+        scores[i][j] = scores[j][i] = s
+    return scores
+
+
+def _top_k_numpy(catalogue, co, k, batch_size):
+    # Scores are accumulated from the postings a block of rows at a time, so
+    # memory is the postings plus one (batch_size x books) block.
+    postings = catalogue.normalised_postings()
+    n = len(catalogue)
+    kk = min(k, n - 1)
+    for start in range(0, n, batch_size):
+        stop = min(start + batch_size, n)
+        scores = np.zeros((stop - start, n), dtype=np.float32)
+        for i in range(start, stop):
+            row = scores[i - start]
+            for name, w in catalogue.tokens[i].items():
+                c = catalogue.columns.get(name)
+                if c is not None:
+                    rows, weights = postings[c]
+                    row[rows] += weights * (w / catalogue.norms[i])
+            for j, s in co.get(i, {}).items():
+                row[j] += CO_LOAN_WEIGHT * s
+        scores[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+        if kk <= 0:
+            for i in range(start, stop):
+                yield i, []
+            continue
+        best = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+        for r, cols in enumerate(best):
+            ranked = sorted(((float(scores[r, c]), int(c)) for c in cols), reverse=True)
+            yield start + r, [(j, s) for s, j in ranked if s > 0]
+
+
+def _scores_for(catalogue, tokens: Dict[str, float], norm: float) -> Dict[int, float]:
+    acc: Dict[int, float] = defaultdict(float)
+    for name, w in tokens.items():
+        c = catalogue.columns.get(name)
+        for j, wj in catalogue.postings.get(c, ()) if c is not None else ():
+            acc[j] += w * wj
+    return {j: s / (norm * catalogue.norms[j]) for j, s in acc.items()}
+
+
+def _top_k_python(catalogue, co, k):
+    for i, tokens in enumerate(catalogue.tokens):
+        scores = _scores_for(catalogue, tokens, catalogue.norms[i])
+        for j, s in co.get(i, {}).items():
+            scores[j] = scores.get(j, 0.0) + CO_LOAN_WEIGHT * s
+        scores.pop(i, None)
+        best = heapq.nlargest(k, ((s, j) for j, s in scores.items() if s > 0))
+        yield i, [(j, s) for s, j in best]
+
+
+def _items(catalogue, ranked) -> List[Dict[str, Any]]:
+    return [{"id": catalogue.ids[j], "title": catalogue.titles[j], "score": round(s, 4)}
+            for j, s in ranked]
+
+
+def _floor(items, k) -> float:
+    return items[-1]["score"] if len(items) >= k else -1.0
+
+
+def _floor_expr(k) -> Dict[str, Any]:
+    """_floor() as an aggregation expression over the stored items."""
+    return {"$cond": [{"$gte": [{"$size": "$items"}, k]}, {"$arrayElemAt": ["$items.score", -1]}, -1.0]}
+
+
+def _neighbours(doc: Dict[str, Any], limit: int) -> List[Dict[str, Any]]:
+    """
+    Pipeline for the 'limit' books sharing the most weighted genres, authors
+    and category with 'doc', the only ones it can score above zero against.
+    """
+    genres = doc.get("genres") or []
+    authors = set()
+    for author in doc.get("authors") or []:
+        name = author.replace("(Illustrator)", "").strip()
+        authors.update((author, name, f"{name} (Illustrator)"))
+    authors = sorted(authors)
+    clauses: List[Dict[str, Any]] = []
+    if genres:
+        clauses.append({"genres": {"$in": genres}})
+    if authors:
+        clauses.append({"authors": {"$in": authors}})
+    if doc.get("category"):
+        clauses.append({"category": doc["category"]})
+    if not clauses:
+        return []
+
+    def shared(field, values):
+        return {"$size": {"$filter": {"input": {"$ifNull": [f"${field}", []]},
+                                      "cond": {"$in": ["$$this", values]}}}}
+
+    return [
+        {"$match": {"$or": clauses, "_id": {"$ne": doc["_id"]}}},
+        {"$addFields": {"_shared": {"$add": [
+            {"$multiply": [FEATURE_WEIGHTS["genres"], shared("genres", genres)]},
+            {"$multiply": [FEATURE_WEIGHTS["authors"], shared("authors", authors)]},
+            {"$cond": [{"$eq": ["$category", doc.get("category")]}, FEATURE_WEIGHTS["category"], 0]},
+        ]}}},
+        {"$sort": {"_shared": -1, "_id": 1}},
+        {"$limit": limit},
+        {"$project": FIELDS},
+    ]
+
+
+def rebuild(k: int = TOP_K, batch_size: int = 512) -> int:
+    """Recompute every book's top-k similar titles; returns the number of books written."""
+    stamp = datetime.now(timezone.utc).replace(microsecond=0)
+    coll = SimilarBooks._get_collection()
+    # Lists that add_book() writes while this runs are not in 'before' and survive.
+    before = [d["_id"] for d in coll.find({}, {"_id": 1})]
+    catalogue = Catalogue.load()
+    co = co_loans(catalogue)
+    ranked = (_top_k_numpy(catalogue, co, k, batch_size) if np is not None
+              else _top_k_python(catalogue, co, k))
+
+    ops, written = [], 0
+    for i, best in ranked:
+        items = _items(catalogue, best)
+        ops.append(ReplaceOne(
+            {"_id": catalogue.ids[i]},
+            {"items": items, "floor": _floor(items, k), "computed_at": stamp, "updated_at": stamp},
+            upsert=True,
+        ))
+        if len(ops) >= 1000:
+            written += len(ops)
+            coll.bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        written += len(ops)
+        coll.bulk_write(ops, ordered=False)
+    gone = [book_id for book_id in before if book_id not in catalogue.index]
+    for start in range(0, len(gone), 1000):
+        coll.delete_many({"_id": {"$in": gone[start:start + 1000]}})
+    return written
+
+
+def add_book(book_id, k: int = TOP_K, limit: int = None) -> int:
+    """
+    Incremental refresh for a newly added title: compute its own list, and push
+    it into the lists of books it now beats (only where its score clears their
+    stored floor). Only its 'limit' (default NEIGHBOURS_MAX) closest neighbours
+    are considered; the next rebuild() covers the rest. Returns the number of
+    other lists updated.
+    """
+    # From the primary: the new title may not have reached a secondary yet.
+    books = Book._get_collection()
+    doc = books.find_one({"_id": book_id}, FIELDS)
+    if doc is None:
+        return 0
+    # Features shared within this subset are shared in the whole catalogue,
+    # so its scores match a full rebuild's for the books it holds.
+    pipeline = _neighbours(doc, limit or NEIGHBOURS_MAX)
+    rows = list(books.aggregate(pipeline)) if pipeline else []
+    catalogue = Catalogue(sorted([doc, *rows], key=lambda d: d["_id"]))
+    i = catalogue.index[book_id]
+    scores = _scores_for(catalogue, catalogue.tokens[i], catalogue.norms[i])
+    scores.pop(i, None)
+    best = heapq.nlargest(k, ((s, j) for j, s in scores.items() if s > 0))
+    items = _items(catalogue, [(j, s) for s, j in best])
+
+    coll = SimilarBooks._get_collection()
+    now = datetime.now(timezone.utc)
+    coll.replace_one(
+        {"_id": book_id},
+        {"items": items, "floor": _floor(items, k), "computed_at": now, "updated_at": now},
+        upsert=True,
+    )
+
+    candidates = {catalogue.ids[j]: s for j, s in scores.items() if s > 0}
+    me = {"id": book_id, "title": catalogue.titles[i]}
+    pushed = [
+        d["_id"] for d in coll.find({"_id": {"$in": list(candidates)}}, {"floor": 1})
+        if candidates[d["_id"]] > d.get("floor", -1.0)
+    ]
+    ops = [
+        UpdateOne({"_id": other}, {
+            "$push": {"items": {
+                "$each": [{**me, "score": round(candidates[other], 4)}],
+                "$sort": {"score": -1}, "$slice": k,
+            }},
+            "$set": {"updated_at": now},
+        })
+        for other in pushed
+    ]
+    if ops:
+        coll.bulk_write(ops, ordered=False)
+        # Lists that were short may be full now, and full ones have a new last item.
+        coll.update_many({"_id": {"$in": pushed}}, [{"$set": {"floor": _floor_expr(k)}}])
+    return len(ops)
+
+
+# One refresh at a time, off the request thread: see queue_add_book().
+_pending = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recommend")
+
+
+def queue_add_book(book_id, k: int = TOP_K) -> Future:
+    """Run add_book() in the background, so a slow or failed refresh never fails a save."""
+    future = _pending.submit(add_book, book_id, k)
+    future.add_done_callback(_log_failure)
+    return future
+
+
+def _log_failure(future: Future) -> None:
+    if future.exception() is not None:
+        log.error("recommendation refresh failed", exc_info=future.exception())
@@ -0,0 +1,190 @@
+"""
+Compare the sync and async (ASYNC_READS) read views under simulated DB latency.
+
+    python -m bench.async_reads --latency-ms 5 --requests 200 --concurrency 8
+
+Both apps talk to MongoDB through an in-process TCP proxy that holds every
+chunk for --latency-ms in each direction, so each round trip costs about
+2 x latency on top of the server's own time. Views that issue their
+independent queries together gain roughly one round trip per query saved.
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.run import DEFAULT_HOST, percentile
+
+ROUTES = ("/books", "/books?genre=<genre>", "/book/<title>", "/books/search?q=<word>", "/loans")
+
+
+class LatencyProxy:
+    """TCP forwarder to 'upstream' that delays each chunk by 'delay' seconds, keeping order."""
+
+    def __init__(self, upstream_host, upstream_port, delay):
+        self.upstream = (upstream_host, upstream_port)
+        self.delay = delay
+        self.port = None
+        self._ready = threading.Event()
+
+    def start(self):
+        threading.Thread(target=lambda: asyncio.run(self._serve()), daemon=True).start()
+        self._ready.wait()
+        return self
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._client, "127.0.0.1", 0)
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def _client(self, reader, writer):
+        up_reader, up_writer = await asyncio.open_connection(*self.upstream)
+        await asyncio.gather(self._pipe(reader, up_writer), self._pipe(up_reader, writer),
+                             return_exceptions=True)
+
+    async def _pipe(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+
+        async def pump():
+            while data := await reader.read(65536):
+                await chunks.put((loop.time() + self.delay, data))
+            await chunks.put((None, b""))
+
+        async def drain():
+            while True:
+                due, data = await chunks.get()
+                if due is None:
+                    writer.close()
+                    return
+                wait = due - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                writer.write(data)
+                await writer.drain()
+
+        await asyncio.gather(pump(), drain())
+
+
+def proxied(host, port):
+    """'host' (a mongodb:// URI) pointed at the local proxy, as a direct connection."""
+    parts = urllib.parse.urlsplit(host)
+    query = urllib.parse.parse_qs(parts.query)
+    query["directConnection"] = ["true"]
+    return urllib.parse.urlunsplit(
+        (parts.scheme, f"127.0.0.1:{port}", parts.path, urllib.parse.urlencode(query, doseq=True), "")
+    )
+
+
+def run(app, emails, paths, n_requests, concurrency, rng):
+    from bench.seed import BENCH_PASSWORD
+
+    local = threading.local()
+    logins = iter(range(sys.maxsize))
+
+    def client():
+        # One logged-in test client per worker thread; they are not thread-safe.
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+            email = emails[next(logins) % len(emails)]
+            local.client.post("/login", data={"email": email, "password": BENCH_PASSWORD})
+        return local.client
+
+    def one(job):
+        route, url = job
+        c = client()
+        started = time.perf_counter()
+        resp = c.get(url)
+        if resp.status_code >= 500:
+            raise RuntimeError(f"{url} returned {resp.status_code}")
+        return route, time.perf_counter() - started
+
+    jobs = [(route, rng.choice(urls)) for _ in range(n_requests) for route, urls in paths.items()]
+    samples = {route: [] for route in paths}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        for route, elapsed in pool.map(one, jobs):
+            samples[route].append(elapsed)
+    return samples, time.perf_counter() - started
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mongodb-host", default=os.environ.get("BENCH_MONGODB_HOST", DEFAULT_HOST))
+    parser.add_argument("--books", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--loans", type=int, default=20000)
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="one-way delay added by the proxy")
+    parser.add_argument("--requests", type=int, default=100, help="requests per route and mode")
+    parser.add_argument("--concurrency", type=int, default=4, help="client threads")
+    parser.add_argument("--warm-facets", action="store_true",
+                        help="keep the facet cache (default: recount facets on every request)")
+    parser.add_argument("--no-seed", action="store_true", help="reuse the existing bench data")
+    parser.add_argument("--seed", type=int, default=239)
+    args = parser.parse_args(argv)
+
+    parts = urllib.parse.urlsplit(args.mongodb_host)
+    db_name = parts.path.lstrip("/")
+    if not args.no_seed and "bench" not in db_name:
+        parser.error(f"refusing to reseed database {db_name!r}; its name must contain 'bench'")
+
+    from app import create_app
+    from app.model import Book, User
+    from bench.seed import seed
+
+    proxy = LatencyProxy(parts.hostname or "localhost", parts.port or 27017, args.latency_ms / 1000).start()
+    config = {
+        "TESTING": True,
+        "MONGODB_HOST": proxied(args.mongodb_host, proxy.port),
+        "MONGODB_CATALOGUE_READ_PREFERENCE": "primary",
+    }
+    if not args.warm_facets:
+        config["FACET_CACHE_TTL"] = 0
+    apps = {"sync": create_app({**config, "ASYNC_READS": False}),
+            "async": create_app({**config, "ASYNC_READS": True})}
+
+    with apps["sync"].app_context():
+        if not args.no_seed:
+            seed(args.books, args.users, args.loans, seed_value=args.seed)
+            Book.ensure_indexes()
+        emails = [u.email for u in User.objects(email__startswith="bench").only("email")]
+        docs = list(Book._get_collection().aggregate([{"$sample": {"size": 50}}]))
+        genres = list(Book.facet_counts("genres"))[:10]
+
+    titles = [urllib.parse.quote(d["title"]) for d in docs]
+    words = [w for d in docs for w in d["title"].split() if len(w) > 4][:50] or ["book"]
+    paths = {
+        "/books": [f"/books?after={t}" for t in titles],
+        "/books?genre=<genre>": [f"/books?genre={urllib.parse.quote(g)}" for g in genres],
+        "/book/<title>": [f"/book/{t}" for t in titles],
+        "/books/search?q=<word>": [f"/books/search?q={urllib.parse.quote(w)}" for w in words],
+        "/loans": ["/loans"],
+    }
+
+    print(f"one-way latency {args.latency_ms:.1f}ms, {args.concurrency} client threads")
+    print(f"{'route':<24}{'sync p50':>10}{'p95':>9}{'async p50':>11}{'p95':>9}{'speedup':>9}")
+    results = {}
+    for mode, app in apps.items():
+        run(app, emails, paths, 3, args.concurrency, random.Random(args.seed))  # warm pools and loop
+        results[mode] = run(app, emails, paths, args.requests, args.concurrency, random.Random(args.seed))
+    for route in ROUTES:
+        s, a = results["sync"][0][route], results["async"][0][route]
+        s50, a50 = percentile(s, 50) * 1000, percentile(a, 50) * 1000
+        print(f"{route:<24}{s50:>8.1f}ms{percentile(s, 95) * 1000:>7.1f}ms"
+              f"{a50:>9.1f}ms{percentile(a, 95) * 1000:>7.1f}ms{s50 / a50 if a50 else 0:>8.2f}x")
+    for mode in apps:
+        samples, wall = results[mode]
+        n = sum(len(v) for v in samples.values())
+        print(f"{mode:<6} {n} requests in {wall:.2f}s ({n / wall if wall else 0:.1f} req/s)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
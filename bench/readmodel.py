@@ -0,0 +1,79 @@
+"""
+Compare MongoEngine Documents with the raw-dict read views used by the
+catalogue, detail and loans pages.
+
+    python -m bench.readmodel --books 10000 --users 200 --loans 50000 --repeat 50
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import urllib.parse
+
+from bench.run import DEFAULT_HOST, percentile
+
+
+def timeit(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mongodb-host", default=os.environ.get("BENCH_MONGODB_HOST", DEFAULT_HOST))
+    parser.add_argument("--books", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--loans", type=int, default=20000)
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--no-seed", action="store_true", help="reuse the existing bench data")
+    parser.add_argument("--seed", type=int, default=239)
+    args = parser.parse_args(argv)
+
+    db_name = urllib.parse.urlparse(args.mongodb_host).path.lstrip("/")
+    if not args.no_seed and "bench" not in db_name:
+        parser.error(f"refusing to reseed database {db_name!r}; its name must contain 'bench'")
+
+    from app import create_app
+    from app.model import Book, Loan, User
+    from app.readmodel import BookView, LoanView
+    from bench.seed import seed
+
+    app = create_app({"TESTING": True, "MONGODB_HOST": args.mongodb_host})
+    rng = random.Random(args.seed)
+    if not args.no_seed:
+        seed(args.books, args.users, args.loans, seed_value=args.seed)
+
+    with app.app_context():
+        n = args.page_size
+        ids = [b["_id"] for b in Book._get_collection().find({}, {"_id": 1})]
+        users = list(User.objects(email__startswith="bench").only("id"))
+        fields = Book.CARD_FIELDS
+
+        cases = [
+            ("catalogue page", lambda: list(Book.objects.order_by("title").only(*fields).limit(n)),
+             lambda: BookView.wrap(Book._get_collection().find({}, dict.fromkeys(fields, 1))
+                                   .sort("title", 1).limit(n))),
+            ("book detail", lambda: Book.objects(id=rng.choice(ids)).first(),
+             lambda: BookView.by_id(rng.choice(ids))),
+            ("loans page", lambda: Loan.for_user(rng.choice(users), resolve_books=True, per_page=n),
+             lambda: LoanView.for_user(rng.choice(users), per_page=n)),
+        ]
+
+        print(f"{'path':<16}{'documents p50':>15}{'p95':>9}{'views p50':>12}{'p95':>9}{'speedup':>9}")
+        for name, documents, views in cases:
+            timeit(documents, 3), timeit(views, 3)
+            doc_t, view_t = timeit(documents, args.repeat), timeit(views, args.repeat)
+            d50, v50 = percentile(doc_t, 50) * 1000, percentile(view_t, 50) * 1000
+            print(f"{name:<16}{d50:>13.2f}ms{percentile(doc_t, 95) * 1000:>7.2f}ms"
+                  f"{v50:>10.2f}ms{percentile(view_t, 95) * 1000:>7.2f}ms{d50 / v50 if v50 else 0:>8.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
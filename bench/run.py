@@ -0,0 +1,252 @@
+"""
+Benchmark the library app's hot routes and compare against a stored baseline.
+
+In-process (Flask test client, with MongoDB query counts):
+
+    python -m bench.run --books 10000 --users 200 --loans 50000 --requests 500
+
+Against a running server with several load-generating processes:
+
+    flask run &
+    python -m bench.run --http http://127.0.0.1:5000 --processes 4 --duration 30
+
+The target database is dropped and reseeded unless --no-seed is given, so
+its name must contain "bench".
+"""
+import argparse
+import http.cookiejar
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+
+from pymongo import monitoring
+
+DEFAULT_HOST = "mongodb://localhost:27017/sg_library_bench"
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+ROUTES = ("login", "/books", "/book/<title>", "/loan/make/<title>", "/loans")
+
+
+class QueryCounter(monitoring.CommandListener):
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# Must be registered before the app creates its MongoClient.
+query_counter = QueryCounter()
+monitoring.register(query_counter)
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = max(0, min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[k]
+
+
+def summarise(samples, wall_time):
+    report = {}
+    for route, data in samples.items():
+        lat = data["latencies"]
+        queries = data.get("queries") or []
+        report[route] = {
+            "n": len(lat),
+            "p50_ms": percentile(lat, 50) * 1000,
+            "p95_ms": percentile(lat, 95) * 1000,
+            "p99_ms": percentile(lat, 99) * 1000,
+            "rps": len(lat) / wall_time if wall_time else 0.0,
+            "queries": sum(queries) / len(queries) if queries else None,
+        }
+    return report
+
+
+def run_in_process(app, emails, titles, n_requests, rng):
+    from bench.seed import BENCH_PASSWORD
+
+    samples = defaultdict(lambda: {"latencies": [], "queries": []})
+
+    def timed(route, call):
+        before = query_counter.count
+        started = time.perf_counter()
+        resp = call()
+        elapsed = time.perf_counter() - started
+        if resp.status_code >= 500:
+            raise RuntimeError(f"{route} returned {resp.status_code}")
+        samples[route]["latencies"].append(elapsed)
+        samples[route]["queries"].append(query_counter.count - before)
+
+    clients = []
+    for email in rng.sample(emails, min(len(emails), 20)):
+        client = app.test_client()
+        timed("login", lambda: client.post("/login", data={"email": email, "password": BENCH_PASSWORD}))
+        clients.append(client)
+
+    started = time.perf_counter()
+    for _ in range(n_requests):
+        client = rng.choice(clients)
+        title = rng.choice(titles)
+        timed("/books", lambda: client.get("/books", query_string={"after": title}))
+        timed("/book/<title>", lambda: client.get(f"/book/{title}"))
+        timed("/loan/make/<title>", lambda: client.post(f"/loan/make/{title}"))
+        timed("/loans", lambda: client.get("/loans"))
+    return samples, time.perf_counter() - started
+
+
+def _http_worker(job):
+    base, email, password, titles, duration, seed_value = job
+    rng = random.Random(seed_value)
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    samples = defaultdict(lambda: {"latencies": []})
+
+    def timed(route, url, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        started = time.perf_counter()
+        try:
+            with opener.open(url, data=body) as resp:
+                resp.read()
+        except urllib.error.HTTPError as e:
+            if e.code >= 500:
+                raise
+        samples[route]["latencies"].append(time.perf_counter() - started)
+
+    timed("login", f"{base}/login", {"email": email, "password": password})
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        title = urllib.parse.quote(rng.choice(titles))
+        timed("/books", f"{base}/books?after={title}")
+        timed("/book/<title>", f"{base}/book/{title}")
+        timed("/loan/make/<title>", f"{base}/loan/make/{title}", {})
+        timed("/loans", f"{base}/loans")
+    return {route: dict(data) for route, data in samples.items()}
+
+
+def run_http(base, emails, titles, processes, duration):
+    from bench.seed import BENCH_PASSWORD
+
+    jobs = [
+        (base.rstrip("/"), emails[i % len(emails)], BENCH_PASSWORD, titles, duration, i)
+        for i in range(processes)
+    ]
+    started = time.perf_counter()
+    with multiprocessing.Pool(processes) as pool:
+        parts = pool.map(_http_worker, jobs)
+    wall = time.perf_counter() - started
+
+    samples = defaultdict(lambda: {"latencies": []})
+    for part in parts:
+        for route, data in part.items():
+            samples[route]["latencies"].extend(data["latencies"])
+    return samples, wall
+
+
+def compare(report, baseline, tolerance):
+    """Human-readable regressions of p95 latency or query count against the baseline."""
+    problems = []
+    for route, cur in report.items():
+        base = baseline.get(route)
+        if not base:
+            continue
+        if cur["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            problems.append(f"{route}: p95 {cur['p95_ms']:.1f}ms vs baseline {base['p95_ms']:.1f}ms")
+        if cur["queries"] is not None and base.get("queries") is not None:
+            if cur["queries"] > base["queries"] + 0.5:
+                problems.append(f"{route}: {cur['queries']:.1f} queries vs baseline {base['queries']:.1f}")
+    return problems
+
+
+def print_report(report, wall):
+    total = sum(r["n"] for r in report.values())
+    print(f"{'route':<22}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'queries':>9}")
+    for route in ROUTES:
+        r = report.get(route)
+        if not r:
+            continue
+        queries = f"{r['queries']:.1f}" if r["queries"] is not None else "-"
+        print(f"{route:<22}{r['n']:>7}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}"
+              f"{r['p99_ms']:>10.2f}{r['rps']:>10.1f}{queries:>9}")
+    print(f"total {total} requests in {wall:.2f}s ({total / wall if wall else 0:.1f} req/s)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mongodb-host", default=os.environ.get("BENCH_MONGODB_HOST", DEFAULT_HOST))
+    parser.add_argument("--books", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--loans", type=int, default=20000)
+    parser.add_argument("--requests", type=int, default=300, help="in-process iterations per route")
+    parser.add_argument("--no-seed", action="store_true", help="reuse the existing bench data")
+    parser.add_argument("--http", metavar="URL", help="drive a running server instead of the test client")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds per HTTP worker")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p95 slowdown, e.g. 0.25")
+    parser.add_argument("--seed", type=int, default=239)
+    args = parser.parse_args(argv)
+
+    db_name = urllib.parse.urlparse(args.mongodb_host).path.lstrip("/")
+    if not args.no_seed and "bench" not in db_name:
+        parser.error(f"refusing to reseed database {db_name!r}; its name must contain 'bench'")
+
+    from app import create_app
+    from app.model import Book, User
+    from bench.seed import seed
+
+    app = create_app({
+        "TESTING": True,
+        "MONGODB_HOST": args.mongodb_host,
+        "LOGIN_EMAIL_LIMIT": 10 ** 9,
+        "LOGIN_IP_LIMIT": 10 ** 9,
+    })
+    rng = random.Random(args.seed)
+    if not args.no_seed:
+        started = time.perf_counter()
+        seed(args.books, args.users, args.loans, seed_value=args.seed)
+        print(f"seeded {args.books} books, {args.users} users, {args.loans} loans "
+              f"in {time.perf_counter() - started:.1f}s")
+
+    emails = [u["email"] for u in User._get_collection().find({"email": {"$regex": "^bench"}}, {"email": 1})]
+    titles = [b["title"] for b in Book._get_collection().find({}, {"title": 1})]
+
+    if args.http:
+        samples, wall = run_http(args.http, emails, titles, args.processes, args.duration)
+    else:
+        samples, wall = run_in_process(app, emails, titles, args.requests, rng)
+
+    report = summarise(samples, wall)
+    print_report(report, wall)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+        print(f"baseline written to {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fh:
+            problems = compare(report, json.load(fh), args.tolerance)
+        for p in problems:
+            print(f"REGRESSION {p}")
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
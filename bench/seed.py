@@ -0,0 +1,99 @@
+import random
+from datetime import date, datetime, timedelta
+
+from pymongo import UpdateOne
+
+from books import all_books
+from app import recommend
+from app.importer import import_books
+from app.model import (
+    Book, Branch, Counter, Hold, Loan, LoanRollup, LoanSummary, Notification, SimilarBooks, User,
+)
+
+# Every collection the app keeps, so no state (counters, summaries, holds)
+# survives from a previous run.
+MODELS = (Book, User, Loan, Branch, Counter, Hold, Notification, LoanSummary, LoanRollup, SimilarBooks)
+
+BENCH_PASSWORD = "bench-pass"
+
+
+def synthetic_books(n: int, rng: random.Random):
+    """n book dicts shaped like books.all_books, with unique titles."""
+    for i in range(n):
+        base = all_books[i % len(all_books)]
+        copies = rng.randint(1, 10)
+        yield {
+            **base,
+            "title": f"{base['title']} #{i:06d}",
+            "category": rng.choice(("Children", "Teens", "Adult")),
+            "copies": copies,
+            "available": copies,
+        }
+
+
+def seed(n_books: int, n_users: int, n_loans: int, seed_value: int = 239):
+    """
+    Replace the contents of the current database with a synthetic catalogue,
+    n_users regular users (all sharing BENCH_PASSWORD) and n_loans loans,
+    with the read models (loan summaries, rollups, similar titles) built from
+    them as `flask migrate` would. Returns the list of user emails.
+    """
+    rng = random.Random(seed_value)
+    for doc in MODELS:
+        doc.drop_collection()
+        doc.ensure_indexes()
+    Branch.ensure_default()
+
+    import_books(Book._get_collection(), synthetic_books(n_books, rng), batch_size=2000,
+                 branch=Branch.DEFAULT)
+    Book.catalogue_changed()
+
+    pw = User.hash_pw(BENCH_PASSWORD)
+    emails = [f"bench{i}@lib.sg" for i in range(n_users)]
+    User._get_collection().insert_many(
+        [{"email": e, "password": pw, "name": f"Bench {i}", "is_admin": False}
+         for i, e in enumerate(emails)]
+    )
+
+    books = list(Book._get_collection().find({}, {"available": 1}))
+    users = [d["_id"] for d in User._get_collection().find({}, {"_id": 1})]
+    available = {b["_id"]: b.get("available") or 0 for b in books}
+    book_ids = list(available)
+
+    today = date.today()
+    loans = []
+    for _ in range(n_loans):
+        book_id = rng.choice(book_ids)
+        borrowed = today - timedelta(days=rng.randint(0, 120))
+        active = available[book_id] > 0 and rng.random() < 0.2
+        if active:
+            available[book_id] -= 1
+        returned = None if active else borrowed + timedelta(days=rng.randint(1, 14))
+        loans.append({
+            "user": rng.choice(users),
+            "book": book_id,
+            "borrow_date": datetime.combine(borrowed, datetime.min.time()),
+            "due_date": datetime.combine(Loan.due_from(borrowed), datetime.min.time()),
+            "return_date": datetime.combine(returned, datetime.min.time()) if returned else None,
+            "renew_count": rng.randint(0, 2),
+            "branch": Branch.DEFAULT,
+        })
+        if len(loans) >= 5000:
+            Loan._get_collection().insert_many(loans)
+            loans = []
+    if loans:
+        Loan._get_collection().insert_many(loans)
+
+    initial = {b["_id"]: b.get("available") or 0 for b in books}
+    ops = [
+        UpdateOne({"_id": book_id}, {"$set": {"available": avail, "holdings.0.available": avail}})
+        for book_id, avail in available.items() if avail != initial[book_id]
+    ]
+    if ops:
+        Book._get_collection().bulk_write(ops, ordered=False)
+
+    # Loans went in with insert_many, past the hooks that keep these current.
+    LoanSummary.rebuild()
+    LoanRollup.rebuild()
+    recommend.rebuild()
+    return emails
@@ -0,0 +1,54 @@
+"""
+Measure per-worker startup: a fresh interpreter importing the app and calling
+create_app(), as each gunicorn worker does on boot.
+
+    python -m bench.startup --runs 10 --target-ms 500
+
+Exits non-zero if the median exceeds --target-ms.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+from bench.run import DEFAULT_HOST, percentile
+
+PROBE = """
+import time
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+create_app({"MONGODB_HOST": %r})
+done = time.perf_counter()
+print(imported - started, done - imported)
+"""
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--mongodb-host", default=os.environ.get("BENCH_MONGODB_HOST", DEFAULT_HOST))
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--target-ms", type=float, default=500.0)
+    args = parser.parse_args(argv)
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, "MIGRATE_ON_STARTUP": "0"}
+    imports, creates = [], []
+    for _ in range(args.runs):
+        out = subprocess.run([sys.executable, "-c", PROBE % args.mongodb_host], cwd=root, env=env,
+                             check=True, capture_output=True, text=True).stdout.split()
+        imports.append(float(out[0]))
+        creates.append(float(out[1]))
+    totals = [a + b for a, b in zip(imports, creates)]
+
+    for name, values in (("import app", imports), ("create_app()", creates), ("total", totals)):
+        print(f"{name:<14} p50 {percentile(values, 50) * 1000:8.1f}ms   max {max(values) * 1000:8.1f}ms")
+    median = percentile(totals, 50) * 1000
+    if median > args.target_ms:
+        print(f"SLOW startup: {median:.1f}ms > target {args.target_ms:.0f}ms")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
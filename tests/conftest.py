@@ -0,0 +1,222 @@
+"""
+Fixtures for the test suite. Tests run against mongomock by default; set
+TEST_MONGODB_HOST (e.g. mongodb://localhost/sg_library_test) to use a real
+server instead. Collections are emptied after every test.
+"""
+import functools
+import io
+import itertools
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import mongoengine
+import pytest
+from pymongo import ReturnDocument, monitoring
+
+from app import create_app, db as app_db
+from app.model import Book, Hold, Loan, User, branch_cache, facet_cache, user_cache
+
+TEST_HOST = os.environ.get("TEST_MONGODB_HOST")
+PASSWORD = "12345"
+
+
+class CommandRecorder(monitoring.CommandListener):
+    """Command names seen while recording (see the 'commands' fixture)."""
+
+    def __init__(self):
+        self.names = None
+
+    def started(self, event):
+        if self.names is not None:
+            self.names.append(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+recorder = CommandRecorder()
+monitoring.register(recorder)
+
+
+def _use_mongomock():
+    """
+    Point app.db's connect() at mongomock and paper over the gaps the tests
+    hit: pymongo 4.x bulk-write arguments, positional '$' in
+    find_one_and_update, per-command atomicity and command monitoring.
+    """
+    import mongomock
+    import mongomock.collection as mc
+
+    store = mongomock.store.ServerStore()
+    connect = app_db.connect
+    app_db.connect = lambda *a, **kw: connect(*a, mongo_client_class=mongomock.MongoClient, _store=store, **kw)
+
+    def loose(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *a, **kw):
+            kw.pop("sort", None)
+            kw.pop("namespace", None)
+            return fn(self, *a, **kw)
+        return wrapper
+
+    for name in ("add_update", "add_replace", "add_delete"):
+        setattr(mc.BulkOperationBuilder, name, loose(getattr(mc.BulkOperationBuilder, name)))
+
+    # mongomock re-targets the update by _id and loses the element '$' matched.
+    original = mc.Collection.find_one_and_update
+
+    def find_one_and_update(self, filter, update, projection=None, sort=None, upsert=False,
+                            return_document=ReturnDocument.BEFORE, **kw):
+        positional = any("$." in k for op in update.values() if isinstance(op, dict) for k in op)
+        if sort or upsert or not positional:
+            return original(self, filter, update, projection=projection, sort=sort, upsert=upsert,
+                            return_document=return_document, **kw)
+        before = self.find_one(filter)
+        if before is None:
+            return None
+        self.update_one({**filter, "_id": before["_id"]}, update)
+        doc = before if return_document == ReturnDocument.BEFORE else self.find_one({"_id": before["_id"]})
+        if projection:
+            doc = {k: v for k, v in doc.items() if k == "_id" or projection.get(k)}
+        return doc
+
+    mc.Collection.find_one_and_update = find_one_and_update
+
+    # One command at a time, as the server applies each one atomically, and
+    # reported to command listeners like pymongo would.
+    lock = threading.RLock()
+    local = threading.local()
+    ids = itertools.count(1)
+
+    def command(name, fn):
+        @functools.wraps(fn)
+        def wrapper(self, *a, **kw):
+            if getattr(local, "busy", False):
+                return fn(self, *a, **kw)
+            event = SimpleNamespace(command_name=name, request_id=next(ids), database_name=self.database.name,
+                                    command={name: self.name}, duration_micros=0)
+            recorder.started(event)
+            with lock:
+                local.busy = True
+                try:
+                    return fn(self, *a, **kw)
+                finally:
+                    local.busy = False
+
+        return wrapper
+
+    for method, name in {
+        "find": "find", "find_one": "find", "aggregate": "aggregate", "count_documents": "aggregate",
+        "distinct": "distinct", "insert_one": "insert", "insert_many": "insert", "update_one": "update",
+        "update_many": "update", "replace_one": "update", "delete_one": "delete", "delete_many": "delete",
+        "bulk_write": "bulkWrite", "find_one_and_update": "findAndModify", "find_one_and_delete": "findAndModify",
+    }.items():
+        setattr(mc.Collection, method, command(name, getattr(mc.Collection, method)))
+
+
+if not TEST_HOST:
+    _use_mongomock()
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    flask_app = create_app({
+        "TESTING": True,
+        "MONGODB_HOST": TEST_HOST or "mongodb://localhost/sg_library_test",
+        "MONGODB_CATALOGUE_READ_PREFERENCE": "primary",
+        "COVER_CACHE_DIR": str(tmp_path_factory.mktemp("covers")),
+        "PASSWORD_HASH_METHOD": "pbkdf2:sha256:1000",
+        "LOGIN_IP_LIMIT": 10_000,  # every test client logs in from 127.0.0.1
+    })
+    with flask_app.app_context():
+        for doc in (Book, User, Loan, Hold):
+            doc.ensure_indexes()
+    return flask_app
+
+
+@pytest.fixture(autouse=True)
+def db(app):
+    """An empty database (indexes kept) and empty caches for every test."""
+    database = mongoengine.get_db()
+    yield database
+    for name in database.list_collection_names():
+        database[name].delete_many({})
+    for cache in (branch_cache, facet_cache, user_cache):
+        cache.clear()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def commands():
+    """Record command names issued inside 'with commands:' into commands.names."""
+    class Recording:
+        names = []
+
+        def __enter__(self):
+            self.names = recorder.names = []
+            return self
+
+        def __exit__(self, *exc):
+            recorder.names = None
+
+    return Recording()
+
+
+@pytest.fixture
+def cover_server():
+    """
+    Local stand-in for the cover image host: serves one fixed JPEG at any path
+    and counts requests in .hits. .url(path) gives an address on it.
+    """
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.new("RGB", (600, 800), (200, 40, 40)).save(buf, "JPEG")
+    image = buf.getvalue()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            server.hits += 1
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(image)))
+            self.end_headers()
+            self.wfile.write(image)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.hits = 0
+    server.url = lambda path: f"http://127.0.0.1:{server.server_port}/{path.lstrip('/')}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+_titles = itertools.count(1)
+
+
+def make_book(copies: int = 1, **fields) -> Book:
+    fields.setdefault("title", f"Test Book {next(_titles)}")
+    fields.setdefault("category", "Adult")
+    fields.setdefault("url", "http://covers.test/book.jpg")
+    return Book(copies=copies, available=copies, **fields).save()
+
+
+def make_user(email: str, **fields) -> User:
+    return User(email=email, name=email.split("@")[0], password=User.hash_pw(PASSWORD), **fields).save()
+
+
+def login(client, email: str, password: str = PASSWORD):
+    return client.post("/login", data={"email": email, "password": password})
@@ -0,0 +1,54 @@
+import time
+
+from conftest import login, make_user
+
+from app.auth_bp.throttle import MemoryBackend
+from app.model import User
+
+
+def test_needs_rehash_expands_short_method_names(monkeypatch):
+    monkeypatch.setattr(User, "HASH_METHOD", "scrypt")
+    user = User(email="a@lib.sg", name="A", password=User.hash_pw("pw"))
+    assert user.password.startswith("scrypt:32768:8:1$")
+    assert not user.needs_rehash()
+
+    monkeypatch.setattr(User, "HASH_METHOD", "pbkdf2:sha256:1000")
+    assert user.needs_rehash()
+
+
+def test_login_does_not_rewrite_a_current_hash(client):
+    user = make_user("reader@lib.sg")
+    for _ in range(2):
+        assert login(client, "reader@lib.sg").status_code == 302
+        client.get("/logout")
+    assert User.objects.get(id=user.id).password == user.password
+
+
+def test_login_rehashes_an_outdated_hash(client, monkeypatch):
+    user = make_user("reader@lib.sg")
+    monkeypatch.setattr(User, "HASH_METHOD", "pbkdf2:sha256:2000")
+    assert login(client, "reader@lib.sg").status_code == 302
+    stored = User.objects.get(id=user.id).password
+    assert stored.startswith("pbkdf2:sha256:2000$") and stored != user.password
+
+
+def test_memory_backend_forgets_expired_keys():
+    backend = MemoryBackend()
+    for i in range(100):
+        backend.hit(f"email:{i}@lib.sg", 0.01)
+    assert len(backend) == 100
+    time.sleep(0.02)
+    backend.hit("email:last@lib.sg", 0.01)
+    assert len(backend) == 1
+    time.sleep(0.02)
+    assert backend.count("email:last@lib.sg", 0.01) == 0
+    assert len(backend) == 0
+
+
+def test_each_client_logs_in_and_loads_its_own_user(app):
+    for email in ("first@lib.sg", "second@lib.sg"):
+        make_user(email)
+        client = app.test_client()
+        resp = login(client, email)
+        assert resp.status_code == 302 and "session=" in resp.headers.get("Set-Cookie", "")
+        assert email.split("@")[0].encode() in client.get("/loans").data
@@ -0,0 +1,100 @@
+from datetime import date
+
+import pytest
+from conftest import login, make_book, make_user
+from mongoengine import ValidationError
+
+from app import migrations
+from app.model import Book, Branch, Counter, Loan
+
+
+def _holdings(**counts):
+    return [{"branch": b, "copies": n, "available": n} for b, n in counts.items()]
+
+
+def _shelf(book_id):
+    doc = Book._get_collection().find_one({"_id": book_id})
+    return {h["branch"]: h["available"] for h in doc["holdings"]}, doc["available"], doc["copies"]
+
+
+def test_borrow_takes_the_first_ranked_branch_in_one_update(commands):
+    book = make_book(holdings=_holdings(main=1, east=1, west=1))
+    with commands:
+        assert book.borrow_one(prefer=["west", "east", "main"]) == "west"
+    assert commands.names.count("findAndModify") == 1
+    assert _shelf(book.id) == ({"main": 1, "east": 1, "west": 0}, 2, 3)
+
+
+def test_borrow_walks_the_ranking_when_branches_empty_meanwhile():
+    book = make_book(holdings=_holdings(main=1, east=1, west=1))
+    Book.take_copy(book.id, "west")  # the copy this stale read still shows is gone
+    assert book.borrow_one(prefer=["west", "east", "main"]) == "east"
+
+    Book.take_copy(book.id, "main")  # both branches this read showed are empty now
+    Book.credit_copy(book.id, "west")
+    stale = Book.objects.get(id=book.id)
+    Book.take_copy(book.id, "west")
+    Book.credit_copy(book.id, "main")
+    assert stale.borrow_one(prefer=["west", "east", "main"]) == "main"
+
+
+def test_last_copy_goes_to_one_borrower_only():
+    book = make_book(holdings=_holdings(main=1, east=0))
+    first, second = Book.objects.get(id=book.id), Book.objects.get(id=book.id)
+    assert first.borrow_one(prefer=["east", "main"]) == "main"
+    with pytest.raises(ValidationError):
+        second.borrow_one(prefer=["east", "main"])
+    assert _shelf(book.id) == ({"main": 0, "east": 0}, 0, 1)
+
+
+def test_returns_go_back_to_the_branch_they_came_from():
+    book = make_book(holdings=_holdings(main=1, east=1))
+    reader = make_user("reader@lib.sg")
+    single = Loan.create_for(user=reader, book=book, borrow_date=date.today(), branch="east")
+    single.do_return(date.today())
+    assert _shelf(book.id) == ({"main": 1, "east": 1}, 2, 2)
+
+    other = make_book(holdings=_holdings(main=1, east=1))
+    loans = [Loan.create_for(user=reader, book=b, borrow_date=date.today(), branch="east")
+             for b in (book, other)]
+    results = Loan.bulk_return(reader, [str(l.id) for l in loans], lambda _d: date.today())
+    assert set(results.values()) == {"ok"}
+    assert _shelf(book.id) == _shelf(other.id) == ({"main": 1, "east": 1}, 2, 2)
+
+
+def test_set_branch_copies_keeps_loaned_copies_out():
+    book = make_book(holdings=_holdings(main=2))
+    book.borrow_one("main")
+    Book.set_branch_copies(book.id, "east", 3)
+    Book.set_branch_copies(book.id, "main", 1)
+    assert _shelf(book.id) == ({"main": 0, "east": 3}, 3, 4)
+    with pytest.raises(ValidationError):
+        Book.set_branch_copies(book.id, "main", 0)
+
+
+def test_branch_migration_shelves_existing_stock_at_the_default_branch():
+    book = make_book(copies=2)
+    loan = Loan.create_for(user=make_user("reader@lib.sg"), book=book, borrow_date=date.today())
+    # As saved before branches existed.
+    Book._get_collection().update_one({"_id": book.id}, {"$unset": {"holdings": ""}})
+    Loan._get_collection().update_one({"_id": loan.id}, {"$unset": {"branch": ""}})
+
+    Counter.raise_to(migrations.SCHEMA, 9)
+    migrations.migrate(10)
+    assert _shelf(book.id) == ({Branch.DEFAULT: 1}, 1, 2)
+    assert Loan.objects.get(id=loan.id).branch == Branch.DEFAULT
+    assert Branch.DEFAULT in Branch.names()
+
+
+@pytest.mark.parametrize("target, expected", [
+    ("/book/Some%20Title", "/book/Some%20Title"),
+    ("https://evil.example/", "/books"),
+    ("//evil.example/", "/books"),
+    ("/\\evil.example/", "/books"),
+    ("/\t/evil.example/", "/books"),
+])
+def test_set_home_branch_redirects_only_within_the_site(client, target, expected):
+    make_user("reader@lib.sg")
+    login(client, "reader@lib.sg")
+    resp = client.post("/branch/home", query_string={"next": target}, data={"branch": ""})
+    assert resp.status_code == 302 and resp.headers["Location"] == expected
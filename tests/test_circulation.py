@@ -0,0 +1,63 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import pytest
+from conftest import make_book, make_user
+from mongoengine import ValidationError
+
+from app.model import Book, Loan
+
+COPIES = 3
+WORKERS = 8
+ROUNDS = 25
+
+
+def _counts(book_id):
+    doc = Book._get_collection().find_one({"_id": book_id}, {"available": 1, "copies": 1})
+    return doc["available"], doc["copies"]
+
+
+def test_concurrent_borrow_and_return_keep_counts_in_range():
+    book_id = make_book(copies=COPIES).id
+    users = [make_user(f"reader{i}@lib.sg") for i in range(WORKERS)]
+    seen, stop = [], threading.Event()
+
+    def watch():
+        while not stop.is_set():
+            seen.append(_counts(book_id))
+
+    def hammer(user):
+        borrowed = 0
+        for _ in range(ROUNDS):
+            try:
+                loan = Loan.create_for(user=user, book=Book.objects.get(id=book_id), borrow_date=date.today())
+            except ValidationError:
+                continue
+            borrowed += 1
+            seen.append(_counts(book_id))
+            loan.do_return(date.today())
+        return borrowed
+
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+    try:
+        with ThreadPoolExecutor(WORKERS) as pool:
+            borrowed = sum(pool.map(hammer, users))
+    finally:
+        stop.set()
+        watcher.join()
+
+    assert borrowed > 0
+    assert all(0 <= available <= copies == COPIES for available, copies in seen)
+    assert _counts(book_id) == (COPIES, COPIES)
+    assert Loan.objects(book=book_id, return_date=None).count() == 0
+
+
+def test_borrow_fails_cleanly_when_no_copies_left():
+    book = make_book(copies=1)
+    first, second = make_user("a@lib.sg"), make_user("b@lib.sg")
+    Loan.create_for(user=first, book=book, borrow_date=date.today())
+    with pytest.raises(ValidationError):
+        Loan.create_for(user=second, book=Book.objects.get(id=book.id), borrow_date=date.today())
+    assert _counts(book.id) == (0, 1)
@@ -0,0 +1,47 @@
+import io
+import time
+
+from conftest import make_book
+from PIL import Image
+
+from app.covers import SIZES
+
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_cover_miss_then_hit(app, client, cover_server):
+    book = make_book(url=cover_server.url("miss-then-hit.jpg"))
+    covers = app.extensions["covers"]
+
+    miss = client.get(f"/covers/{book.id}/card")
+    assert miss.status_code == 200
+    assert miss.mimetype == "image/svg+xml"
+    assert miss.cache_control.no_store
+
+    _wait_for(lambda: covers.cached(book.url, "card"))
+    hit = client.get(f"/covers/{book.id}/card")
+    assert hit.status_code == 200
+    assert hit.mimetype == "image/jpeg"
+    assert hit.cache_control.max_age == app.config["COVER_MAX_AGE"]
+    with Image.open(io.BytesIO(hit.data)) as img:
+        assert img.size == SIZES["card"]
+
+    # Another size is cut from the stored original without going back to the origin.
+    client.get(f"/covers/{book.id}/thumb")
+    _wait_for(lambda: covers.cached(book.url, "thumb"))
+    assert cover_server.hits == 1
+
+
+def test_cover_miss_does_not_wait_for_the_origin(app, cover_server):
+    covers = app.extensions["covers"]
+    url = cover_server.url("no-wait.jpg")
+    started = time.perf_counter()
+    assert covers.get(url, "detail") is None
+    assert time.perf_counter() - started < 0.5
+    _wait_for(lambda: covers.cached(url, "detail"))
+    assert covers.get(url, "detail").endswith(".detail.jpg")
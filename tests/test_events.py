@@ -0,0 +1,37 @@
+import pytest
+from conftest import make_book
+from flask import Flask
+
+from app.events import Hub, availability
+
+
+def test_streaming_is_off_by_default(app, client):
+    book = make_book(copies=0)
+    assert app.config["AVAILABILITY_EVENTS"] == "off"
+    assert b"EventSource" not in client.get(f"/book/{book.title}").data
+    assert b"EventSource" not in client.get("/books").data
+    assert client.get(f"/events/availability?id={book.id}").status_code == 404
+
+
+@pytest.mark.parametrize("workers, mode, ok", [
+    (1, "local", True), (4, "local", False), (4, "changestream", True), (4, "off", True),
+])
+def test_local_events_need_a_single_worker(workers, mode, ok):
+    flask_app = Flask(__name__)
+    flask_app.config.update(AVAILABILITY_EVENTS=mode, WORKERS=workers)
+    if ok:
+        Hub().init_app(flask_app)
+    else:
+        with pytest.raises(ValueError):
+            Hub().init_app(flask_app)
+
+
+def test_detail_page_swaps_buttons_in_place(app, client, monkeypatch):
+    monkeypatch.setitem(app.config, "AVAILABILITY_EVENTS", "local")
+    monkeypatch.setattr(availability, "mode", "local")
+    book = make_book(copies=0)
+    html = client.get(f"/book/{book.title}").data.decode()
+    assert "EventSource" in html
+    assert "location.reload" not in html
+    assert 'class="js-loan d-inline-flex gap-2 ms-2 d-none"' in html
+    assert 'class="js-unavailable d-inline ms-2"' in html
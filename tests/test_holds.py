@@ -0,0 +1,84 @@
+from datetime import date, datetime
+
+from conftest import login, make_book, make_user
+
+from app.model import Book, Hold, Loan, Notification
+
+
+def _books_etag(client):
+    resp = client.get("/books")
+    assert resp.status_code == 200
+    return resp.headers["ETag"]
+
+
+def _still_fresh(client, etag):
+    return client.get("/books", headers={"If-None-Match": etag}).status_code == 304
+
+
+def _book_on_hold():
+    """A one-copy title lent to 'lender@lib.sg' with 'holder@lib.sg' waiting for it."""
+    book = make_book(copies=1)
+    lender, holder = make_user("lender@lib.sg"), make_user("holder@lib.sg")
+    loan = Loan.create_for(user=lender, book=book, borrow_date=date.today())
+    Hold.place(holder, Book.objects.get(id=book.id))
+    return book, loan, holder
+
+
+def test_return_to_a_hold_refreshes_the_lenders_catalogue_etag(client):
+    _, loan, _ = _book_on_hold()
+    login(client, "lender@lib.sg")
+    etag = _books_etag(client)
+    assert _still_fresh(client, etag)
+
+    loan.do_return(date.today())
+    assert not _still_fresh(client, etag)
+
+
+def test_borrowing_a_ready_hold_refreshes_the_holders_catalogue_etag(client):
+    book, loan, holder = _book_on_hold()
+    loan.do_return(date.today())
+    assert Hold.active_for(holder, book.id)["status"] == "ready"
+
+    login(client, "holder@lib.sg")
+    etag = _books_etag(client)
+    Loan.create_for(user=holder, book=Book.objects.get(id=book.id), borrow_date=date.today())
+    assert not _still_fresh(client, etag)
+
+
+def test_bulk_return_to_a_hold_refreshes_the_catalogue_etag(client):
+    _, loan, _ = _book_on_hold()
+    login(client, "lender@lib.sg")
+    etag = _books_etag(client)
+    results = Loan.bulk_return(loan.user_id, [str(loan.id)], lambda _borrowed: date.today())
+    assert results == {str(loan.id): "ok"}
+    assert not _still_fresh(client, etag)
+
+
+def test_borrowing_from_the_shelf_fulfils_the_borrowers_hold():
+    book, loan, holder = _book_on_hold()
+    Book.set_branch_copies(book.id, "main", 2)  # a new copy reaches the shelf
+    Loan.create_for(user=holder, book=Book.objects.get(id=book.id), borrow_date=date.today())
+    assert Hold.active_for(holder, book.id) is None
+
+    loan.do_return(date.today())  # goes back on the shelf, not to the holder
+    assert Book.objects.get(id=book.id).available == 1
+    assert not Notification.objects(user=holder.id, kind="hold_ready").count()
+
+
+def test_borrowing_past_a_lapsed_ready_hold_passes_its_copy_on():
+    book, loan, holder = _book_on_hold()
+    loan.do_return(date.today())
+    Hold._get_collection().update_one({"user": holder.id}, {"$set": {"expires_at": datetime(2000, 1, 1)}})
+    Book.set_branch_copies(book.id, "main", 2)
+    Loan.create_for(user=holder, book=Book.objects.get(id=book.id), borrow_date=date.today())
+    assert Hold.active_for(holder, book.id) is None
+    assert Book.objects.get(id=book.id).available == 1
+
+
+def test_cancel_hold_ignores_an_offsite_next(client):
+    book, _, holder = _book_on_hold()
+    hold = Hold.active_for(holder, book.id)
+    login(client, "holder@lib.sg")
+    resp = client.post(f"/hold/{hold['_id']}/cancel", query_string={"next": "//evil.example/"})
+    assert resp.headers["Location"] == "/holds"
+    assert Hold.active_for(holder, book.id) is None
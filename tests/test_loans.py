@@ -0,0 +1,85 @@
+from datetime import date, datetime, timedelta, timezone
+
+from bson import ObjectId
+from conftest import login, make_book, make_user
+
+from app.model import Book, Loan, LoanSummary
+
+
+def _loans_page_commands(client, commands, email, n_loans):
+    user = make_user(email)
+    for _ in range(n_loans):
+        Loan.create_for(user=user, book=make_book(copies=2), borrow_date=date.today())
+    login(client, email)
+    client.get("/loans")  # warm the session principal and branch caches
+    with commands:
+        resp = client.get("/loans")
+    assert resp.status_code == 200
+    return commands.names
+
+
+def test_loans_page_issues_constant_queries(app, client, commands):
+    one = _loans_page_commands(client, commands, "one@lib.sg", 1)
+    client.get("/logout")
+    many = _loans_page_commands(client, commands, "many@lib.sg", app.config["LOANS_PAGE_SIZE"])
+    assert many == one
+
+
+def test_for_user_resolves_books_in_one_query(commands):
+    user = make_user("reader@lib.sg")
+    books = [make_book() for _ in range(5)]
+    for book in books:
+        Loan.create_for(user=user, book=book, borrow_date=date.today())
+    with commands:
+        loans = Loan.for_user(user, resolve_books=True)
+        titles = {loan.book.title for loan in loans}
+    assert titles == {b.title for b in books}
+    assert commands.names == ["find", "find"]
+
+
+def _tokens():
+    loans = Loan._get_collection().count_documents({"batch_token": {"$exists": True}})
+    books = Book._get_collection().count_documents({"holdings.batch_token": {"$exists": True}})
+    return loans, books
+
+
+def test_batches_leave_no_tokens_behind():
+    user = make_user("reader@lib.sg")
+    loans = [Loan.create_for(user=user, book=make_book(), borrow_date=date.today()) for _ in range(3)]
+    ids = [str(loan.id) for loan in loans]
+    assert set(Loan.bulk_renew(user, ids, lambda _d: date.today()).values()) == {"ok"}
+    assert set(Loan.bulk_return(user, ids, lambda _d: date.today()).values()) == {"ok"}
+    assert _tokens() == (0, 0)
+
+
+def test_clear_batch_tokens_drops_only_stale_ones():
+    user = make_user("reader@lib.sg")
+    book = make_book()
+    loan = Loan.create_for(user=user, book=book, borrow_date=date.today())
+    stale = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(hours=1))
+    Loan._get_collection().update_one({"_id": loan.id}, {"$set": {"batch_token": stale}})
+    Book._get_collection().update_one({"_id": book.id}, {"$set": {"holdings.0.batch_token": stale}})
+    other = make_book()
+    Book._get_collection().update_one({"_id": other.id}, {"$set": {"holdings.0.batch_token": ObjectId()}})
+
+    assert Loan.clear_batch_tokens() == 2
+    assert _tokens() == (0, 1)
+
+
+def test_bulk_delete_counts_only_loans_it_deleted(monkeypatch):
+    user = make_user("reader@lib.sg")
+    loans = [Loan.create_for(user=user, book=make_book(), borrow_date=date.today()) for _ in range(3)]
+    for loan in loans:
+        loan.do_return(date.today())
+    owned = Loan._owned.__func__
+
+    def deleted_meanwhile(cls, *args):
+        found = owned(cls, *args)
+        Loan.objects.get(id=loans[0].id).delete_if_returned()  # another request
+        return found
+
+    monkeypatch.setattr(Loan, "_owned", classmethod(deleted_meanwhile))
+    results = Loan.bulk_delete(user, [str(loan.id) for loan in loans])
+
+    assert results == {str(loans[0].id): "Loan not found.", str(loans[1].id): "ok", str(loans[2].id): "ok"}
+    assert LoanSummary.for_user(user).total_borrowed == 0
@@ -0,0 +1,64 @@
+from types import SimpleNamespace
+
+import pytest
+
+from app.metrics import RequestStats, _CommandListener, _current, describe
+
+
+def test_describe_keeps_only_command_collection_and_filter_keys():
+    update = {"update": "users", "updates": [
+        {"q": {"_id": 1, "email": "a@lib.sg"}, "u": {"$set": {"password": "scrypt:32768:8:1$salt$hash"}}},
+    ]}
+    assert describe("update", update) == "update users {_id,email}"
+    assert describe("find", {"find": "books", "filter": {"title": "Dune"}}) == "find books {title}"
+    assert describe("aggregate", {"aggregate": "books", "pipeline": [{"$match": {"genres": "SF"}}]}) \
+        == "aggregate books {genres}"
+    assert describe("insert", {"insert": "users", "documents": [{"email": "a@lib.sg"}]}) == "insert users {}"
+
+
+def _run(stats):
+    listener = _CommandListener()
+    event = SimpleNamespace(request_id=1, command_name="find", command={"find": "books", "filter": {"x": 1}},
+                            duration_micros=1500)
+    token = _current.set(stats)
+    try:
+        listener.started(event)
+        listener.succeeded(event)
+    finally:
+        _current.reset(token)
+    return stats
+
+
+def test_commands_are_only_described_when_traced():
+    untraced = _run(RequestStats())
+    assert untraced.queries == 1 and untraced.commands == [] and not untraced._pending
+    traced = _run(RequestStats(trace=True))
+    assert traced.commands == ["1.5ms find books {x}"]
+
+
+def test_async_reads_count_towards_the_request(app):
+    from asgiref.sync import async_to_sync
+
+    from app.aio import reads
+
+    listener = _CommandListener()
+
+    async def query(request_id):
+        event = SimpleNamespace(request_id=request_id, command_name="find",
+                                command={"find": "books", "filter": {}}, duration_micros=1000)
+        listener.started(event)
+        listener.succeeded(event)
+
+    async def view():
+        await reads.run(query(1))
+        await reads.gather(query(2), query(3))
+
+    stats = RequestStats(trace=True)
+    token = _current.set(stats)
+    try:
+        async_to_sync(view)()
+    finally:
+        _current.reset(token)
+    assert stats.queries == 3
+    assert stats.db_time == pytest.approx(0.003)
+    assert len(stats.commands) == 3
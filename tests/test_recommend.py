@@ -0,0 +1,119 @@
+import pytest
+from conftest import login, make_book, make_user
+
+from app import recommend
+from app.model import Book, SimilarBooks
+
+
+@pytest.fixture
+def shelf():
+    """Books in three loose clusters, plus one that shares nothing with the rest."""
+    specs = [
+        ("Adult", ["Fantasy", "Epic"], ["A. Writer"]),
+        ("Adult", ["Fantasy"], ["A. Writer (Illustrator)"]),
+        ("Adult", ["Fantasy", "Epic"], ["B. Writer"]),
+        ("Adult", ["Mystery"], ["C. Writer"]),
+        ("Teens", ["Romance"], ["D. Writer"]),
+        ("Teens", ["Romance", "Drama"], ["E. Writer"]),
+        ("Children", ["Picture Books"], ["F. Writer"]),
+    ]
+    return [make_book(category=c, genres=g, authors=a).id for c, g, a in specs]
+
+
+def _lists():
+    # Ties may come out in either order.
+    return {d["_id"]: sorted((-i["score"], i["id"]) for i in d["items"])
+            for d in SimilarBooks._get_collection().find()}
+
+
+def test_numpy_and_python_scorers_agree(shelf):
+    catalogue = recommend.Catalogue.load()
+    fast = dict(recommend._top_k_numpy(catalogue, {}, 3, batch_size=2))
+    slow = dict(recommend._top_k_python(catalogue, {}, 3))
+    assert fast.keys() == slow.keys()
+    for i in fast:
+        assert [j for j, _ in fast[i]] == [j for j, _ in slow[i]]
+        assert [s for _, s in fast[i]] == pytest.approx([s for _, s in slow[i]], rel=1e-5)
+
+
+def test_add_book_matches_a_full_rebuild(shelf):
+    recommend.rebuild(k=3)
+    new = make_book(category="Adult", genres=["Fantasy", "Epic"], authors=["A. Writer"]).id
+    assert recommend.add_book(new, k=3) > 0
+    incremental = _lists()
+    recommend.rebuild(k=3)
+    assert incremental == _lists()
+
+
+def test_add_book_scores_only_the_closest_neighbours(shelf, monkeypatch):
+    # A full category: many books share only "Children" with the new title.
+    for i in range(40):
+        make_book(category="Children", genres=[f"Topic {i}"], authors=[f"Filler {i}"])
+    loaded = []
+    init = recommend.Catalogue.__init__
+
+    def spy(self, docs):
+        loaded.extend(d["_id"] for d in docs)
+        init(self, docs)
+
+    monkeypatch.setattr(recommend.Catalogue, "__init__", spy)
+    monkeypatch.setattr(recommend, "NEIGHBOURS_MAX", 10)
+    new = make_book(category="Children", genres=["Picture Books"], authors=["G. Writer"]).id
+    recommend.add_book(new, k=3)
+    assert len(loaded) == 11 and shelf[-1] in loaded
+    assert SimilarBooks.for_book(new)["items"][0]["id"] == shelf[-1]
+
+
+def test_queue_add_book_refreshes_in_the_background(shelf):
+    recommend.rebuild(k=3)
+    new = make_book(category="Adult", genres=["Fantasy", "Epic"], authors=["A. Writer"]).id
+    assert recommend.queue_add_book(new, k=3).result(timeout=5) > 0
+    assert SimilarBooks.for_book(new)["items"]
+
+
+def test_add_book_refreshes_the_floor_of_lists_it_fills(shelf):
+    recommend.rebuild(k=3)
+    coll = SimilarBooks._get_collection()
+    picture_book = shelf[-1]
+    assert coll.find_one({"_id": picture_book})["floor"] == -1.0
+
+    for i in range(3):
+        recommend.add_book(make_book(category="Children", genres=["Picture Books"],
+                                     authors=[f"G{i}. Writer"]).id, k=3)
+    doc = coll.find_one({"_id": picture_book})
+    assert len(doc["items"]) == 3
+    assert doc["floor"] == doc["items"][-1]["score"] > -1.0
+
+
+def test_rebuild_keeps_lists_added_while_it_runs(shelf, monkeypatch):
+    recommend.rebuild(k=3)
+    removed = make_book(category="Teens", genres=["Romance"])
+    recommend.add_book(removed.id, k=3)
+    removed.delete()
+    added = []
+    load = recommend.Catalogue.load.__func__
+
+    def add_meanwhile(cls, collection=None, query=None):
+        catalogue = load(cls, collection, query)
+        if not added:
+            added.append(make_book(category="Teens", genres=["Romance"]).id)
+            recommend.add_book(added[0], k=3)
+        return catalogue
+
+    monkeypatch.setattr(recommend.Catalogue, "load", classmethod(add_meanwhile))
+    recommend.rebuild(k=3)
+    ids = set(_lists())
+    assert added[0] in ids and removed.id not in ids
+
+
+def test_new_book_saves_even_if_the_refresh_fails(client, monkeypatch):
+    def fail(*args):
+        raise RuntimeError("scorer down")
+
+    monkeypatch.setattr(recommend, "add_book", fail)
+    make_user("admin@lib.sg", is_admin=True)
+    login(client, "admin@lib.sg")
+    resp = client.post("/books/new", data={"title": "Fresh Title", "category": "Adult",
+                                           "url": "http://covers.test/fresh.jpg"})
+    assert resp.status_code == 302
+    assert Book.objects(title="Fresh Title").count() == 1
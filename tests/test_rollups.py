@@ -0,0 +1,30 @@
+from datetime import date
+
+from conftest import make_book, make_user
+
+from app import model
+from app.model import Loan, LoanRollup
+
+
+def _borrowed(_id):
+    doc = LoanRollup._get_collection().find_one({"_id": _id})
+    return doc and doc["borrowed"]
+
+
+def test_rebuild_keeps_rollups_recorded_while_it_runs(monkeypatch):
+    first, second = make_book(category="Teens"), make_book(category="Teens")
+    reader = make_user("reader@lib.sg")
+    Loan.create_for(user=reader, book=first, borrow_date=date.today())
+    reconcile = model._reconcile
+
+    def borrow_meanwhile(*args):
+        Loan.create_for(user=reader, book=second, borrow_date=date.today())
+        return reconcile(*args)
+
+    monkeypatch.setattr(model, "_reconcile", borrow_meanwhile)
+    LoanRollup.rebuild()
+
+    day = f"{date.today():%Y-%m-%d}"
+    assert _borrowed(f"book:{first.id}:{day}") == 1
+    assert _borrowed(f"book:{second.id}:{day}") == 1
+    assert _borrowed(f"category:Teens:{day}") == 2
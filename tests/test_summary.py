@@ -0,0 +1,99 @@
+from datetime import date
+
+from bson import ObjectId
+from conftest import login, make_book, make_user
+
+from app import model
+from app.model import Loan, LoanSummary
+
+
+def test_detail_etag_changes_with_the_loan_badge(client):
+    make_user("reader@lib.sg")
+    borrowed, other = make_book(), make_book()
+    login(client, "reader@lib.sg")
+    first = client.get(f"/book/{other.title}")
+    assert client.get(f"/book/{other.title}", headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+
+    client.post(f"/loan/make/{borrowed.title}")
+    resp = client.get(f"/book/{other.title}", headers={"If-None-Match": first.headers["ETag"]})
+    assert resp.status_code == 200 and resp.headers["ETag"] != first.headers["ETag"]
+
+
+def test_rebuild_keeps_summaries_changed_while_it_runs(monkeypatch):
+    book, later = make_book(copies=5), make_book(copies=5)
+    busy, fresh, drifted = (make_user(f"{n}@lib.sg") for n in ("busy", "fresh", "drifted"))
+    for user in (busy, drifted):
+        Loan.create_for(user=user, book=book, borrow_date=date.today())
+    LoanSummary.objects(user=drifted.id).update(set__total_borrowed=9)
+    gone = LoanSummary(user=ObjectId(), total_borrowed=3).save()
+
+    reconcile = model._reconcile
+
+    def borrow_meanwhile(*args):
+        for user in (busy, fresh):
+            Loan.create_for(user=user, book=later, borrow_date=date.today())
+        return reconcile(*args)
+
+    monkeypatch.setattr(model, "_reconcile", borrow_meanwhile)
+    LoanSummary.rebuild()
+
+    assert LoanSummary.for_user(busy).active_count == 2
+    assert LoanSummary.for_user(busy).total_borrowed == 2
+    assert LoanSummary.for_user(fresh).active_count == 1
+    assert LoanSummary.for_user(drifted).total_borrowed == 1
+    assert not LoanSummary.objects(user=gone.user).count()
+
+
+def _summary(user):
+    s = LoanSummary.for_user(user)
+    return s.active_count, s.total_borrowed, s.renewals_remaining
+
+
+def test_single_loan_changes_keep_the_summary_current():
+    reader = make_user("reader@lib.sg")
+    loan = Loan.create_for(user=reader, book=make_book(), borrow_date=date.today())
+    assert _summary(reader) == (1, 1, Loan.MAX_RENEWALS)
+    loan.do_renew(date.today())
+    assert _summary(reader) == (1, 1, Loan.MAX_RENEWALS - 1)
+    assert LoanSummary.for_user(reader).active[str(loan.id)]["due"].date() == loan.due_date
+    loan.do_return(date.today())
+    assert _summary(reader) == (0, 1, 0)
+    loan.delete_if_returned()
+    assert _summary(reader) == (0, 0, 0)
+
+
+def test_batch_loan_changes_keep_the_summary_current():
+    reader = make_user("reader@lib.sg")
+    ids = [str(Loan.create_for(user=reader, book=make_book(), borrow_date=date.today()).id)
+           for _ in range(3)]
+    Loan.bulk_renew(reader, ids[:2], lambda _d: date.today())
+    assert _summary(reader) == (3, 3, 3 * Loan.MAX_RENEWALS - 2)
+    Loan.bulk_return(reader, ids[:2], lambda _d: date.today())
+    assert _summary(reader) == (1, 3, Loan.MAX_RENEWALS)
+    Loan.bulk_delete(reader, ids)  # the active loan is refused
+    assert _summary(reader) == (1, 1, Loan.MAX_RENEWALS)
+
+
+def _badge(client):
+    page = client.get("/books").data.decode()
+    marker = 'bg-light text-success ms-2">'
+    return int(page.split(marker, 1)[1].split("<", 1)[0]) if marker in page else 0
+
+
+def test_nav_badge_counts_the_users_active_loans(client):
+    make_user("reader@lib.sg")
+    make_user("other@lib.sg")
+    books = [make_book() for _ in range(2)]
+    login(client, "reader@lib.sg")
+    assert _badge(client) == 0
+    for book in books:
+        client.post(f"/loan/make/{book.title}")
+    assert _badge(client) == 2
+
+    loan = Loan.objects(book=books[0].id).first()
+    client.post(f"/loan/{loan.id}/return")
+    assert _badge(client) == 1
+
+    other = client.application.test_client()
+    login(other, "other@lib.sg")
+    assert _badge(other) == 0